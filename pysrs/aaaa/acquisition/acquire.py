@@ -1,17 +1,238 @@
-import nidaqmx
-from nidaqmx.constants import AcquisitionType
 import numpy as np
-import matplotlib.pyplot as plt
 import time
 from pysrs.aaaa.instruments.galvos import Galvo
-from pysrs.aaaa.gui.gui import GUI
+from pysrs.aaaa.acquisition.demod import demodulate_raster
 import threading, time, os
-from PIL import Image
 from tkinter import messagebox
 from pysrs.mains.utils import generate_data
 
+def reduce_frame(data: np.ndarray, galvo: Galvo, numchans: int, demod: dict = None) -> list[np.ndarray]:
+    '''turn the raw AI samples of one raster into cropped 2D images
+
+    args:
+        data: raw samples as read from the AI task, shape (numchans, total_samples) or (total_samples,)
+        galvo: galvo object that generated the raster
+        numchans: number of AI channels in data
+        demod: optional software lock-in settings, the kwargs of demod.demodulate_raster (signal, reference,
+               frequency, harmonics, output, phase_deg). the signal channel is replaced by one image per
+               harmonic and the reference channel is dropped, other channels are averaged as usual
+
+    returns: list of 2D arrays, one per channel
+    '''
+
+    if demod:
+        data = np.asarray(data).reshape(numchans, -1)
+        signal, reference = demod.get('signal', 0), demod.get('reference')
+        images = []
+        for ch in range(numchans):
+            if ch == signal:
+                images += demodulate_raster(data, galvo, **demod)
+            elif ch != reference:
+                images += reduce_frame(data[ch], galvo, 1)
+        return images
+
+    data = np.asarray(data).reshape(numchans, galvo.total_y, galvo.total_x, galvo.pixel_samples)
+    data = data.mean(axis=3)
+    left = galvo.extrasteps_left
+    return [chan[:, left:left + galvo.numsteps_x] for chan in data]
+
+
+def read_raster(channels: list[str], galvo: Galvo, start_trigger: str = None, on_armed=None,
+                ttl: np.ndarray = None, ttl_line: str = None) -> np.ndarray:
+    '''run one raster with the galvos on AO and any number of AI channels on the same clock, without reducing it
+
+    args:
+        channels: full AI channel names, e.g. ['Dev1/ai1', 'Dev1/ai2'], channels on other cards go through multidev
+        galvo: galvo object holding the raster waveform
+        start_trigger: optional terminal the galvo output waits on, e.g. '/Dev1/PFI0' when the zaber stream sequences the steps
+        on_armed: optional callable run once both tasks are armed, e.g. to release the stage for the move that fires the trigger
+        ttl: optional bool array of total_samples, e.g. from galvo.ttl_waveform, played on ttl_line with the raster
+        ttl_line: DO line for the rpoc TTL, e.g. 'Dev1/port0/line4'
+
+    returns: raw samples, shape (len(channels), galvo.total_samples)
+    '''
+
+    from pysrs.aaaa.acquisition.multidev import shard_channels, read_raster_multi
+    if not set(shard_channels(channels)) <= {galvo.device}:
+        # AI on other cards, they share the galvo card's clock and start trigger
+        return read_raster_multi(channels, galvo, start_trigger, on_armed, ttl, ttl_line)
+
+    import nidaqmx # only needed on the rig, reduce_frame and the replays import this module without it
+    from nidaqmx.constants import AcquisitionType
+    with nidaqmx.Task() as ao_task, nidaqmx.Task() as ai_task, nidaqmx.Task() as do_task:
+        for chan in galvo.ao_chans:
+            ao_task.ao_channels.add_ao_voltage_chan(f'{galvo.device}/{chan}')
+        ao_task.timing.cfg_samp_clk_timing(
+            rate=galvo.rate,
+            sample_mode=AcquisitionType.FINITE,
+            samps_per_chan=galvo.total_samples
+        )
+        if start_trigger:
+            ao_task.triggers.start_trigger.cfg_dig_edge_start_trig(start_trigger)
+
+        for chan in channels:
+            ai_task.ai_channels.add_ai_voltage_chan(chan)
+        ai_task.timing.cfg_samp_clk_timing(
+            rate=galvo.rate,
+            source=f'/{galvo.device}/ao/SampleClock', # set the input task to read off the same clock as the galvos
+            sample_mode=AcquisitionType.FINITE,
+            samps_per_chan=galvo.total_samples
+        )
+
+        use_ttl = ttl is not None and ttl_line is not None
+        if use_ttl:
+            do_task.do_channels.add_do_chan(ttl_line)
+            do_task.timing.cfg_samp_clk_timing(
+                rate=galvo.rate,
+                source=f'/{galvo.device}/ao/SampleClock', # mask pixels line up with the galvo steps
+                sample_mode=AcquisitionType.FINITE,
+                samps_per_chan=galvo.total_samples
+            )
+            do_task.write(ttl, auto_start=False)
+
+        ao_task.write(galvo.waveform, auto_start=False)
+        ai_task.start() # start this first, because it uses the ao task to begin so its ok to wait
+        if use_ttl:
+            do_task.start()
+        ao_task.start()
+        if on_armed is not None:
+            on_armed()
+
+        timeout = galvo.total_samples / galvo.rate + 5
+        if start_trigger:
+            timeout += 30 # the stage has to arrive before the trigger comes
+        ao_task.wait_until_done(timeout=timeout)
+        ai_task.wait_until_done(timeout=timeout)
+        if use_ttl:
+            do_task.wait_until_done(timeout=timeout)
+
+        data = np.array(ai_task.read(number_of_samples_per_channel=galvo.total_samples))
+
+    return data.reshape(len(channels), -1)
+
+
+class RasterSession:
+    def __init__(self, channels: list[str], galvo: Galvo, ttl_line: str = None) -> None:
+        '''read_raster with the tasks kept committed between frames, for live view where the same raster repeats
+
+        the AO waveform is written once and regenerated on every start, so a frame only costs start, read and
+        stop, plus the DO write when a new TTL comes in. channels have to be on the galvo card (multidev syncs
+        several cards per frame and goes through read_raster).
+
+        args:
+            channels: full AI channel names on the galvo card
+            galvo: galvo object holding the raster waveform
+            ttl_line: DO line for the rpoc TTL, None for no TTL
+
+        returns: none
+        '''
+
+        import nidaqmx # only needed on the rig
+        from nidaqmx.constants import AcquisitionType, TaskMode, WriteRelativeTo
+        self.channels = list(channels)
+        self.galvo = galvo
+        self.ttl = None
+        self.tasks = []
+        try:
+            self.ao_task = self._task(nidaqmx)
+            for chan in galvo.ao_chans:
+                self.ao_task.ao_channels.add_ao_voltage_chan(f'{galvo.device}/{chan}')
+            self.ao_task.timing.cfg_samp_clk_timing(rate=galvo.rate, sample_mode=AcquisitionType.FINITE,
+                                                    samps_per_chan=galvo.total_samples)
+            self.ai_task = self._task(nidaqmx)
+            for chan in self.channels:
+                self.ai_task.ai_channels.add_ai_voltage_chan(chan)
+            self.ai_task.timing.cfg_samp_clk_timing(rate=galvo.rate, source=f'/{galvo.device}/ao/SampleClock',
+                                                    sample_mode=AcquisitionType.FINITE,
+                                                    samps_per_chan=galvo.total_samples)
+            self.do_task = None
+            if ttl_line is not None:
+                self.do_task = self._task(nidaqmx)
+                self.do_task.do_channels.add_do_chan(ttl_line)
+                self.do_task.timing.cfg_samp_clk_timing(rate=galvo.rate, source=f'/{galvo.device}/ao/SampleClock',
+                                                        sample_mode=AcquisitionType.FINITE,
+                                                        samps_per_chan=galvo.total_samples)
+                # every write replaces the whole pattern from sample 0, wherever the last frame left the stream
+                self.do_task.out_stream.relative_to = WriteRelativeTo.FIRST_SAMPLE
+                self.do_task.out_stream.offset = 0
+                self.do_task.write(np.zeros(galvo.total_samples, dtype=bool), auto_start=False)
+            self.ao_task.write(galvo.waveform, auto_start=False)
+            for task in self.tasks:
+                task.control(TaskMode.TASK_COMMIT) # reserve and program the hardware once, starts are cheap after
+        except Exception:
+            self.close()
+            raise
+        self.timeout = galvo.total_samples / galvo.rate + 5
+
+    def _task(self, nidaqmx):
+        task = nidaqmx.Task()
+        self.tasks.append(task)
+        return task
+
+    def read(self, ttl: np.ndarray = None, on_armed=None) -> np.ndarray:
+        '''one raster, same result as read_raster
+
+        args:
+            ttl: bool array of total_samples for this frame, None keeps the last one (all off at first)
+            on_armed: optional callable run once the tasks are started, the TTL is in the output buffer by then
+
+        returns: raw samples, shape (len(channels), galvo.total_samples)
+        '''
+
+        if ttl is not None and self.do_task is not None and ttl is not self.ttl:
+            self.do_task.write(ttl, auto_start=False)
+            self.ttl = ttl
+        try:
+            self.ai_task.start()
+            if self.do_task is not None:
+                self.do_task.start()
+            self.ao_task.start()
+            if on_armed is not None:
+                on_armed()
+            self.ao_task.wait_until_done(timeout=self.timeout)
+            data = np.array(self.ai_task.read(number_of_samples_per_channel=self.galvo.total_samples,
+                                              timeout=self.timeout))
+        finally:
+            for task in self.tasks:
+                task.stop() # back to committed, ready for the next start
+        return data.reshape(len(self.channels), -1)
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.close()
+        self.tasks = []
+
+
+def lockin_scan(channels: list[str], galvo: Galvo, start_trigger: str = None, on_armed=None,
+                demod: dict = None) -> list[np.ndarray]:
+    '''acquire one raster frame and reduce it to images, see read_raster for the args and reduce_frame for demod
+
+    returns: list of 2D arrays, one per channel
+    '''
+
+    return reduce_frame(read_raster(channels, galvo, start_trigger, on_armed), galvo, len(channels), demod)
+
+
+def pulse_digital_line(line: str, width: float = 2e-3) -> None:
+    '''send a short high pulse on a DO line, e.g. 'Dev1/port0/line5'
+
+    args:
+        line: full DO line name
+        width: time in s to hold the line high, long enough for the receiving controller to poll it
+
+    returns: none
+    '''
+
+    import nidaqmx
+    with nidaqmx.Task() as task:
+        task.do_channels.add_do_chan(line)
+        task.write(True, auto_start=True)
+        time.sleep(width)
+        task.write(False, auto_start=True)
+
+
 class Acquisition:
-    def __init__(self, ai_chans: list[str], ao_chans: list[str], galvo: Galvo, gui: GUI, config: dict = {}, **kwargs):
+    def __init__(self, ai_chans: list[str], ao_chans: list[str], galvo: Galvo, gui: 'GUI', config: dict = {}, **kwargs):
         '''create an acquisition coordinating object
         
         args:
@@ -64,14 +285,14 @@ class Acquisition:
 
         try: 
             while self.gui.running:
-                self.gui.update_config()
+                config = self.gui.config.snapshot() # entries are committed on the tk thread, never from here
 
                 channels = []
-                for chan in self.gui.config['device']:
-                    channels.append(f'{self.gui.config['device']}/{chan}')
+                for chan in config['ai_chans']:
+                    channels.append(f"{config['device']}/{chan}")
                 
                 if self.gui.simulation_mode.get():
-                    self.gui.data = generate_data(len(channels), config=self.gui.config)
+                    self.gui.data = generate_data(len(channels), config=config)
                 else: 
                     self.gui.data = self.acquire_single()
                 self.gui.root.after(0, self.gui.display_data)
@@ -108,49 +329,7 @@ class Acquisition:
         if isinstance(self.ai_chans, str): 
             self.ai_chans = [self.ai_chans] # probably unecessary
         
-        with nidaqmx.Task() as ao_task, nidaqmx.Task() as ai_task:
-            for chan in self.galvo.ao_chans:
-                ao_task.ao_channels.add_ao_voltage_chan(f'{self.galvo.device}/{chan}')
-            ao_task.timing.cfg_samp_clk_timing(
-                rate=self.galvo.rate,
-                sample_mode=AcquisitionType.FINITE,
-                samps_per_chan=self.galvo.total_samples
-            )
-
-            for chan in self.ai_chans:
-                ai_task.ai_channels.add_ai_voltage_chan(f'{self.galvo.device}/{chan}')
-            ai_task.timing.cfg_samp_clk_timing(
-                rate=self.galvo.rate,
-                source=f'/{self.galvo.device}/ao/SampleClock', # set the input task to read off the same clock as the galvos
-                sample_mode=AcquisitionType.FINITE,
-                amps_per_chan=self.galvo.total_samples
-            )
-
-            ao_task.write(self.galvo.waveform, auto_start=False)
-            ai_task.start() # start this first, because it uses the ao task to begin so its ok to wait
-            ao_task.start()
-
-            ao_task.wait_until_done(timeout=self.galvo.total_samples / self.galvo.rate + 5) 
-            ai_task.wait_until_done(timeout=self.galvo.total_samples / self.galvo.rate + 5) # order of waiting shouldnt matter since they use the same clock
-
-            data = np.array(ai_task.read(number_of_samples_per_channel=self.galvo.total_samples)) # thanks for the nice variable name nidaqmx devs
-
-        numchans = len(self.ai_chans)
-        output = []
-
-        if numchans == 1:
-            data = data.reshape(self.galvo.total_y, self.galvo.total_x, self.galvo.pixel_samples)
-            data = np.mean(data, axis=2)
-            output = data[:,self.galvo.extrasteps_left:-self.galvo.extrasteps_right]
-            return [output] # surely i dont have to rewrap this array 
-        else:
-            for i in range(numchans):
-                chan_data = data[i]  # shape=(total_samples,)
-                chan_data = chan_data.reshape(self.galvo.total_y, self.galvo.total_x, self.galvo.pixel_samples)
-                data2d = np.mean(chan_data, axis=2)
-                cropped = data2d[:,self.galvo.extrasteps_left:-self.galvo.extrasteps_right]
-                output.append(cropped)
-            return output
+        return lockin_scan([chan if '/' in chan else f'{self.galvo.device}/{chan}' for chan in self.ai_chans], self.galvo)
 
 
     def acquire_single_rpoc(self):
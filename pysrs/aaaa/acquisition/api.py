@@ -0,0 +1,350 @@
+import io
+import json
+import os
+import secrets
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import numpy as np
+from pysrs.aaaa.acquisition.engine import AcquisitionEngine, AcquisitionRequest
+from pysrs.aaaa.acquisition.scheduler import Experiment
+
+'''
+localhost control api for the acquisition engine
+
+plain http.server, json in and out, so scripts, notebooks and other programs can drive the microscope without
+the gui (or next to it, the gui submits to the same engine). progress is streamed as newline delimited json
+and frames come back as .npy bytes.
+
+    GET  /status                     engine status and job list
+    POST /jobs                       body is AcquisitionRequest.to_dict(), returns {"job": id}
+    GET  /jobs/<id>                  job summary
+    POST /jobs/<id>/cancel           stop after the current frame
+    GET  /jobs/<id>/events?since=n   event stream (ndjson) from event n until the job finishes
+    GET  /jobs/<id>/frames/<i>       frame i as .npy, (channels, ny, nx) float32
+
+with a scheduler (scheduler.py) attached:
+    GET  /queue                      queue status, runs and their engine jobs
+    POST /queue/pause, /queue/resume
+    POST /runs                       body is Experiment.to_dict() plus an optional "priority"
+    POST /runs/<id>/cancel
+    POST /runs/<id>/priority         body {"priority": n}
+
+every call needs the session token in an X-PySRS-Token header. serve() makes a new token per session and
+writes it to TOKEN_FILE (readable by the user only), EngineClient picks it up from there. on top of that,
+requests whose Host or Origin is not loopback are refused (a web page open on the rig pc can reach
+127.0.0.1, and dns rebinding can make it look same origin), POST bodies must be application/json (a page
+can only send that after a cors preflight, which this server never answers), and capture/mask/replay paths
+must resolve inside the data root, so a request can not write or read anywhere else on disk.
+'''
+
+DEFAULT_PORT = 8765
+TOKEN_HEADER = 'X-PySRS-Token'
+TOKEN_FILE = Path.home() / '.pysrs' / 'api_token'
+DATA_ROOT = Path.home() / 'pysrs_data' # capture_path, mask_path and replay_path of api requests live under here
+PATH_FIELDS = ('capture_path', 'mask_path', 'replay_path')
+LOOPBACK = ('127.0.0.1', 'localhost', '::1')
+
+
+def host_name(value: str) -> str:
+    # 'localhost:8765' -> 'localhost', '[::1]:8765' -> '::1', 'http://127.0.0.1:8765' -> '127.0.0.1'
+    value = value.strip().lower().split('://', 1)[-1].split('/', 1)[0]
+    if value.startswith('['):
+        return value[1:].split(']', 1)[0]
+    return value.rsplit(':', 1)[0] if value.count(':') == 1 else value
+
+
+def confine_paths(payload: dict, root) -> dict:
+    '''resolve the file paths of a request body inside the data root
+
+    args:
+        payload: request or experiment dict, PATH_FIELDS that are set are checked
+        root: data root, relative paths are taken relative to it
+
+    returns: payload with the paths replaced by their resolved absolute form, raises PermissionError outside root
+    '''
+
+    root = os.path.realpath(root)
+    for key in PATH_FIELDS:
+        if payload.get(key):
+            path = os.path.realpath(os.path.join(root, os.path.expanduser(str(payload[key]))))
+            if os.path.commonpath([root, path]) != root:
+                raise PermissionError(f'{key} has to be inside {root}.')
+            payload[key] = path
+    return payload
+
+
+class EngineHandler(BaseHTTPRequestHandler):
+    engine = None # set on the subclass made by serve()
+    scheduler = None
+    token = None
+    data_root = DATA_ROOT
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass # one line per request would drown the acquisition logs
+
+    def send_json(self, payload, status: int = 200) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self):
+        # (parts, query) of the path, e.g. ['jobs', '3', 'frames', '0'], {'since': '4'}
+        path, _, query = self.path.partition('?')
+        params = dict(p.split('=', 1) for p in query.split('&') if '=' in p)
+        return [p for p in path.split('/') if p], params
+
+    def find_job(self, job_id: str):
+        job = self.engine.jobs.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            self.send_json({'error': f'No job {job_id}.'}, 404)
+        return job
+
+    def refuse(self) -> bool:
+        # sends the error and returns True for anything that is not a local client holding the session token
+        origin = self.headers.get('Origin')
+        if host_name(self.headers.get('Host', '')) not in LOOPBACK or (origin and host_name(origin) not in LOOPBACK):
+            self.send_json({'error': 'Only local clients are served.'}, 403)
+            return True
+        if not secrets.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.token or ''):
+            self.send_json({'error': f'Missing or wrong {TOKEN_HEADER}.'}, 401)
+            return True
+        return False
+
+    def do_GET(self):
+        if self.refuse():
+            return
+        parts, params = self.route()
+        if parts == ['status']:
+            return self.send_json(self.engine.status())
+        if parts == ['queue'] and self.scheduler is not None:
+            return self.send_json(self.scheduler.status())
+        if len(parts) >= 2 and parts[0] == 'jobs':
+            job = self.find_job(parts[1])
+            if job is None:
+                return
+            if len(parts) == 2:
+                return self.send_json(job.summary())
+            if parts[2:] == ['events']:
+                return self.stream_events(job, int(params.get('since', 0)))
+            if len(parts) == 4 and parts[2] == 'frames' and parts[3].isdigit():
+                return self.send_frame(job, int(parts[3]))
+        self.send_json({'error': f'Unknown path {self.path}.'}, 404)
+
+    def do_POST(self):
+        parts, _ = self.route()
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b'' # read either way so the connection stays usable
+        if self.refuse():
+            return
+        if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+            return self.send_json({'error': 'POST bodies must be application/json.'}, 415)
+        if parts == ['jobs']:
+            try:
+                payload = confine_paths(json.loads(body or b'{}'), self.data_root)
+                request = AcquisitionRequest.from_dict(payload)
+                job = self.engine.submit(request)
+            except PermissionError as e:
+                return self.send_json({'error': str(e)}, 403)
+            except (ValueError, TypeError) as e:
+                return self.send_json({'error': str(e)}, 400)
+            return self.send_json({'job': job.id}, 202)
+        if parts[:1] in (['queue'], ['runs']) and self.scheduler is not None:
+            return self.post_queue(parts, body)
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+            job = self.find_job(parts[1])
+            if job is not None:
+                job.cancel()
+                self.send_json(job.summary())
+            return
+        self.send_json({'error': f'Unknown path {self.path}.'}, 404)
+
+    def post_queue(self, parts, body) -> None:
+        try:
+            payload = json.loads(body or b'{}')
+            if parts == ['queue', 'pause']:
+                self.scheduler.pause()
+            elif parts == ['queue', 'resume']:
+                self.scheduler.resume()
+            elif parts == ['runs']:
+                priority = int(payload.pop('priority', 0))
+                run = self.scheduler.submit(Experiment.from_dict(confine_paths(payload, self.data_root)), priority)
+                return self.send_json({'run': run.id}, 202)
+            elif len(parts) == 3 and parts[1].isdigit() and int(parts[1]) in self.scheduler.runs:
+                if parts[2] == 'cancel':
+                    self.scheduler.cancel(int(parts[1]))
+                elif parts[2] == 'priority':
+                    self.scheduler.reprioritize(int(parts[1]), int(payload['priority']))
+                else:
+                    return self.send_json({'error': f'Unknown path {self.path}.'}, 404)
+            else:
+                return self.send_json({'error': f'Unknown path {self.path}.'}, 404)
+        except PermissionError as e:
+            return self.send_json({'error': str(e)}, 403)
+        except (ValueError, TypeError, KeyError) as e:
+            return self.send_json({'error': str(e)}, 400)
+        self.send_json(self.scheduler.status())
+
+    def stream_events(self, job, since: int) -> None:
+        # chunked ndjson, one line per event as it happens, the stream ends with the job
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        seq = since
+        try:
+            while True:
+                events = job.events_since(seq, timeout=1.0)
+                if events:
+                    lines = b''.join(json.dumps(e).encode() + b'\n' for e in events)
+                    self.wfile.write(f'{len(lines):X}\r\n'.encode() + lines + b'\r\n')
+                    self.wfile.flush()
+                    seq += len(events)
+                elif job.finished and seq >= len(job.events):
+                    break
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client stopped listening, the job carries on
+
+    def send_frame(self, job, index: int) -> None:
+        if index >= len(job.frames):
+            return self.send_json({'error': f'Job {job.id} has {len(job.frames)} frames.'}, 404)
+        buffer = io.BytesIO()
+        np.save(buffer, job.frames[index].astype(np.float32, copy=False))
+        body = buffer.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(engine: AcquisitionEngine, host: str = '127.0.0.1', port: int = DEFAULT_PORT,
+          scheduler=None, token: str = None, data_root=DATA_ROOT) -> ThreadingHTTPServer:
+    '''start the api on a background thread
+
+    args:
+        engine: AcquisitionEngine to expose
+        host: loopback interface to bind, the api refuses requests addressed to anything else
+        port: tcp port, 0 picks a free one (see server.server_address)
+        scheduler: optional Scheduler on the same engine, enables the queue endpoints
+        token: session token, None makes a new one and writes it to TOKEN_FILE
+        data_root: folder api requests may capture to and load masks or replays from, created if needed
+
+    returns: the running server (its token is server.token), call shutdown() to stop it
+    '''
+
+    if host not in LOOPBACK:
+        raise ValueError(f'The acquisition api only binds to loopback, not {host}.')
+    if token is None:
+        token = secrets.token_urlsafe(32)
+        TOKEN_FILE.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(token)
+        print(f'[INFO] Acquisition api token written to {TOKEN_FILE}')
+    os.makedirs(data_root, exist_ok=True)
+    handler = type('BoundEngineHandler', (EngineHandler,), {'engine': engine, 'scheduler': scheduler,
+                                                            'token': token, 'data_root': str(data_root)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.token = token
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='acquisition-api', daemon=True).start()
+    print(f'[INFO] Acquisition api on http://{server.server_address[0]}:{server.server_address[1]}, files under {data_root}')
+    return server
+
+
+class EngineClient:
+    def __init__(self, url: str = f'http://127.0.0.1:{DEFAULT_PORT}', timeout: float = 10, token: str = None) -> None:
+        '''thin client for the api, e.g. from a notebook
+
+        args:
+            url: base url of serve()
+            timeout: seconds per call, event streams have no timeout
+            token: session token, None reads the one serve() wrote to TOKEN_FILE
+
+        returns: none
+        '''
+
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.token = token if token is not None else TOKEN_FILE.read_text().strip()
+
+    def open(self, path: str, method: str = 'GET', payload: dict = None, timeout: float = None):
+        data = None if payload is None else json.dumps(payload).encode()
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json', TOKEN_HEADER: self.token})
+        return urllib.request.urlopen(request, timeout=timeout)
+
+    def call(self, method: str, path: str, payload: dict = None):
+        with self.open(path, method, payload, self.timeout) as response:
+            return json.loads(response.read())
+
+    def status(self) -> dict:
+        return self.call('GET', '/status')
+
+    def submit(self, request: AcquisitionRequest) -> int:
+        return self.call('POST', '/jobs', request.to_dict())['job']
+
+    def job(self, job_id: int) -> dict:
+        return self.call('GET', f'/jobs/{job_id}')
+
+    def cancel(self, job_id: int) -> dict:
+        return self.call('POST', f'/jobs/{job_id}/cancel', {})
+
+    def queue(self) -> dict:
+        return self.call('GET', '/queue')
+
+    def submit_experiment(self, experiment: Experiment, priority: int = 0) -> int:
+        return self.call('POST', '/runs', {**experiment.to_dict(), 'priority': priority})['run']
+
+    def pause(self) -> dict:
+        return self.call('POST', '/queue/pause', {})
+
+    def resume(self) -> dict:
+        return self.call('POST', '/queue/resume', {})
+
+    def cancel_run(self, run_id: int) -> dict:
+        return self.call('POST', f'/runs/{run_id}/cancel', {})
+
+    def set_priority(self, run_id: int, priority: int) -> dict:
+        return self.call('POST', f'/runs/{run_id}/priority', {'priority': priority})
+
+    def events(self, job_id: int, since: int = 0):
+        # generator over the job's events as they happen, ends when the job does
+        with self.open(f'/jobs/{job_id}/events?since={since}') as response:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+
+    def frame(self, job_id: int, index: int) -> np.ndarray:
+        with self.open(f'/jobs/{job_id}/frames/{index}', timeout=self.timeout) as response:
+            return np.load(io.BytesIO(response.read()))
+
+    def run(self, request: AcquisitionRequest, on_event=None) -> list:
+        '''submit, follow the stream and fetch every frame
+
+        args:
+            request: what to acquire, keep_frames must be on
+            on_event: optional callable(event) for progress display
+
+        returns: list of (channels, ny, nx) arrays
+        '''
+
+        job_id = self.submit(request)
+        frames, last = [], None
+        for event in self.events(job_id):
+            if on_event is not None:
+                on_event(event)
+            if event['type'] == 'frame':
+                frames.append(self.frame(job_id, event['index']))
+            elif event['type'] == 'state':
+                last = event
+        if last is not None and last['state'] == 'error':
+            raise RuntimeError(f"Job {job_id} failed: {last.get('error')}")
+        return frames
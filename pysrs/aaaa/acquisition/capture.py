@@ -0,0 +1,211 @@
+import json
+import os
+import time
+import zlib
+import numpy as np
+from pysrs.aaaa.instruments.galvos import Galvo
+from pysrs.aaaa.acquisition.acquire import reduce_frame
+
+'''
+raw sample capture and replay
+
+a capture is a folder with capture.json (galvo parameters, AI channels), frames.jsonl (one line of metadata
+per frame, appended as the frame is written) and one frame_<n>.npy per raster holding the raw AI samples.
+samples are float32 by default, which holds the DAQ's voltages to well below one ADC code, int16 with a per
+frame, per channel scale is an opt in at half the size but is lossy. capture.json is written once when the
+capture starts and again with the whole frame list when it is closed, so per frame cost does not grow with
+the capture, and a capture cut short still has its frames.jsonl. ReplayBackend reads a capture back frame by
+frame with the same call as a live DAQ read, so reduction, display and saving run unchanged on recorded data.
+'''
+
+GALVO_KEYS = ['amp_x', 'amp_y', 'numsteps_x', 'numsteps_y', 'extrasteps_left', 'extrasteps_right',
+              'offset_x', 'offset_y', 'dwell', 'rate', 'device', 'ao_chans']
+FORMAT_VERSION = 2 # 2: frames.jsonl index, version 1 captures only have the frame list in capture.json
+INDEX_FILE = 'frames.jsonl'
+
+
+def waveform_checksum(galvo: Galvo) -> int:
+    # crc of the generated raster, so a replay can tell if Galvo would now generate something different
+    return zlib.crc32(np.ascontiguousarray(galvo.waveform, dtype=np.float64).tobytes())
+
+
+class CaptureWriter:
+    def __init__(self, path, galvo: Galvo, channels: list, encoding: str = 'float32', metadata: dict = None) -> None:
+        '''start a new raw capture
+
+        args:
+            path: capture folder, created if needed
+            galvo: galvo object the frames are taken with
+            channels: full AI channel names in the order of the raw rows
+            encoding: 'float32' (the raw stream) or 'int16' (scaled per frame, half the size, lossy)
+            metadata: anything else worth keeping, e.g. the gui config
+
+        returns: none
+        '''
+
+        if encoding not in ('int16', 'float32'):
+            raise ValueError("encoding must be 'int16' or 'float32'")
+        self.path = str(path)
+        os.makedirs(self.path, exist_ok=True)
+        self.header = {
+            'version': FORMAT_VERSION,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'galvo': {key: getattr(galvo, key) for key in GALVO_KEYS},
+            'waveform_crc32': waveform_checksum(galvo),
+            'total_samples': galvo.total_samples,
+            'channels': list(channels),
+            'encoding': encoding,
+            'metadata': metadata or {},
+            'frames': [],
+        }
+        self.t0 = time.perf_counter()
+        self.write_header()
+        self.index = open(os.path.join(self.path, INDEX_FILE), 'w')
+
+    def write_header(self) -> None:
+        tmp = os.path.join(self.path, 'capture.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, 'capture.json'))
+
+    def add_frame(self, raw: np.ndarray, **info) -> None:
+        '''store one raster worth of raw samples
+
+        args:
+            raw: (channels, total_samples) as returned by read_raster
+            info: per frame extras, e.g. delay_um=25000
+
+        returns: none
+        '''
+
+        raw = np.asarray(raw, dtype=np.float64).reshape(len(self.header['channels']), -1)
+        n = len(self.header['frames'])
+        entry = {'file': f'frame_{n:05d}.npy', 't_s': time.perf_counter() - self.t0, **info}
+        if self.header['encoding'] == 'int16':
+            scale = np.abs(raw).max(axis=1) / 32767
+            scale[scale == 0] = 1.0
+            data = np.round(raw / scale[:, None]).astype(np.int16)
+            entry['scale'] = scale.tolist()
+        else:
+            data = raw.astype(np.float32)
+        np.save(os.path.join(self.path, entry['file']), data)
+        self.header['frames'].append(entry)
+        self.index.write(json.dumps(entry) + '\n') # one line per frame, the full header waits for close()
+        self.index.flush()
+
+    def close(self) -> None:
+        if self.index.closed:
+            return
+        self.index.close()
+        self.header['duration_s'] = time.perf_counter() - self.t0
+        self.write_header()
+
+
+class Capture:
+    def __init__(self, path) -> None:
+        '''read access to a capture folder
+
+        args:
+            path: folder written by CaptureWriter
+
+        returns: none
+        '''
+
+        self.path = str(path)
+        with open(os.path.join(self.path, 'capture.json')) as f:
+            self.header = json.load(f)
+        self.channels = self.header['channels']
+        self.frames = self.header['frames']
+        index = os.path.join(self.path, INDEX_FILE)
+        if 'duration_s' not in self.header and os.path.exists(index):
+            # never closed (crash, killed), the frame list is only in the index
+            with open(index) as f:
+                self.frames = [json.loads(line) for line in f if line.endswith('\n')] # a torn last line is dropped
+
+    def __len__(self):
+        return len(self.frames)
+
+    def galvo(self) -> Galvo:
+        '''rebuild the galvo the capture was taken with, warns if the raster generator changed since
+
+        args: none
+
+        returns: Galvo
+        '''
+
+        galvo = Galvo(dict(self.header['galvo']))
+        if waveform_checksum(galvo) != self.header['waveform_crc32']:
+            print('[WARN] Galvo.gen_raster output differs from the captured waveform, the replay may not match.')
+        return galvo
+
+    def frame(self, index: int) -> np.ndarray:
+        entry = self.frames[index]
+        data = np.load(os.path.join(self.path, entry['file']))
+        if 'scale' in entry:
+            return data * np.asarray(entry['scale'])[:, None]
+        return data.astype(np.float64)
+
+
+class ReplayBackend:
+    def __init__(self, capture: Capture, realtime: bool = True, loop: bool = False) -> None:
+        '''stands in for the DAQ, read_raster has the same signature as acquire.read_raster
+
+        args:
+            capture: Capture to play back
+            realtime: pace frames at the captured raster duration, False plays as fast as the pipeline allows
+            loop: start over at the end instead of raising
+
+        returns: none
+        '''
+
+        self.capture = capture
+        self.realtime = realtime
+        self.loop = loop
+        self.index = 0
+        self.next_time = None
+
+    def read_raster(self, channels=None, galvo=None, start_trigger=None, on_armed=None) -> np.ndarray:
+        if self.index >= len(self.capture):
+            if not self.loop:
+                raise StopIteration('End of capture.')
+            self.index = 0
+        if on_armed is not None:
+            on_armed()
+        raw = self.capture.frame(self.index)
+        self.index += 1
+        if self.realtime:
+            g = self.capture.header['galvo']
+            duration = self.capture.header['total_samples'] / g['rate']
+            now = time.perf_counter()
+            self.next_time = now + duration if self.next_time is None else max(self.next_time + duration, now)
+            time.sleep(max(0.0, self.next_time - now))
+        return raw
+
+
+def replay(path, on_frame=None, realtime: bool = False, demod: dict = None) -> dict:
+    '''run a capture through the normal reduction, e.g. to profile or regression test the pipeline
+
+    args:
+        path: capture folder
+        on_frame: optional callable(index, images, frame info) for display, saving or comparisons
+        realtime: pace at the captured frame rate
+        demod: software lock-in settings passed to reduce_frame
+
+    returns: dict with frames, total_s, reduce_s (time spent in reduce_frame) and fps
+    '''
+
+    capture = Capture(path)
+    galvo = capture.galvo()
+    backend = ReplayBackend(capture, realtime=realtime)
+    reduce_s = 0.0
+    tic = time.perf_counter()
+    for i in range(len(capture)):
+        raw = backend.read_raster()
+        t = time.perf_counter()
+        images = reduce_frame(raw, galvo, len(capture.channels), demod)
+        reduce_s += time.perf_counter() - t
+        if on_frame is not None:
+            on_frame(i, images, capture.frames[i])
+    total_s = time.perf_counter() - tic
+    return {'frames': len(capture), 'total_s': total_s, 'reduce_s': reduce_s,
+            'fps': len(capture) / total_s if total_s else float('inf')}
@@ -0,0 +1,481 @@
+import collections
+import itertools
+import os
+import queue
+import threading
+import time
+import numpy as np
+from pysrs.aaaa.instruments.galvos import Galvo
+from pysrs.aaaa.acquisition.acquire import read_raster, reduce_frame
+from pysrs.aaaa.acquisition.capture import Capture, CaptureWriter, ReplayBackend
+from pysrs.aaaa.acquisition.multidev import SimulatedMultiDaq, full_channel_names
+from pysrs.mains.config_model import ConfigModel, WAVEFORM_KEYS
+from pysrs.mains import mask_io
+from pysrs.mains.simulate import generate_frame
+
+'''
+headless acquisition engine
+
+an AcquisitionRequest says what to take (config, number of frames or a list of delay positions, which backend)
+and the engine runs it on its own worker thread, one job at a time, with no tk anywhere. every job keeps an
+append only list of events (state, progress, frame) that listeners get as they happen and that can be read back
+from any point, which is what the localhost api (api.py) streams. the gui, scripts and notebooks are all just
+clients: build a request, submit it, listen or wait.
+
+backends share one small interface, open(request) / frame(delay_um) / close():
+    'sim'     simulated frames, no hardware
+    'daq'     read_raster + reduce_frame on the NI card(s), optionally capturing the raw samples
+    'sim-daq' the 'daq' path on simulated cards (multidev.SimulatedMultiDaq), sharding and merge included
+    'replay'  a raw capture played back through the same reduction
+'''
+
+BACKENDS = ['sim', 'daq', 'sim-daq', 'replay']
+JOB_STATES = ['queued', 'running', 'done', 'cancelled', 'error']
+CACHE_SIZE = 8 # waveforms and compiled masks kept, enough for a queue that alternates a few scan settings
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def cached(key, make):
+    # small lru shared by every job, so a scheduler can build the next job's waveform or TTL ahead of time
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    value = make() # built outside the lock, two threads racing for the same key just both build it
+    with _cache_lock:
+        _cache[key] = value
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return value
+
+
+def waveform_key(config) -> tuple:
+    return tuple((k, repr(config.get(k))) for k in sorted(WAVEFORM_KEYS))
+
+
+def galvo_for(config) -> Galvo:
+    '''Galvo for a config, generated once per distinct scan
+
+    args:
+        config: acquisition config
+
+    returns: Galvo, shared between jobs so treat it as read only
+    '''
+
+    return cached(('galvo', waveform_key(config)), lambda: Galvo(dict(config)))
+
+
+def ttl_for(mask_path: str, galvo: Galvo) -> np.ndarray:
+    '''compiled TTL of a mask file for a galvo, rebuilt if the file changes
+
+    args:
+        mask_path: .rmask (compiled straight from the runs) or any image PIL reads
+        galvo: Galvo the mask plays on
+
+    returns: bool array of total_samples
+    '''
+
+    def compile_mask():
+        if mask_path.endswith(mask_io.EXTENSION):
+            return mask_io.load_mask(mask_path).ttl(galvo)
+        from PIL import Image
+        mask = Image.open(mask_path).convert('L').resize((galvo.numsteps_x, galvo.numsteps_y), 0)
+        return galvo.ttl_waveform(np.array(mask))
+    key = ('ttl', mask_path, os.path.getmtime(mask_path), waveform_key(galvo.__dict__))
+    return cached(key, compile_mask)
+
+
+class AcquisitionRequest:
+    def __init__(self, config: dict = None, frames: int = 1, delays_um: list = None, delay_um: float = None,
+                 backend: str = 'sim', replay_path: str = None, realtime: bool = False, capture_path: str = None,
+                 mask_path: str = None, ttl_line: str = None, keep_frames: bool = True, label: str = '') -> None:
+        '''one acquisition, everything the engine needs and nothing from a gui
+
+        args:
+            config: acquisition config, same keys as the gui config (validated by ConfigModel). unused for replays
+            frames: number of frames at a fixed delay, ignored when delays_um is given. for replays the number of
+                captured frames to play, 0 for all of them
+            delays_um: delay stage positions for a hyperspectral run, one frame each
+            delay_um: fixed delay for plain frames, passed to the simulator and the capture metadata
+            backend: one of BACKENDS
+            replay_path: capture folder for the 'replay' backend
+            realtime: pace replays at the captured frame rate
+            capture_path: folder to capture raw samples to ('daq' only)
+            mask_path: rpoc mask played as a TTL with every frame ('daq' only)
+            ttl_line: full DO line for the mask TTL, e.g. 'Dev1/port0/line4'
+            keep_frames: keep every frame on the job, needed to fetch frames afterwards (e.g. over the api)
+            label: free text shown in job listings
+
+        returns: none
+        '''
+
+        self.config = dict(config or {})
+        self.frames = int(frames)
+        self.delays_um = None if delays_um is None else [float(d) for d in delays_um]
+        self.delay_um = None if delay_um is None else float(delay_um)
+        self.backend = backend
+        self.replay_path = replay_path
+        self.realtime = bool(realtime)
+        self.capture_path = capture_path
+        self.mask_path = mask_path
+        self.ttl_line = ttl_line
+        self.keep_frames = bool(keep_frames)
+        self.label = label
+
+    def __repr__(self):
+        return f'AcquisitionRequest({self.to_dict()})'
+
+    def validate(self) -> None:
+        # raises ValueError before anything is armed
+        if self.backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {self.backend}, expected one of {BACKENDS}.')
+        if self.backend == 'replay':
+            if not self.replay_path:
+                raise ValueError('A replay needs replay_path.')
+        else:
+            self.config = dict(ConfigModel(self.config).snapshot()) # raises ConfigError (a ValueError)
+        if self.mask_path and not self.ttl_line:
+            raise ValueError('A mask needs ttl_line.')
+        if self.delays_um is not None and not self.delays_um:
+            raise ValueError('delays_um is empty.')
+        if self.delays_um is None and self.frames < (0 if self.backend == 'replay' else 1):
+            raise ValueError('Need at least 1 frame.')
+
+    def positions(self) -> list:
+        # delay of every frame, None where the delay is not set
+        if self.delays_um is not None:
+            return list(self.delays_um)
+        return [self.delay_um] * self.frames
+
+    def to_dict(self) -> dict:
+        return {
+            'config': {k: list(v) if isinstance(v, tuple) else v for k, v in self.config.items()},
+            'frames': self.frames,
+            'delays_um': self.delays_um,
+            'delay_um': self.delay_um,
+            'backend': self.backend,
+            'replay_path': self.replay_path,
+            'realtime': self.realtime,
+            'capture_path': self.capture_path,
+            'mask_path': self.mask_path,
+            'ttl_line': self.ttl_line,
+            'keep_frames': self.keep_frames,
+            'label': self.label,
+        }
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'AcquisitionRequest':
+        unknown = set(values) - set(cls().to_dict())
+        if unknown:
+            raise ValueError(f'Unknown request fields: {sorted(unknown)}')
+        return cls(**values)
+
+
+class SimulatedBackend:
+    def __init__(self, seed: int = None) -> None:
+        self.seed = seed
+
+    def open(self, request: AcquisitionRequest) -> None:
+        self.config = request.config
+        self.numchans = len(request.config['ai_chans'])
+
+    def frame(self, delay_um: float = None) -> list:
+        return generate_frame(self.numchans, config=self.config, delay_um=delay_um, seed=self.seed)
+
+    def close(self) -> None:
+        pass
+
+
+class DaqBackend:
+    def __init__(self, daq=None) -> None:
+        self.daq = daq # anything with a read_raster, None for the real cards
+        self.capture = None # set by open(), close() has to work even if open() failed before it got there
+
+    def open(self, request: AcquisitionRequest) -> None:
+        config = request.config
+        self.channels = full_channel_names(config)
+        self.galvo = galvo_for(config)
+        self.ttl = ttl_for(request.mask_path, self.galvo) if request.mask_path else None
+        self.ttl_line = request.ttl_line
+        self.demod = config.get('demod')
+        self.capture = None
+        if request.capture_path:
+            self.capture = CaptureWriter(request.capture_path, self.galvo, self.channels,
+                                         metadata={'config': request.to_dict()['config']})
+
+    def frame(self, delay_um: float = None) -> list:
+        if isinstance(self.daq, SimulatedMultiDaq):
+            self.daq.delay_um = delay_um
+        read = read_raster if self.daq is None else self.daq.read_raster
+        raw = read(self.channels, self.galvo, ttl=self.ttl, ttl_line=self.ttl_line)
+        if self.capture is not None:
+            self.capture.add_frame(raw, delay_um=delay_um)
+        return reduce_frame(raw, self.galvo, len(self.channels), self.demod)
+
+    def close(self) -> None:
+        if self.capture is not None:
+            self.capture.close()
+
+
+class ReplayFrames:
+    # the capture module's ReplayBackend stands in for read_raster, this adds the reduction on top
+    def open(self, request: AcquisitionRequest) -> None:
+        capture = Capture(request.replay_path)
+        self.galvo = capture.galvo()
+        self.numchans = len(capture.channels)
+        self.demod = capture.header['metadata'].get('config', {}).get('demod')
+        self.backend = ReplayBackend(capture, realtime=request.realtime)
+        request.config = dict(capture.header['metadata'].get('config', {}))
+        # frames are played in capture order at the delays they were taken at
+        n = len(capture) if request.frames == 0 else min(request.frames, len(capture))
+        request.delays_um = [f.get('delay_um') for f in capture.frames[:n]]
+
+    def frame(self, delay_um: float = None) -> list:
+        return reduce_frame(self.backend.read_raster(), self.galvo, self.numchans, self.demod)
+
+    def close(self) -> None:
+        pass
+
+
+def make_backend(name: str, seed: int = None):
+    if name == 'sim':
+        return SimulatedBackend(seed)
+    if name == 'daq':
+        return DaqBackend()
+    if name == 'sim-daq':
+        return DaqBackend(SimulatedMultiDaq(seed))
+    if name == 'replay':
+        return ReplayFrames()
+    raise ValueError(f'Unknown backend {name}, expected one of {BACKENDS}.')
+
+
+class Job:
+    _ids = itertools.count(1)
+
+    def __init__(self, request: AcquisitionRequest, before_frame=None) -> None:
+        '''one submitted request and everything that happened to it
+
+        args:
+            request: what to acquire
+            before_frame: optional in process callable(index, delay_um) run before each frame, e.g. autofocus
+
+        returns: none
+        '''
+
+        # events are plain json friendly dicts, the frame arrays only go to in process listeners and self.frames
+
+        self.id = next(Job._ids)
+        self.request = request
+        self.before_frame = before_frame
+        self.state = 'queued'
+        self.done = 0
+        self.total = len(request.positions())
+        self.frames = [] # (channels, ny, nx) arrays when request.keep_frames
+        self.error = None
+        self.t_submit = time.time()
+        self.t_start = None
+        self.t_end = None
+        self.events = []
+        self.listeners = []
+        self._cancel = threading.Event()
+        self._changed = threading.Condition()
+
+    def emit(self, kind: str, data=None, **info) -> None:
+        with self._changed:
+            event = {'seq': len(self.events), 'job': self.id, 'type': kind, 't': time.time(), **info}
+            self.events.append(event)
+            self._changed.notify_all()
+        for listener in list(self.listeners):
+            try:
+                listener(event, data)
+            except Exception as e: # a broken client must never stop the acquisition
+                print(f'[WARN] Job {self.id} listener failed: {e}')
+
+    def set_state(self, state: str, **info) -> None:
+        self.state = state
+        self.emit('state', state=state, **info)
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ('done', 'cancelled', 'error')
+
+    def events_since(self, seq: int = 0, timeout: float = None) -> list:
+        '''events from seq on, waits up to timeout for new ones if there are none yet
+
+        args:
+            seq: first event number wanted
+            timeout: seconds to wait, None waits until there is something or the job is finished
+
+        returns: list of event dicts, empty if the job finished or the wait timed out
+        '''
+
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.events) > seq or self.finished, timeout)
+            return self.events[seq:]
+
+    def wait(self, timeout: float = None) -> bool:
+        with self._changed:
+            return self._changed.wait_for(lambda: self.finished, timeout)
+
+    def summary(self) -> dict:
+        return {
+            'job': self.id,
+            'label': self.request.label,
+            'backend': self.request.backend,
+            'state': self.state,
+            'done': self.done,
+            'total': self.total,
+            'error': self.error,
+            'events': len(self.events),
+            'submitted': self.t_submit,
+            'elapsed_s': None if self.t_start is None else (self.t_end or time.time()) - self.t_start,
+        }
+
+
+class AcquisitionEngine:
+    def __init__(self, stage=None, seed: int = None, history: int = 50) -> None:
+        '''runs requests one after another on a worker thread
+
+        args:
+            stage: delay stage with move_async(um) -> future and move_timeout(um) (e.g. ZaberStage), None never moves one
+            seed: noise seed for the simulated backend
+            history: finished jobs kept for status queries, oldest are dropped first
+
+        returns: none
+        '''
+
+        self.stage = stage
+        self.seed = seed
+        self.history = history
+        self.jobs = {}
+        self.current = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, request: AcquisitionRequest, listener=None, before_frame=None) -> Job:
+        '''queue a request, returns straight away
+
+        args:
+            request: AcquisitionRequest, validated here so bad requests fail in the caller
+            listener: optional callable(event, data) for every event, called on the engine thread. data is the
+                (channels, ny, nx) array for 'frame' events and None otherwise
+            before_frame: optional callable(index, delay_um) run before each frame
+
+        returns: Job
+        '''
+
+        request.validate()
+        job = Job(request, before_frame)
+        if listener is not None:
+            job.listeners.append(listener)
+        with self._lock:
+            self.jobs[job.id] = job
+            finished = [j for j in self.jobs.values() if j.finished]
+            for old in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[old.id]
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work, name='acquisition-engine', daemon=True)
+                self._worker.start()
+        job.set_state('queued')
+        self._queue.put(job)
+        return job
+
+    def run(self, request: AcquisitionRequest, listener=None, before_frame=None) -> Job:
+        # blocking submit for scripts and notebooks, raises what the acquisition raised
+        job = self.submit(request, listener, before_frame)
+        job.wait()
+        if job.state == 'error':
+            raise RuntimeError(f'Job {job.id} failed: {job.error}')
+        return job
+
+    def cancel(self, job_id: int = None) -> None:
+        # cancel one job, or the running one and everything queued
+        with self._lock:
+            jobs = [self.jobs[job_id]] if job_id is not None else list(self.jobs.values())
+        for job in jobs:
+            job.cancel()
+
+    def status(self) -> dict:
+        with self._lock:
+            jobs = [job.summary() for job in self.jobs.values()]
+        return {'current': None if self.current is None else self.current.id, 'jobs': jobs}
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job.cancelled:
+                job.set_state('cancelled')
+                continue
+            self.current = job
+            try:
+                self.execute(job)
+            except Exception as e:
+                # execute records acquisition errors on the job, this is for anything else (backend, listeners),
+                # the worker has to survive it or every later job would stay queued forever
+                print(f'[WARN] Acquisition engine job {job.id} failed outside the acquisition: {e}')
+                if not job.finished:
+                    job.error = f'{type(e).__name__}: {e}'
+                    job.t_end = time.time()
+                    job.set_state('error', error=job.error)
+            finally:
+                self.current = None
+
+    def execute(self, job: Job) -> None:
+        '''run one job on the calling thread, delay moves overlap the frame before them
+
+        args:
+            job: Job from submit
+
+        returns: none, the outcome is in job.state and the events
+        '''
+
+        request = job.request
+        backend = make_backend(request.backend, self.seed)
+        job.t_start = time.time()
+        job.set_state('running')
+        try:
+            backend.open(request)
+            positions = request.positions()
+            job.total = len(positions)
+            move_stage = self.stage is not None and request.delays_um is not None and request.backend != 'replay'
+            move = self.stage.move_async(positions[0]) if move_stage else None
+            for i, delay in enumerate(positions):
+                if job.cancelled:
+                    break
+                if job.before_frame is not None:
+                    job.before_frame(i, delay)
+                if move is not None:
+                    move.result(timeout=self.stage.move_timeout(delay))
+                images = backend.frame(delay)
+                if move_stage and i + 1 < len(positions):
+                    move = self.stage.move_async(positions[i + 1]) # next step moves while this frame is handed out
+                frame = np.stack(images)
+                if request.keep_frames:
+                    job.frames.append(frame)
+                job.done = i + 1
+                job.emit('frame', frame, index=i, delay_um=delay, shape=list(frame.shape))
+                job.emit('progress', done=job.done, total=job.total)
+        except StopIteration: # a replay ran out of frames
+            pass
+        except Exception as e:
+            job.error = f'{type(e).__name__}: {e}'
+            job.t_end = time.time()
+            job.set_state('error', error=job.error)
+            return
+        finally:
+            try:
+                backend.close()
+            except Exception as e:
+                print(f'[WARN] Could not close the {request.backend} backend of job {job.id}: {e}')
+        job.t_end = time.time()
+        job.set_state('cancelled' if job.cancelled else 'done')
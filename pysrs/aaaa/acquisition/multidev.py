@@ -0,0 +1,211 @@
+import concurrent.futures
+import threading
+import time
+import numpy as np
+from pysrs.aaaa.instruments.galvos import Galvo
+from pysrs.aaaa.acquisition.acquire import read_raster
+
+'''
+rasters read across several NI DAQ cards
+
+one card's AI is a multiplexed converter, so every extra channel on it divides the per channel sample rate and
+eventually the pixel rate. here the AI channels are sharded by card (a channel is 'ai1' on the galvo card or a
+full 'Dev2/ai0' anywhere else): the galvo card's AO task is the master, every card's AI task samples on the
+master's ao/SampleClock and arms on its ao/StartTrigger, so all cards take sample n at the same clock edge. each
+card is read on its own thread and the shards are put back in the configured channel order, the result is the
+same (channels, total_samples) array read_raster gives for one card.
+
+the clock and trigger reach the other cards through the RTSI cable or the PXI backplane, which DAQmx routes by
+itself from the master's terminal names. cards wired with plain PFI cables pass routes instead.
+'''
+
+DEFAULT_MAX_AI_RATE = 1.25e6 # aggregate multiplexed AI rate of an X series card, per card
+
+
+def full_channel_names(config) -> list:
+    # ai_chans entries without a device are on the galvo card
+    return [ch if '/' in ch else f"{config['device']}/{ch}" for ch in config['ai_chans']]
+
+
+def shard_channels(channels: list) -> dict:
+    '''group full channel names by card, keeping where each one goes in the merged frame
+
+    args:
+        channels: full AI channel names, e.g. ['Dev1/ai1', 'Dev2/ai0', 'Dev1/ai2']
+
+    returns: dict of device -> list of (merged row, channel name), devices in first appearance order
+    '''
+
+    shards = {}
+    for row, chan in enumerate(channels):
+        device = chan.strip('/').split('/')[0]
+        shards.setdefault(device, []).append((row, chan))
+    return shards
+
+
+def check_rates(shards: dict, rate: float, max_rates: dict = None) -> None:
+    '''raise before arming if a card would have to convert faster than it can
+
+    args:
+        shards: from shard_channels
+        rate: pixel sample rate (galvo.rate)
+        max_rates: device -> aggregate AI rate, DEFAULT_MAX_AI_RATE for devices not listed
+
+    returns: none
+    '''
+
+    for device, chans in shards.items():
+        limit = (max_rates or {}).get(device, DEFAULT_MAX_AI_RATE)
+        if len(chans) * rate > limit:
+            raise ValueError(f'{device} would need {len(chans) * rate / 1e6:.2f} MS/s for {len(chans)} channels at '
+                             f'{rate:g} Hz, it does {limit / 1e6:.2f} MS/s. Move channels to another card.')
+
+
+def read_raster_multi(channels: list, galvo: Galvo, start_trigger: str = None, on_armed=None,
+                      ttl: np.ndarray = None, ttl_line: str = None, routes: dict = None,
+                      max_rates: dict = None) -> np.ndarray:
+    '''read_raster across any number of cards, same arguments and result
+
+    args:
+        channels: full AI channel names on any cards, the galvo card is the master
+        galvo, start_trigger, on_armed, ttl, ttl_line: see acquire.read_raster
+        routes: device -> (clock terminal, trigger terminal) on that device for cards cabled by PFI, e.g.
+            {'Dev2': ('/Dev2/PFI0', '/Dev2/PFI1')} with the master exporting on the terminals named under 'export'
+            ({'export': ('/Dev1/PFI12', '/Dev1/PFI13')}). None routes over RTSI / PXI
+        max_rates: device -> aggregate AI rate for check_rates, DEFAULT_MAX_AI_RATE for devices not listed
+
+    returns: raw samples, shape (len(channels), galvo.total_samples)
+    '''
+
+    shards = shard_channels(channels)
+    if set(shards) <= {galvo.device}:
+        return read_raster(channels, galvo, start_trigger, on_armed, ttl, ttl_line) # one card, nothing to sync
+    check_rates(shards, galvo.rate, max_rates) # before any task exists, an overloaded card fails here and not mid frame
+
+    import nidaqmx # only needed on the rig
+    from nidaqmx.constants import AcquisitionType
+    routes = routes or {}
+    master_clock = f'/{galvo.device}/ao/SampleClock'
+    master_trigger = f'/{galvo.device}/ao/StartTrigger'
+    total = galvo.total_samples
+    timeout = total / galvo.rate + 5 + (30 if start_trigger else 0)
+
+    tasks = []
+    try:
+        ao_task = nidaqmx.Task()
+        tasks.append(ao_task)
+        for chan in galvo.ao_chans:
+            ao_task.ao_channels.add_ao_voltage_chan(f'{galvo.device}/{chan}')
+        ao_task.timing.cfg_samp_clk_timing(rate=galvo.rate, sample_mode=AcquisitionType.FINITE, samps_per_chan=total)
+        if start_trigger:
+            ao_task.triggers.start_trigger.cfg_dig_edge_start_trig(start_trigger)
+        if 'export' in routes:
+            ao_task.export_signals.samp_clk_output_term = routes['export'][0]
+            ao_task.export_signals.start_trig_output_term = routes['export'][1]
+
+        ai_tasks = {}
+        for device, chans in shards.items():
+            task = nidaqmx.Task()
+            tasks.append(task)
+            for _, chan in chans:
+                task.ai_channels.add_ai_voltage_chan(chan)
+            clock, trigger = routes.get(device, (master_clock, master_trigger))
+            task.timing.cfg_samp_clk_timing(rate=galvo.rate, source=clock,
+                                            sample_mode=AcquisitionType.FINITE, samps_per_chan=total)
+            if device != galvo.device:
+                task.triggers.start_trigger.cfg_dig_edge_start_trig(trigger)
+            ai_tasks[device] = task
+
+        do_task = None
+        if ttl is not None and ttl_line is not None:
+            do_task = nidaqmx.Task()
+            tasks.append(do_task)
+            do_task.do_channels.add_do_chan(ttl_line)
+            do_task.timing.cfg_samp_clk_timing(rate=galvo.rate, source=master_clock,
+                                               sample_mode=AcquisitionType.FINITE, samps_per_chan=total)
+            do_task.write(ttl, auto_start=False)
+
+        ao_task.write(galvo.waveform, auto_start=False)
+        for task in ai_tasks.values():
+            task.start() # every AI waits on the master clock, so they are all armed before the AO starts it
+        if do_task is not None:
+            do_task.start()
+        ao_task.start()
+        if on_armed is not None:
+            on_armed()
+
+        def read(device):
+            task = ai_tasks[device]
+            data = task.read(number_of_samples_per_channel=total, timeout=timeout)
+            return np.array(data).reshape(len(shards[device]), -1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ai_tasks)) as pool:
+            parts = dict(zip(ai_tasks, pool.map(read, ai_tasks)))
+        ao_task.wait_until_done(timeout=timeout)
+        if do_task is not None:
+            do_task.wait_until_done(timeout=timeout)
+    finally:
+        for task in tasks:
+            task.close()
+    return merge_shards(parts, shards, total)
+
+
+def merge_shards(parts: dict, shards: dict, total: int) -> np.ndarray:
+    # per card blocks back into the configured channel order
+    out = np.empty((sum(len(c) for c in shards.values()), total))
+    for device, chans in shards.items():
+        out[[row for row, _ in chans]] = parts[device]
+    return out
+
+
+class SimulatedMultiDaq:
+    def __init__(self, seed: int = None, max_rates: dict = None, realtime: bool = True) -> None:
+        '''read_raster_multi without hardware, for testing the sharding and merge off the rig
+
+        every card gets its own thread that renders its channels from the simulator as raw raster samples (every
+        pixel held for pixel_samples samples, padding included) and, in realtime, takes one raster period like
+        a real finite read. cards run in parallel, so the frame time does not grow with the card count, and a
+        card asked to convert faster than its max rate fails like DAQmx would.
+
+        args:
+            seed: simulator noise seed
+            max_rates: device -> aggregate AI rate, see check_rates
+            realtime: sleep for the raster duration per read
+
+        returns: none
+        '''
+
+        self.seed = seed
+        self.max_rates = max_rates
+        self.realtime = realtime
+        self.delay_um = None # simulated delay stage position, set by whoever moves it
+        self.reads = {} # device -> thread name of the last read, to check the reads really ran in parallel
+
+    def read_raster(self, channels: list, galvo: Galvo, start_trigger: str = None, on_armed=None,
+                    ttl: np.ndarray = None, ttl_line: str = None) -> np.ndarray:
+        from pysrs.mains.simulate import generate_frame
+        shards = shard_channels(channels)
+        check_rates(shards, galvo.rate, self.max_rates)
+        config = {'numsteps_x': galvo.numsteps_x, 'numsteps_y': galvo.numsteps_y}
+        images = generate_frame(len(channels), config=config, delay_um=self.delay_um, seed=self.seed)
+        if on_armed is not None:
+            on_armed()
+        t_end = time.perf_counter() + galvo.total_samples / galvo.rate
+
+        def read(device):
+            self.reads[device] = threading.current_thread().name
+            rows = [images[row] for row, _ in shards[device]]
+            raw = np.stack([raster_samples(image, galvo) for image in rows])
+            if self.realtime:
+                time.sleep(max(0.0, t_end - time.perf_counter()))
+            return raw
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix='daq') as pool:
+            parts = dict(zip(shards, pool.map(read, shards)))
+        return merge_shards(parts, shards, galvo.total_samples)
+
+
+def raster_samples(image: np.ndarray, galvo: Galvo) -> np.ndarray:
+    # inverse of reduce_frame for one channel: pad to the raster, hold every pixel for pixel_samples
+    full = np.zeros((galvo.total_y, galvo.total_x), dtype=np.float64)
+    left = galvo.extrasteps_left
+    full[:, left:left + galvo.numsteps_x] = image
+    return np.repeat(full.ravel(), galvo.pixel_samples)
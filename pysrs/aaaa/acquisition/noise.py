@@ -0,0 +1,229 @@
+import numpy as np
+
+'''
+streaming noise analysis for detector and lock-in channels
+
+welch psd, allan deviation and band limited rms are all accumulated chunk by chunk with constant memory,
+so a multi-hour record never has to be held. the psd tells you where the noise is (1/f knee, pickup lines),
+the allan deviation tells you how long averaging keeps helping, which is what dwell time and oversampling
+should be picked from.
+'''
+
+
+class StreamingWelch:
+    def __init__(self, rate: float, channels: int = 1, nperseg: int = 4096) -> None:
+        '''averaged periodogram over 50% overlapping hann windowed segments
+
+        args:
+            rate: sample rate in Hz
+            channels: number of channels updated together
+            nperseg: segment length, sets the frequency resolution rate / nperseg
+
+        returns: none
+        '''
+
+        self.rate = rate
+        self.nperseg = nperseg
+        self.step = nperseg // 2
+        self.window = np.hanning(nperseg)
+        self.scale = 1.0 / (rate * (self.window**2).sum())
+        self.power = np.zeros((channels, nperseg // 2 + 1))
+        self.segments = 0
+        self.carry = np.empty((channels, 0))
+
+    def update(self, block: np.ndarray) -> None:
+        x = np.concatenate([self.carry, block], axis=1) if self.carry.shape[1] else block
+        count = (x.shape[1] - self.nperseg) // self.step + 1 if x.shape[1] >= self.nperseg else 0
+        if count:
+            # every whole segment in the chunk goes through one batched fft
+            idx = np.arange(count)[:, None] * self.step + np.arange(self.nperseg)[None, :]
+            segs = x[:, idx]
+            segs = segs - segs.mean(axis=2, keepdims=True)
+            self.power += (np.abs(np.fft.rfft(segs * self.window, axis=2))**2).sum(axis=1)
+            self.segments += count
+        self.carry = x[:, count * self.step:]
+
+    def psd(self):
+        '''one sided power spectral density so far
+
+        args: none
+
+        returns: (frequencies in Hz, psd of shape (channels, freqs) in V^2/Hz)
+        '''
+
+        freqs = np.fft.rfftfreq(self.nperseg, 1 / self.rate)
+        psd = self.power * self.scale / max(self.segments, 1)
+        psd[:, 1:-1] *= 2
+        return freqs, psd
+
+
+class StreamingAllan:
+    def __init__(self, rate: float, channels: int = 1, base: int = 1, octaves: int = 30) -> None:
+        '''octave spaced (tau = base * 2^k samples) non overlapping allan deviation with constant memory
+
+        args:
+            rate: sample rate in Hz
+            channels: number of channels
+            base: samples in the shortest averaging time
+            octaves: how many doublings of tau to track at most
+
+        returns: none
+        '''
+
+        self.rate = rate
+        self.base = base
+        self.carry = np.empty((channels, 0))
+        self.levels = [{'carry': np.empty((channels, 0)), 'last': None,
+                        'sum': np.zeros(channels), 'count': 0} for _ in range(octaves)]
+
+    def update(self, block: np.ndarray) -> None:
+        x = np.concatenate([self.carry, block], axis=1) if self.carry.shape[1] else block
+        full = x.shape[1] // self.base * self.base
+        self.carry = x[:, full:]
+        means = x[:, :full].reshape(x.shape[0], -1, self.base).mean(axis=2)
+        for level in self.levels:
+            if means.shape[1] == 0:
+                break
+            series = means if level['last'] is None else np.concatenate([level['last'], means], axis=1)
+            diffs = np.diff(series, axis=1)
+            level['sum'] += (diffs**2).sum(axis=1)
+            level['count'] += diffs.shape[1]
+            level['last'] = series[:, -1:]
+            # pairs of averages at this tau are the averages at twice the tau
+            pending = np.concatenate([level['carry'], means], axis=1)
+            pairs = pending.shape[1] // 2 * 2
+            level['carry'] = pending[:, pairs:]
+            means = pending[:, :pairs].reshape(pending.shape[0], -1, 2).mean(axis=2)
+
+    def deviation(self):
+        '''allan deviation at every tau that has at least one difference
+
+        args: none
+
+        returns: (taus in s, adev of shape (channels, taus))
+        '''
+
+        used = [k for k, level in enumerate(self.levels) if level['count'] > 0]
+        taus = np.array([self.base * 2**k / self.rate for k in used])
+        adev = np.array([np.sqrt(0.5 * self.levels[k]['sum'] / self.levels[k]['count']) for k in used]).T
+        return taus, adev
+
+
+def band_rms(freqs, psd, f_lo: float = 0.0, f_hi: float = None) -> np.ndarray:
+    # integrate the psd over [f_lo, f_hi], trapezoid rule
+    f_hi = freqs[-1] if f_hi is None else f_hi
+    band = (freqs >= f_lo) & (freqs <= f_hi)
+    if band.sum() < 2:
+        return np.zeros(psd.shape[0])
+    p, f = psd[:, band], freqs[band]
+    return np.sqrt((0.5 * (p[:, 1:] + p[:, :-1]) * np.diff(f)).sum(axis=1)) # trapz by hand, it moved in numpy 2
+
+
+class NoiseAnalyzer:
+    def __init__(self, rate: float, channels: list, nperseg: int = 4096, bands: list = None) -> None:
+        '''psd, allan deviation, mean and rms for a set of channels fed chunk by chunk
+
+        args:
+            rate: sample rate in Hz
+            channels: channel names, used as keys in the summary
+            nperseg: welch segment length
+            bands: list of (f_lo, f_hi) to report the rms in, defaults to the full band
+
+        returns: none
+        '''
+
+        self.rate = rate
+        self.channels = list(channels)
+        self.bands = bands or [(0, rate / 2)]
+        self.welch = StreamingWelch(rate, len(self.channels), nperseg)
+        self.allan = StreamingAllan(rate, len(self.channels))
+        self.samples = 0
+        self.total = np.zeros(len(self.channels))
+        self.total_sq = np.zeros(len(self.channels))
+
+    def update(self, block) -> None:
+        '''feed the next chunk
+
+        args:
+            block: (channels, n) samples, or (n,) for a single channel
+
+        returns: none
+        '''
+
+        block = np.asarray(block, dtype=float).reshape(len(self.channels), -1)
+        self.samples += block.shape[1]
+        self.total += block.sum(axis=1)
+        self.total_sq += (block**2).sum(axis=1)
+        self.welch.update(block)
+        self.allan.update(block)
+
+    def summary(self) -> dict:
+        '''summary metrics per channel
+
+        args: none
+
+        returns: dict of channel -> dict with mean, std, band rms values, white noise density (median psd
+                 over the upper half of the spectrum, in V/rtHz), and the minimum allan deviation with its tau
+        '''
+
+        n = max(self.samples, 1)
+        mean = self.total / n
+        std = np.sqrt(np.maximum(self.total_sq / n - mean**2, 0))
+        freqs, psd = self.welch.psd()
+        taus, adev = self.allan.deviation()
+        upper = freqs > freqs[-1] / 2
+        out = {}
+        for i, ch in enumerate(self.channels):
+            d = {'mean_V': float(mean[i]), 'std_V': float(std[i]), 'samples': self.samples, 'duration_s': self.samples / self.rate}
+            for lo, hi in self.bands:
+                d[f'rms_{lo:g}-{hi:g}Hz_V'] = float(band_rms(freqs, psd[i:i + 1], lo, hi)[0])
+            if self.welch.segments:
+                d['white_noise_V_rtHz'] = float(np.sqrt(np.median(psd[i, upper])))
+            if taus.size:
+                k = int(np.argmin(adev[i]))
+                d['allan_min_V'] = float(adev[i, k])
+                d['allan_min_tau_s'] = float(taus[k])
+            out[ch] = d
+        return out
+
+
+def analyze_channels(device: str, channels: list, rate: float, duration: float, chunk_s: float = 0.5,
+                     nperseg: int = 4096, bands: list = None, progress=None) -> NoiseAnalyzer:
+    '''stream AI channels straight into a NoiseAnalyzer, nothing but the current chunk is kept
+
+    args:
+        device: NIDAQ name, e.g. 'Dev1'
+        channels: AI channel names, e.g. ['ai1', 'ai0']
+        rate: sample rate in Hz
+        duration: seconds to analyze
+        chunk_s: seconds per read
+        nperseg, bands: see NoiseAnalyzer
+        progress: optional callable(analyzer) run after every chunk, e.g. to print a running summary
+
+    returns: the NoiseAnalyzer, call summary(), welch.psd() or allan.deviation() on it
+    '''
+
+    analyzer = NoiseAnalyzer(rate, [f'{device}/{ch}' for ch in channels], nperseg, bands)
+    chunk = max(1, int(chunk_s * rate))
+    total = int(duration * rate)
+    buffer = np.empty((len(channels), chunk))
+
+    import nidaqmx # only needed on the rig, the streaming estimators work offline without it
+    from nidaqmx.constants import AcquisitionType
+    from nidaqmx.stream_readers import AnalogMultiChannelReader
+    with nidaqmx.Task() as task:
+        for ch in channels:
+            task.ai_channels.add_ai_voltage_chan(f'{device}/{ch}')
+        task.timing.cfg_samp_clk_timing(rate=rate, sample_mode=AcquisitionType.CONTINUOUS,
+                                        samps_per_chan=max(chunk * 10, int(rate)))
+        reader = AnalogMultiChannelReader(task.in_stream)
+        task.start()
+        while analyzer.samples < total:
+            count = min(chunk, total - analyzer.samples)
+            data = buffer if count == chunk else np.empty((len(channels), count))
+            reader.read_many_sample(data, number_of_samples_per_channel=count, timeout=10 * chunk_s + 1)
+            analyzer.update(data)
+            if progress is not None:
+                progress(analyzer)
+        task.stop()
+    return analyzer
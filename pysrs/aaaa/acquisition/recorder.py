@@ -0,0 +1,182 @@
+import json
+import os
+import time
+import numpy as np
+
+'''
+streaming AI recorder for long multi-channel time series
+
+the DAQ is read in fixed chunks into one preallocated buffer and every chunk is appended straight to a raw
+float32 file (samples x channels) with a json header next to it, so memory stays flat however long it runs.
+an optional summary keeps min/mean/max per block of samples for plotting hours of data at a glance.
+'''
+
+HEADER_SUFFIX = '.json'
+SUMMARY_SUFFIX = '.summary.bin'
+
+
+class ChunkWriter:
+    def __init__(self, path, channels: list, rate: float, summary_factor: int = None, dtype=np.float32) -> None:
+        '''append-only raw file for chunked recordings, independent of where the samples come from
+
+        args:
+            path: raw data file, the header goes to path + '.json'
+            channels: channel names, sets the column count
+            rate: sample rate in Hz, stored in the header
+            summary_factor: samples per summary point, None for no summary
+            dtype: on disk sample type
+
+        returns: none
+        '''
+
+        self.path = str(path)
+        self.channels = list(channels)
+        self.dtype = np.dtype(dtype)
+        self.summary_factor = summary_factor
+        self.samples = 0
+        self.header = {'channels': self.channels, 'rate': rate, 'dtype': self.dtype.name, 'layout': 'samples x channels',
+                       'started': time.strftime('%Y-%m-%d %H:%M:%S'), 'summary_factor': summary_factor,
+                       'summary_fields': ['min', 'mean', 'max'], 'samples': 0, 'complete': False}
+        dirpath = os.path.dirname(self.path)
+        if dirpath:
+            os.makedirs(dirpath, exist_ok=True)
+        self.file = open(self.path, 'wb')
+        self.summary_file = open(self.path + SUMMARY_SUFFIX, 'wb') if summary_factor else None
+        self.carry = np.empty((len(self.channels), 0))
+        self.write_header()
+
+    def write_header(self) -> None:
+        self.header['samples'] = self.samples
+        tmp = self.path + HEADER_SUFFIX + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f, indent=2)
+        os.replace(tmp, self.path + HEADER_SUFFIX)
+
+    def write(self, block: np.ndarray) -> None:
+        '''append one chunk
+
+        args:
+            block: (channels, n) samples
+
+        returns: none
+        '''
+
+        block = np.asarray(block).reshape(len(self.channels), -1)
+        self.file.write(np.ascontiguousarray(block.T, dtype=self.dtype).tobytes())
+        self.samples += block.shape[1]
+        if self.summary_file is not None:
+            if self.carry.shape[1]:
+                block = np.concatenate([self.carry, block], axis=1)
+            full = block.shape[1] // self.summary_factor * self.summary_factor
+            if full:
+                bins = block[:, :full].reshape(len(self.channels), -1, self.summary_factor)
+                summary = np.stack([bins.min(axis=2), bins.mean(axis=2), bins.max(axis=2)], axis=2) # channels, n, 3
+                self.summary_file.write(np.ascontiguousarray(summary.transpose(1, 0, 2), dtype=np.float32).tobytes())
+            self.carry = block[:, full:].copy()
+
+    def flush(self) -> None:
+        # called every few chunks so a crash loses seconds, not the run
+        self.file.flush()
+        if self.summary_file is not None:
+            self.summary_file.flush()
+        self.write_header()
+
+    def close(self) -> None:
+        self.header['complete'] = True
+        self.header['stopped'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.file.close()
+        if self.summary_file is not None:
+            self.summary_file.close()
+        self.write_header()
+
+
+def record_stream(device: str, channels: list, rate: float, duration: float, path, chunk_s: float = 0.1,
+                  summary_factor: int = None, flush_every: int = 50, progress=None, stop=None) -> str:
+    '''record AI channels continuously to disk
+
+    args:
+        device: NIDAQ name, e.g. 'Dev1'
+        channels: AI channel names, e.g. ['ai0', 'ai1']
+        rate: sample rate in Hz
+        duration: seconds to record, None to run until stop() returns True
+        path: raw output file
+        chunk_s: seconds per read, the DAQ buffer is sized to hold many of these
+        summary_factor: samples per min/mean/max summary point, None for no summary
+        flush_every: chunks between flushes of the file and header
+        progress: optional callable(samples written)
+        stop: optional callable returning True to end the recording early
+
+    returns: path
+    '''
+
+    import nidaqmx # only needed on the rig, load_recording and load_summary work offline without it
+    from nidaqmx.constants import AcquisitionType
+    from nidaqmx.stream_readers import AnalogMultiChannelReader
+    chunk = max(1, int(chunk_s * rate))
+    total = None if duration is None else int(duration * rate)
+    writer = ChunkWriter(path, [f'{device}/{ch}' for ch in channels], rate, summary_factor)
+    buffer = np.empty((len(channels), chunk)) # reused for every read, no per chunk allocation
+
+    try:
+        with nidaqmx.Task() as task:
+            for ch in channels:
+                task.ai_channels.add_ai_voltage_chan(f'{device}/{ch}')
+            task.timing.cfg_samp_clk_timing(rate=rate, sample_mode=AcquisitionType.CONTINUOUS,
+                                            samps_per_chan=max(chunk * 20, int(rate))) # host buffer of >= 1 s
+            reader = AnalogMultiChannelReader(task.in_stream)
+            task.start()
+            n = 0
+            while total is None or writer.samples < total:
+                if stop is not None and stop():
+                    break
+                count = chunk if total is None else min(chunk, total - writer.samples)
+                data = buffer if count == chunk else np.empty((len(channels), count)) # only the last read is short
+                reader.read_many_sample(data, number_of_samples_per_channel=count, timeout=10 * chunk_s + 1)
+                writer.write(data)
+                n += 1
+                if n % flush_every == 0:
+                    writer.flush()
+                if progress is not None:
+                    progress(writer.samples)
+            task.stop()
+    finally:
+        writer.close()
+    return writer.path
+
+
+def load_recording(path):
+    '''open a recording without reading it into memory
+
+    args:
+        path: raw data file written by ChunkWriter
+
+    returns: (memmap of shape (samples, channels), header dict)
+    '''
+
+    with open(str(path) + HEADER_SUFFIX) as f:
+        header = json.load(f)
+    channels = len(header['channels'])
+    dtype = np.dtype(header['dtype'])
+    samples = os.path.getsize(path) // (dtype.itemsize * channels) # trust the file over the header after a crash
+    if samples == 0:
+        return np.empty((0, channels), dtype=dtype), header
+    return np.memmap(path, dtype=dtype, mode='r', shape=(samples, channels)), header
+
+
+def load_summary(path):
+    '''decimated min/mean/max summary of a recording
+
+    args:
+        path: raw data file written by ChunkWriter
+
+    returns: (times in s, array of shape (points, channels, 3)) or None if no summary was kept
+    '''
+
+    with open(str(path) + HEADER_SUFFIX) as f:
+        header = json.load(f)
+    summary_path = str(path) + SUMMARY_SUFFIX
+    if not header.get('summary_factor') or not os.path.exists(summary_path):
+        return None
+    data = np.fromfile(summary_path, dtype=np.float32).reshape(-1, len(header['channels']), 3)
+    times = (np.arange(len(data)) + 0.5) * header['summary_factor'] / header['rate']
+    return times, data
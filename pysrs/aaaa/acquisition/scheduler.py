@@ -0,0 +1,391 @@
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+import numpy as np
+from pysrs.aaaa.acquisition.engine import AcquisitionRequest, galvo_for, ttl_for
+from pysrs.mains.config_model import ConfigModel
+from pysrs.mains.mosaic import tile_grid
+
+'''
+experiment queue for back to back multi dimensional runs
+
+an Experiment describes a whole sequence: time points x xy tiles x z planes x delay positions. it is expanded
+into steps, one per (time, tile, plane), and each step is one engine request holding the delay scan, so the
+engine keeps overlapping the zaber moves with the frames. the order inside a time point minimises travel:
+tiles in a serpentine (or nearest neighbour order for a free list of positions), z planes walked down and back
+up on alternate tiles, delays walked forward and back on alternate planes, so no stage ever flies back to its
+start while there is still work next to where it is.
+
+the Scheduler runs experiments from a priority queue without waiting for anyone to press a button. while one
+runs, the waveform and compiled mask of the next are built in the background (the engine caches them), and the
+queue can be paused between steps, resumed, reprioritised or cancelled.
+'''
+
+RUN_STATES = ['queued', 'running', 'paused', 'done', 'cancelled', 'error']
+
+
+class Step:
+    def __init__(self, index: int, t_s: float, tile: int, xy_um: tuple, z_um: float, delays_um: list) -> None:
+        # one engine request: everything except the delay axis is fixed
+        self.index = index
+        self.t_s = t_s
+        self.tile = tile
+        self.xy_um = xy_um
+        self.z_um = z_um
+        self.delays_um = delays_um
+
+    def __repr__(self):
+        return f'Step({self.index}, t={self.t_s}, tile={self.tile}, xy={self.xy_um}, z={self.z_um}, delays={self.delays_um})'
+
+    def to_dict(self) -> dict:
+        return {'index': self.index, 't_s': self.t_s, 'tile': self.tile,
+                'xy_um': None if self.xy_um is None else list(self.xy_um), 'z_um': self.z_um, 'delays_um': self.delays_um}
+
+
+class Experiment:
+    def __init__(self, config: dict, times_s: list = None, delays_um: list = None, z_um: list = None,
+                 tiles: list = None, frames: int = 1, backend: str = 'sim', mask_path: str = None,
+                 ttl_line: str = None, keep_frames: bool = False, label: str = '') -> None:
+        '''a multi dimensional acquisition, every axis is optional
+
+        args:
+            config: acquisition config (gui config keys)
+            times_s: start of each time point relative to the experiment start, None for one time point at 0
+            delays_um: delay stage positions, None for plain frames at the current delay
+            z_um: focus positions on the z stage, None to stay where it is
+            tiles: xy stage positions [(x, y), ...] or a grid dict for mosaic.tile_grid
+                (tiles_x, tiles_y, step_x_um, step_y_um, origin), None to stay where it is
+            frames: frames per step when there is no delay axis
+            backend: engine backend, see engine.BACKENDS
+            mask_path, ttl_line: rpoc mask played on every frame, see AcquisitionRequest
+            keep_frames: keep frames on the engine jobs, off for long unattended runs that save through listeners
+            label: shown in queue listings
+
+        returns: none
+        '''
+
+        # parsed the way the engine parses it, so the prefetch builds under the same cache keys
+        self.config = dict(ConfigModel(config).snapshot())
+        self.times_s = [0.0] if not times_s else sorted(float(t) for t in times_s)
+        self.delays_um = None if delays_um is None else [float(d) for d in delays_um]
+        self.z_um = None if z_um is None else [float(z) for z in z_um]
+        self.tiles = tiles
+        self.frames = int(frames)
+        self.backend = backend
+        self.mask_path = mask_path
+        self.ttl_line = ttl_line
+        self.keep_frames = bool(keep_frames)
+        self.label = label
+
+    def tile_positions(self) -> list:
+        if self.tiles is None:
+            return [None]
+        if isinstance(self.tiles, dict):
+            return [(x, y) for _, _, x, y in tile_grid(**self.tiles)] # already serpentine
+        return [tuple(float(v) for v in xy) for xy in self.tiles]
+
+    def request(self, step: Step) -> AcquisitionRequest:
+        return AcquisitionRequest(self.config, frames=self.frames, delays_um=step.delays_um, backend=self.backend,
+                                  mask_path=self.mask_path, ttl_line=self.ttl_line, keep_frames=self.keep_frames,
+                                  label=f'{self.label} step {step.index}'.strip())
+
+    def to_dict(self) -> dict:
+        return {'config': {k: list(v) if isinstance(v, tuple) else v for k, v in self.config.items()},
+                'times_s': self.times_s, 'delays_um': self.delays_um, 'z_um': self.z_um, 'tiles': self.tiles,
+                'frames': self.frames, 'backend': self.backend, 'mask_path': self.mask_path,
+                'ttl_line': self.ttl_line, 'keep_frames': self.keep_frames, 'label': self.label}
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'Experiment':
+        unknown = set(values) - set(cls({}).to_dict())
+        if unknown:
+            raise ValueError(f'Unknown experiment fields: {sorted(unknown)}')
+        return cls(**values)
+
+
+def nearest_neighbour_order(points: list, start=None) -> list:
+    '''visiting order for free xy positions, always the closest unvisited one next
+
+    args:
+        points: list of (x, y)
+        start: current stage position, None starts at the first point
+
+    returns: list of indices into points
+    '''
+
+    if len(points) <= 2:
+        return list(range(len(points)))
+    xy = np.asarray(points, dtype=float)
+    left = np.ones(len(xy), dtype=bool)
+    here = xy[0] if start is None else np.asarray(start, dtype=float)
+    order = []
+    for _ in range(len(xy)):
+        dist = np.where(left, np.hypot(*(xy - here).T), np.inf)
+        k = int(np.argmin(dist))
+        order.append(k)
+        left[k] = False
+        here = xy[k]
+    return order
+
+
+def expand(experiment: Experiment, start_xy=None) -> list:
+    '''every step of an experiment in acquisition order
+
+    args:
+        experiment: Experiment
+        start_xy: current xy stage position, used to pick the tile order for free position lists
+
+    returns: list of Step
+    '''
+
+    tiles = experiment.tile_positions()
+    if tiles[0] is not None and not isinstance(experiment.tiles, dict):
+        order = nearest_neighbour_order(tiles, start_xy)
+    else:
+        order = list(range(len(tiles)))
+    planes = experiment.z_um or [None]
+    delays = experiment.delays_um
+
+    steps = []
+    flip_z = flip_delay = False
+    for t in experiment.times_s:
+        # later time points walk the tiles back the way they came, the stage is already at the far end
+        tile_order = order[::-1] if steps and steps[-1].tile == order[-1] else order
+        for k in tile_order:
+            for z in (planes[::-1] if flip_z else planes):
+                step_delays = None if delays is None else (delays[::-1] if flip_delay else list(delays))
+                steps.append(Step(len(steps), t, k, tiles[k], z, step_delays))
+                flip_delay = not flip_delay
+            flip_z = not flip_z
+    return steps
+
+
+def travel(steps: list) -> dict:
+    '''total stage travel of a step sequence, to compare orderings
+
+    args:
+        steps: list of Step
+
+    returns: dict with xy_um, z_um and delay_um
+    '''
+
+    xy = z = delay = 0.0
+    last_xy = last_z = last_delay = None
+    for step in steps:
+        if step.xy_um is not None and last_xy is not None:
+            xy += float(np.hypot(step.xy_um[0] - last_xy[0], step.xy_um[1] - last_xy[1]))
+        if step.z_um is not None and last_z is not None:
+            z += abs(step.z_um - last_z)
+        for d in step.delays_um or []:
+            if last_delay is not None:
+                delay += abs(d - last_delay)
+            last_delay = d
+        last_xy = step.xy_um if step.xy_um is not None else last_xy
+        last_z = step.z_um if step.z_um is not None else last_z
+    return {'xy_um': xy, 'z_um': z, 'delay_um': delay}
+
+
+class Run:
+    _ids = itertools.count(1)
+
+    def __init__(self, experiment: Experiment, priority: int = 0, listener=None) -> None:
+        # one queued experiment, listener(event, data) is passed on to every engine job it starts
+        self.id = next(Run._ids)
+        self.experiment = experiment
+        self.priority = priority
+        self.listener = listener
+        self.state = 'queued'
+        self.steps = None
+        self.done = 0
+        self.jobs = [] # engine job ids, one per step
+        self.error = None
+        self.prepared = None # future of the background prefetch
+        self._cancel = threading.Event()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def summary(self) -> dict:
+        return {'run': self.id, 'label': self.experiment.label, 'priority': self.priority, 'state': self.state,
+                'done': self.done, 'total': None if self.steps is None else len(self.steps),
+                'jobs': list(self.jobs), 'error': self.error}
+
+
+class Scheduler:
+    def __init__(self, engine, xy_stage=None, z_stage=None) -> None:
+        '''runs queued experiments back to back on an AcquisitionEngine
+
+        args:
+            engine: AcquisitionEngine, its delay stage handles the delay axis
+            xy_stage, z_stage: stages with goto_xy(x, y) / goto_z(z) (e.g. PriorStage), None leaves that axis alone
+
+        returns: none
+        '''
+
+        self.engine = engine
+        self.xy_stage = xy_stage
+        self.z_stage = z_stage
+        self.runs = {}
+        self.current = None
+        self._heap = [] # (-priority, submit order, run)
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._paused = False
+        self._prefetch = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+        self._worker = threading.Thread(target=self._work, name='scheduler', daemon=True)
+        self._worker.start()
+
+    def submit(self, experiment: Experiment, priority: int = 0, listener=None) -> Run:
+        '''queue an experiment, higher priority runs first, equal priorities in submit order
+
+        args:
+            experiment: Experiment
+            priority: any int, only compared with other queued runs, a running one is never interrupted
+            listener: optional callable(event, data) for the engine events of every step
+
+        returns: Run
+        '''
+
+        experiment.request(Step(0, 0.0, 0, None, None, experiment.delays_um)).validate() # fail now, not at 3 am
+        run = Run(experiment, priority, listener)
+        with self._wakeup:
+            self.runs[run.id] = run
+            heapq.heappush(self._heap, (-priority, next(self._order), run))
+            self._wakeup.notify()
+        self.prefetch_next()
+        return run
+
+    def reprioritize(self, run_id: int, priority: int) -> None:
+        with self._wakeup:
+            run = self.runs[run_id]
+            run.priority = priority
+            self._heap = [(-r.priority, order, r) for _, order, r in self._heap]
+            heapq.heapify(self._heap)
+        self.prefetch_next()
+
+    def pause(self) -> None:
+        # takes effect after the step that is running, frames already armed finish
+        with self._wakeup:
+            self._paused = True
+            if self.current is not None:
+                self.current.state = 'paused'
+
+    def resume(self) -> None:
+        with self._wakeup:
+            self._paused = False
+            if self.current is not None and self.current.state == 'paused':
+                self.current.state = 'running'
+            self._wakeup.notify_all()
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    def cancel(self, run_id: int = None) -> None:
+        # one run, or everything queued and running
+        with self._lock:
+            runs = [self.runs[run_id]] if run_id is not None else list(self.runs.values())
+        for run in runs:
+            run.cancel()
+        if run_id is None:
+            self.engine.cancel()
+        with self._wakeup:
+            self._wakeup.notify_all() # a paused run has to wake up to notice
+
+    def status(self) -> dict:
+        with self._lock:
+            queued = [r.id for _, _, r in sorted(self._heap)]
+            runs = [r.summary() for r in self.runs.values()]
+        return {'paused': self.paused, 'current': None if self.current is None else self.current.id,
+                'queue': queued, 'runs': runs}
+
+    def prefetch_next(self) -> None:
+        # waveform and mask ttl of the run that will start next, built while the current one acquires
+        with self._lock:
+            run = self._heap[0][2] if self._heap else None
+        if run is not None and run.prepared is None:
+            run.prepared = self._prefetch.submit(self.prepare, run.experiment)
+
+    @staticmethod
+    def prepare(experiment: Experiment) -> None:
+        if experiment.backend not in ('daq', 'sim-daq'):
+            return # the simulator and replays have nothing worth building ahead
+        galvo = galvo_for(experiment.config)
+        if experiment.mask_path:
+            ttl_for(experiment.mask_path, galvo)
+
+    def _work(self) -> None:
+        while True:
+            with self._wakeup:
+                # a paused queue does not pick its next run, so priorities set meanwhile still count
+                self._wakeup.wait_for(lambda: self._heap and not self._paused)
+                run = heapq.heappop(self._heap)[2]
+            self.prefetch_next()
+            if run.cancelled:
+                run.state = 'cancelled'
+                continue
+            self.current = run
+            try:
+                self.execute(run)
+            finally:
+                self.current = None
+
+    def wait_until(self, run: Run, t: float) -> bool:
+        # sleep until a time point, false if the run was cancelled meanwhile
+        while not run.cancelled:
+            left = t - time.monotonic()
+            if left <= 0:
+                return True
+            time.sleep(min(left, 0.1))
+        return False
+
+    def execute(self, run: Run) -> None:
+        '''every step of one run, on the scheduler thread
+
+        args:
+            run: Run popped from the queue
+
+        returns: none, the outcome is in run.state
+        '''
+
+        experiment = run.experiment
+        run.state = 'running'
+        try:
+            if run.prepared is not None:
+                run.prepared.result() # usually long done, a failed prefetch raises here before anything moves
+            start_xy = self.xy_stage.get_xy() if self.xy_stage is not None and experiment.tiles is not None else None
+            run.steps = expand(experiment, start_xy)
+            t0 = time.monotonic()
+            last_xy = last_z = None
+            for step in run.steps:
+                with self._wakeup: # pause point, between steps only
+                    self._wakeup.wait_for(lambda: not self._paused or run.cancelled)
+                if run.cancelled or not self.wait_until(run, t0 + step.t_s):
+                    break
+                if self.xy_stage is not None and step.xy_um is not None and step.xy_um != last_xy:
+                    self.xy_stage.goto_xy(*step.xy_um)
+                    last_xy = step.xy_um
+                if self.z_stage is not None and step.z_um is not None and step.z_um != last_z:
+                    self.z_stage.goto_z(step.z_um)
+                    last_z = step.z_um
+                job = self.engine.submit(experiment.request(step), run.listener)
+                run.jobs.append(job.id)
+                while not job.wait(0.1):
+                    if run.cancelled:
+                        job.cancel()
+                if job.state == 'error':
+                    raise RuntimeError(f'Step {step.index}: {job.error}')
+                run.done = step.index + 1
+        except Exception as e:
+            run.error = f'{type(e).__name__}: {e}'
+            run.state = 'error'
+            print(f'[WARN] Run {run.id} ({experiment.label}) stopped: {run.error}')
+            return
+        run.state = 'cancelled' if run.cancelled else 'done'
@@ -1,27 +1,36 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog, PhotoImage
 import numpy as np
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 import threading, os
 from pathlib import Path
-from PIL import Image, ImageTk
-from pysrs.instruments.zaber import ZaberStage
-from pysrs.mains.rpoc2 import RPOC
+from pysrs.aaaa.instruments.zaber import ZaberStage
+from pysrs.aaaa.instruments.zaber_tuning import MotionProfileTable, tune_motion_profiles, save_timings
+from pysrs.aaaa.acquisition.engine import AcquisitionEngine
+from pysrs.aaaa.acquisition.scheduler import Scheduler
+from pysrs.aaaa.acquisition import api
 from pysrs.mains.widgets import CollapsiblePane, ScrollableFrame
 from utils import Tooltip, generate_data, convert
 import acquisition
 import calibration
+import autofocus
+import automask
+import mask_io
+from config_model import ConfigModel, ConfigError
+from startup import PhaseTimer
+from calibration_table import CalibrationTable
 import display
 import math
 from utils import Tooltip, generate_data, convert
-from pysrs.instruments.prior_stage.prior_stage_movement_test import send_command, wait_for_z_motion
+from pysrs.aaaa.instruments.prior import PriorStage
+from pysrs.aaaa.instruments.prior_stage.coordinator import SimulatedPriorTransport
 
 BASE_DIR = Path(__file__).resolve().parent.parent # directory definition to access icons that i will add later 
 FOLDERICON_PATH = BASE_DIR / "data" / "folder_icon.png" # for browsing the save path
 
 class GUI:
-    def __init__(self, root):
+    def __init__(self, root, timer: PhaseTimer = None):
+        # matplotlib, PIL and the instrument libraries are imported on first use, the window comes up first
+        self.timer = timer or PhaseTimer()
         self.root = root
         self.root.title('Stimulated Raman Coordinator')
         self.root.geometry('1200x800')
@@ -33,10 +42,11 @@ class GUI:
         self.acquiring = False
         self.collapsed = False
         self.save_acquisitions = tk.BooleanVar(value=False)
+        self.raw_capture = tk.BooleanVar(value=False)
         self.root.protocol('WM_DELETE_WINDOW', self.close)
         self.root.bind("<Button-1>", self.on_global_click, add="+")
 
-        self.config = {
+        self.config = ConfigModel({
             'device': 'Dev1',
             'ao_chans': ['ao1', 'ao0'],
             'ai_chans': ['ai1'],
@@ -48,26 +58,46 @@ class GUI:
             'numsteps_x': 200,
             'numsteps_y': 200,
             'numsteps_extra': 50,
-            'dwell': 1e-5
-        }
+            'dwell': 1e-5,
+            'demod': None # software lock-in settings for raw detector inputs, see acquire.reduce_frame
+        })
         self.param_entries = {} # gets populated later with the params from config
 
         # delay stage config, handled within calibration.py so separate the config as well
         self.hyper_config = {
             'start_um': 20000,
             'stop_um': 30000,
-            'single_um': 25000
+            'single_um': 25000,
+            'units': 'um', # 'um' for raw stage positions, 'cm-1' to scan on the calibrated raman shift axis
+            'stream_mode': False, # let the zaber controller step through a stored position list
+            'stream_trigger': 'PFI0', # DAQ terminal wired to the zaber DO, starts each frame
+            'stream_done_line': 'port0/line5', # DAQ DO wired to the zaber DI, pulsed once a frame is read
+            'stream_do': 1,
+            'stream_di': 1,
+            'stream_settle_ms': 0
         }
+        self.calibration_table = CalibrationTable.load_latest() # None until a calibration has been saved
         self.hyperspectral_enabled = tk.BooleanVar(value=False)
+        self.raman_units = tk.BooleanVar(value=False)
+        self.stream_mode = tk.BooleanVar(value=False)
         self.rpoc_enabled = tk.BooleanVar(value=False)
         self.mask_file_path = tk.StringVar(value="No mask loaded")
-        self.zaber_stage = ZaberStage(port=self.config['zaber_chan'])
+        self.zaber_stage = ZaberStage(port=self.config['zaber_chan']) # zaber_motion is only loaded on the first connect
+        self.instruments = {} # filled in by probe_instruments in the background
+        self.engine = None # headless AcquisitionEngine, the gui is one of its clients
+        self.scheduler = None # experiment queue on the same engine
+        self.api_server = None
+        self.prior_stages = {} # one PriorStage per transport kind, created on first use
+        self.zstack_enabled = tk.BooleanVar(value=False)
+        self.autofocus_each = tk.BooleanVar(value=False)
+        self.mosaic_enabled = tk.BooleanVar(value=False)
 
         # variable number of inputs means we have to handle the channels weirdly
         self.channel_axes = []
         self.slice_x = []
         self.slice_y = []
         self.data = None
+        self.rpoc_mask = None
         
         self.main_frame = ttk.Frame(self.root)
         self.main_frame.pack(fill="both", expand=True)
@@ -100,15 +130,49 @@ class GUI:
                         arrowcolor="#888888")
                         
         
-        self.create_widgets()
+        with self.timer.phase('widgets'):
+            self.create_widgets()
 
         self.root.after(100, lambda: self.paned.sashpos(0, 450))
         self.update_sidebar_visibility()
         
         self.root.after(500, self.update_sidebar_visibility)
 
+        self.config.subscribe(self.on_config_change)
+        self.root.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        # runs once the window has been drawn: the display, then instruments and the first frame in the background
+        self.timer.mark('window')
+        if self.fig is None:
+            with self.timer.phase('display'):
+                self.create_display()
+        threading.Thread(target=self.probe_instruments, daemon=True).start()
         threading.Thread(target=acquisition.acquire, args=(self,), kwargs={"startup": True}, daemon=True).start()
 
+    def probe_instruments(self):
+        '''find out what hardware is there without holding up the window, never connects or moves anything
+
+        args: none
+
+        returns: none, results go to self.instruments
+        '''
+
+        with self.timer.phase('instruments'):
+            self.zaber_stage.motion_profiles = MotionProfileTable.load_latest() # None until the stage has been tuned
+            try:
+                import nidaqmx.system # only needed on the rig
+                self.instruments['daq'] = [d.name for d in nidaqmx.system.System.local().devices]
+            except Exception as e: # no driver, no NI-DAQmx runtime, or no card
+                self.instruments['daq'] = []
+                print(f'[INFO] No DAQ found ({type(e).__name__}), use simulation mode.')
+            try:
+                import zaber_motion # loads the native library now, so the first stage move does not pay for it
+                self.instruments['zaber'] = True
+            except ImportError:
+                self.instruments['zaber'] = False
+                print('[INFO] zaber_motion is not installed, the delay stage is unavailable.')
+
     def update_sidebar_visibility(self):
         panes = [child for child in self.sidebar.winfo_children() if hasattr(child, 'show')] # python moment
         visible = any(pane.show.get() for pane in panes)  
@@ -145,6 +209,7 @@ class GUI:
         style.theme_use('clam')
 
         # configure all the various settings
+        style.configure("Feedback.TEntry", fieldbackground="lightgreen") # flashed on entries that changed a value
         style.configure('TFrame', background=self.bg_color)
         style.configure('TLabelFrame', background=self.bg_color, borderwidth=2, relief="groove")
         style.configure('TLabelFrame.Label', background=self.bg_color, foreground=self.fg_color, font=bold_font)
@@ -184,7 +249,7 @@ class GUI:
 
         self.single_button = ttk.Button(
             self.control_frame, text='Acquire',
-            command=lambda: threading.Thread(target=acquisition.acquire, args=(self,), daemon=True).start()
+            command=self.start_acquisition
         )
         self.single_button.grid(row=0, column=1, padx=5, pady=5, sticky='ew')
 
@@ -210,6 +275,14 @@ class GUI:
         )
         self.simulation_mode_checkbutton.grid(row=0, column=1, padx=0, sticky='w')
 
+        self.raw_capture_checkbutton = ttk.Checkbutton(
+            self.checkbox_frame, text='Capture Raw Samples', variable=self.raw_capture
+        )
+        self.raw_capture_checkbutton.grid(row=1, column=0, padx=0, sticky='w')
+
+        self.replay_button = ttk.Button(self.checkbox_frame, text='Replay Capture', command=self.replay_capture)
+        self.replay_button.grid(row=1, column=1, padx=0, pady=(5, 0), sticky='w')
+
         self.io_frame = ttk.Frame(self.control_frame)
         self.io_frame.grid(row=2, column=0, columnspan=3, pady=(5, 5), sticky='ew')
         self.io_frame.columnconfigure(0, weight=0)
@@ -236,6 +309,31 @@ class GUI:
         browse_button = ttk.Button(self.path_frame, text="📂", width=2, command=self.browse_save_path)
         browse_button.grid(row=0, column=1, padx=5)
 
+        # experiment queue, runs the acquire settings back to back without pressing Acquire for each one
+        self.queue_frame = ttk.Frame(self.control_frame)
+        self.queue_frame.grid(row=4, column=0, columnspan=3, pady=(5, 5), sticky='ew')
+        for col in range(4):
+            self.queue_frame.columnconfigure(col, weight=1)
+
+        ttk.Button(self.queue_frame, text='Queue Run', command=self.queue_run).grid(
+            row=0, column=0, padx=2, pady=2, sticky='ew')
+        self.queue_pause_button = ttk.Button(self.queue_frame, text='Pause Queue', command=self.toggle_queue_pause)
+        self.queue_pause_button.grid(row=0, column=1, padx=2, pady=2, sticky='ew')
+        ttk.Button(self.queue_frame, text='Cancel Run', command=self.cancel_queued_run).grid(
+            row=0, column=2, padx=2, pady=2, sticky='ew')
+        ttk.Button(self.queue_frame, text='Set Priority', command=self.reprioritize_run).grid(
+            row=0, column=3, padx=2, pady=2, sticky='ew')
+
+        ttk.Label(self.queue_frame, text='Priority').grid(row=1, column=0, sticky='w', padx=(5, 0))
+        self.queue_priority_entry = ttk.Entry(self.queue_frame, width=6)
+        self.queue_priority_entry.insert(0, '0')
+        self.queue_priority_entry.grid(row=1, column=1, sticky='w', padx=5)
+
+        self.queue_list = tk.Listbox(self.queue_frame, height=4, bg=self.entry_bg, fg=self.entry_fg,
+                                     selectbackground=self.highlight_color, exportselection=False)
+        self.queue_list.grid(row=2, column=0, columnspan=4, padx=5, pady=(5, 0), sticky='ew')
+        self.queue_runs = [] # run id of every line in queue_list
+
 
 
         ###################################################################
@@ -261,12 +359,14 @@ class GUI:
         )
         self.delay_hyperspec_checkbutton.grid(row=1, column=0, columnspan=2, padx=5, pady=5, sticky='w')
 
-        ttk.Label(self.delay_stage_frame, text="Start (µm)").grid(row=2, column=0, sticky="w", padx=5, pady=3)
+        self.start_label = ttk.Label(self.delay_stage_frame, text="Start (µm)")
+        self.start_label.grid(row=2, column=0, sticky="w", padx=5, pady=3)
         self.entry_start_um = ttk.Entry(self.delay_stage_frame, width=10)
         self.entry_start_um.insert(0, str(self.hyper_config['start_um']))
         self.entry_start_um.grid(row=2, column=1, padx=5, pady=3, sticky="ew")
 
-        ttk.Label(self.delay_stage_frame, text="Stop (µm)").grid(row=3, column=0, sticky="w", padx=5, pady=3)
+        self.stop_label = ttk.Label(self.delay_stage_frame, text="Stop (µm)")
+        self.stop_label.grid(row=3, column=0, sticky="w", padx=5, pady=3)
         self.entry_stop_um = ttk.Entry(self.delay_stage_frame, width=10)
         self.entry_stop_um.insert(0, str(self.hyper_config['stop_um']))
         self.entry_stop_um.grid(row=3, column=1, padx=5, pady=3, sticky="ew")
@@ -293,6 +393,29 @@ class GUI:
         )
         self.movestage_button.grid(row=6, column=1, padx=5, pady=10, sticky='ew')
 
+        self.raman_units_checkbutton = ttk.Checkbutton(
+            self.delay_stage_frame, text='Scan in Raman Shift (cm⁻¹)',
+            variable=self.raman_units, command=self.toggle_raman_units
+        )
+        self.raman_units_checkbutton.grid(row=7, column=0, columnspan=2, padx=5, pady=3, sticky='w')
+
+        self.stream_mode_checkbutton = ttk.Checkbutton(
+            self.delay_stage_frame, text='Controller-Sequenced Steps',
+            variable=self.stream_mode,
+            command=lambda: self.hyper_config.__setitem__('stream_mode', self.stream_mode.get())
+        )
+        self.stream_mode_checkbutton.grid(row=9, column=0, columnspan=2, padx=5, pady=3, sticky='w')
+
+        self.tune_button = ttk.Button(
+            self.delay_stage_frame, text='Tune Motion',
+            command=lambda: threading.Thread(target=self.tune_zaber_motion, daemon=True).start()
+        )
+        self.tune_button.grid(row=10, column=0, padx=5, pady=10, sticky='ew')
+
+        self.calibration_status_label = ttk.Label(self.delay_stage_frame, text='')
+        self.calibration_status_label.grid(row=8, column=0, columnspan=2, padx=5, pady=3, sticky='w')
+        self.update_calibration_status()
+
 
 
         ###################################################################
@@ -317,6 +440,63 @@ class GUI:
         self.prior_move_button = ttk.Button(self.prior_stage_frame, text="Move Z", command=self.move_prior_stage)
         self.prior_move_button.grid(row=2, column=0, columnspan=2, pady=5, sticky="ew")
 
+        self.zstack_checkbutton = ttk.Checkbutton(
+            self.prior_stage_frame, text='Enable Z-Stack',
+            variable=self.zstack_enabled, command=self.toggle_zstack_fields
+        )
+        self.zstack_checkbutton.grid(row=3, column=0, columnspan=2, padx=5, pady=5, sticky='w')
+
+        ttk.Label(self.prior_stage_frame, text="Z Start (µm)").grid(row=4, column=0, padx=5, pady=3, sticky="w")
+        self.entry_z_start = ttk.Entry(self.prior_stage_frame, width=10)
+        self.entry_z_start.insert(0, '0')
+        self.entry_z_start.grid(row=4, column=1, padx=5, pady=3, sticky="ew")
+
+        ttk.Label(self.prior_stage_frame, text="Z Stop (µm)").grid(row=5, column=0, padx=5, pady=3, sticky="w")
+        self.entry_z_stop = ttk.Entry(self.prior_stage_frame, width=10)
+        self.entry_z_stop.insert(0, '100')
+        self.entry_z_stop.grid(row=5, column=1, padx=5, pady=3, sticky="ew")
+
+        ttk.Label(self.prior_stage_frame, text="Number of Planes").grid(row=6, column=0, padx=5, pady=3, sticky="w")
+        self.entry_z_planes = ttk.Entry(self.prior_stage_frame, width=10)
+        self.entry_z_planes.insert(0, '11')
+        self.entry_z_planes.grid(row=6, column=1, padx=5, pady=3, sticky="ew")
+
+        ttk.Label(self.prior_stage_frame, text="Focus Range (µm)").grid(row=7, column=0, padx=5, pady=3, sticky="w")
+        self.entry_af_range = ttk.Entry(self.prior_stage_frame, width=10)
+        self.entry_af_range.insert(0, '50')
+        self.entry_af_range.grid(row=7, column=1, padx=5, pady=3, sticky="ew")
+
+        ttk.Label(self.prior_stage_frame, text="Focus Metric").grid(row=8, column=0, padx=5, pady=3, sticky="w")
+        self.af_metric_var = tk.StringVar(value=list(autofocus.FOCUS_METRICS)[0])
+        ttk.Combobox(self.prior_stage_frame, textvariable=self.af_metric_var, values=list(autofocus.FOCUS_METRICS),
+                     state='readonly', width=16).grid(row=8, column=1, padx=5, pady=3, sticky="ew")
+
+        self.autofocus_button = ttk.Button(
+            self.prior_stage_frame, text="Autofocus",
+            command=lambda: threading.Thread(target=self.run_autofocus, daemon=True).start()
+        )
+        self.autofocus_button.grid(row=9, column=0, pady=5, sticky="ew")
+
+        ttk.Checkbutton(
+            self.prior_stage_frame, text='Refocus Each Frame', variable=self.autofocus_each
+        ).grid(row=9, column=1, padx=5, pady=5, sticky='w')
+
+        self.mosaic_checkbutton = ttk.Checkbutton(
+            self.prior_stage_frame, text='Enable XY Mosaic',
+            variable=self.mosaic_enabled, command=self.toggle_zstack_fields
+        )
+        self.mosaic_checkbutton.grid(row=10, column=0, columnspan=2, padx=5, pady=5, sticky='w')
+
+        self.mosaic_entries = []
+        for row, (label, default) in enumerate([("Tiles X", '3'), ("Tiles Y", '3'), ("Overlap (%)", '15'),
+                                                ("Field of View (µm)", '100')], start=11):
+            ttk.Label(self.prior_stage_frame, text=label).grid(row=row, column=0, padx=5, pady=3, sticky="w")
+            entry = ttk.Entry(self.prior_stage_frame, width=10)
+            entry.insert(0, default)
+            entry.grid(row=row, column=1, padx=5, pady=3, sticky="ew")
+            self.mosaic_entries.append(entry)
+        self.entry_tiles_x, self.entry_tiles_y, self.entry_overlap, self.entry_fov_um = self.mosaic_entries
+
 
 
         ###################################################################
@@ -355,6 +535,9 @@ class GUI:
         newmask_button = ttk.Button(self.rpoc_frame, text='Create New Mask', command=self.create_mask)
         newmask_button.grid(row=2, column=0, padx=5, pady=5, sticky="ew")
 
+        automask_button = ttk.Button(self.rpoc_frame, text='Auto Mask', command=self.auto_mask)
+        automask_button.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
+
         ttk.Label(self.rpoc_frame, text='Create mask from:').grid(
             row=3, column=0, columnspan=1, padx=1, pady=1, sticky='e'
         )
@@ -376,6 +559,20 @@ class GUI:
 
         self.mask_ttl_entry.grid(row=4, column=1, padx=5, pady=5, columnspan=1, sticky='ew')
 
+        self.rpoc_closed_loop = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            self.rpoc_frame, text='Closed Loop (remask every frame)', variable=self.rpoc_closed_loop
+        ).grid(row=5, column=0, columnspan=2, padx=5, pady=5, sticky='w')
+
+        ttk.Label(self.rpoc_frame, text='Mask Method:').grid(row=6, column=0, padx=5, pady=5, sticky='e')
+        self.rpoc_method_var = tk.StringVar(value=automask.METHODS[0])
+        ttk.Combobox(self.rpoc_frame, textvariable=self.rpoc_method_var, values=automask.METHODS,
+                     state='readonly', width=12).grid(row=6, column=1, padx=5, pady=5, sticky='ew')
+
+        ttk.Label(self.rpoc_frame, text='Latency Budget (ms):').grid(row=7, column=0, padx=5, pady=5, sticky='e')
+        self.entry_rpoc_budget = ttk.Entry(self.rpoc_frame, width=10) # empty means one frame period
+        self.entry_rpoc_budget.grid(row=7, column=1, padx=5, pady=5, sticky='ew')
+
 
 
         ###################################################################
@@ -422,7 +619,7 @@ class GUI:
             "• Device (enter below): NI-DAQ device identifier (e.g., 'Dev1')\n"
             "• Delay Chan: channel input for delay stage (e.g., 'COM3')\n"
             "• AO Chans: analog output channels to the galvo mirrors (e.g., 'ao1,ao0')\n"
-            "• AI Chan: analog input channels from amplifier (e.g., 'ai1,ai2,ai3') \n"
+            "• AI Chan: analog input channels from amplifier (e.g., 'ai1,ai2,ai3'), 'Dev2/ai0' for another card\n"
             "• Sampling Rate (Hz): resolution of signal output and input\n"
             "• Amp X / Amp Y: voltage amplitudes for galvo movement\n"
             "• Steps X / Steps Y: discrete points in X,Y\n"
@@ -449,13 +646,25 @@ class GUI:
         ###################################################################
         ####################### DATA DISPLAY STUFF ########################
         ###################################################################
-        display_frame = ttk.LabelFrame(self.display_area, text='Data Display', padding=(10, 10))
-        display_frame.grid(row=0, column=0, sticky='nsew', padx=10, pady=10)
-        display_frame.rowconfigure(0, weight=1)
-        display_frame.columnconfigure(0, weight=1)
+        self.display_frame = ttk.LabelFrame(self.display_area, text='Data Display', padding=(10, 10))
+        self.display_frame.grid(row=0, column=0, sticky='nsew', padx=10, pady=10)
+        self.display_frame.rowconfigure(0, weight=1)
+        self.display_frame.columnconfigure(0, weight=1)
+        self.fig = None # the matplotlib figure is built by create_display once the window is up
+
+        # set all the initial states by calling all the toggles
+        self.toggle_hyperspectral_fields()
+        self.toggle_save_options()
+        self.toggle_zstack_fields()
+        self.toggle_rpoc_fields()
+
+    def create_display(self):
+        # importing matplotlib and its tk backend is the slowest part of startup, so it waits for the first draw
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 
         self.fig = Figure(figsize=(10, 8), dpi=100)
-        self.canvas = FigureCanvasTkAgg(self.fig, master=display_frame)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.display_frame)
 
         self.canvas_widget = self.canvas.get_tk_widget()
         self.canvas_widget.pack(fill=tk.BOTH, expand=True)
@@ -467,11 +676,6 @@ class GUI:
 
         self.canvas.mpl_connect('button_press_event', lambda event: display.on_image_click(self, event))
 
-        # set all the initial states by calling all the toggles
-        self.toggle_hyperspectral_fields()
-        self.toggle_save_options()
-        self.toggle_rpoc_fields()
-
     def on_global_click(self, event):
         # force focus off of text entry boxes whenever clicked out of them
         if not isinstance(event.widget, tk.Entry):
@@ -487,46 +691,250 @@ class GUI:
         except ValueError:
             messagebox.showerror("Value Error", "Invalid single delay value entered. Max is 50,000 um, min is 0 um.") 
 
+    def update_calibration_status(self):
+        # raman shift scanning only makes sense once a calibration table with 2+ peaks exists
+        table = self.calibration_table
+        if table is not None and table.is_valid():
+            self.calibration_status_label.config(text=f'Calibration r{table.revision}: {len(table)} peaks')
+            self.raman_units_checkbutton.configure(state='normal')
+        else:
+            self.calibration_status_label.config(text='No Raman shift calibration loaded')
+            self.raman_units.set(False)
+            self.raman_units_checkbutton.configure(state='disabled')
+        self.toggle_raman_units()
+
+    def toggle_raman_units(self):
+        units = 'cm-1' if self.raman_units.get() else 'um'
+        if units == self.hyper_config['units']:
+            return
+        # convert what is already typed in so switching units does not change the scan range
+        try:
+            for entry in (self.entry_start_um, self.entry_stop_um):
+                state = str(entry.cget('state'))
+                entry.config(state='normal')
+                value = float(entry.get().strip())
+                if units == 'cm-1':
+                    value = self.calibration_table.um_to_shift(value)[0]
+                else:
+                    value = self.calibration_table.shift_to_um(value)[0]
+                entry.delete(0, tk.END)
+                entry.insert(0, f'{value:.1f}')
+                entry.config(state=state)
+        except (ValueError, AttributeError):
+            pass
+        self.hyper_config['units'] = units
+        label = 'cm⁻¹' if units == 'cm-1' else 'µm'
+        self.start_label.config(text=f'Start ({label})')
+        self.stop_label.config(text=f'Stop ({label})')
+
     def force_zaber(self):
         # move the zaber stage with a reminder to change to ASCII protocol in zaber console
         # TODO: fix error handling when no zaber stage is connected at all, it just crashes right now
         move_position = self.hyper_config['single_um']
-        try: 
+        def run(): # off the tk thread, the first connect homes the stage
+            try:
+                self.zaber_stage.connect()
+            except Exception as e:
+                messagebox.showerror("Connection Error", f'Could not connect to Zaber stage. Make sure that the protocol is set to ASCII in Zaber console: {e}')
+                return
+
+            try:
+                self.zaber_stage.move_absolute_um(move_position)
+                print(f"[INFO] Stage moved to {move_position} µm successfully.")
+            except Exception as e:
+                messagebox.showerror("Stage Move Error", f"Error moving stage: {e}")
+        threading.Thread(target=run, daemon=True).start()
+
+    def tune_zaber_motion(self):
+        # tune for the current hyperspectral step plus a decade spread, around the single delay position
+        try:
+            start = float(self.entry_start_um.get().strip())
+            stop = float(self.entry_stop_um.get().strip())
+            numshifts = int(self.entry_numshifts.get().strip())
+            if self.hyper_config['units'] == 'cm-1':
+                start, stop = self.calibration_table.shift_to_um([start, stop])
+            steps = {1.0, 10.0, 100.0, 1000.0}
+            if numshifts > 1 and stop != start:
+                steps.add(round(abs(stop - start) / (numshifts - 1), 3))
+        except ValueError:
+            messagebox.showerror("Value Error", "Invalid hyperspectral settings.")
+            return
+
+        self.tune_button.configure(state='disabled')
+        try:
             self.zaber_stage.connect()
+            table, timings = tune_motion_profiles(
+                self.zaber_stage, sorted(steps), self.hyper_config['single_um'],
+                progress=lambda done, total: self.root.after(
+                    0, lambda: self.progress_label.config(text=f'tuning ({done}/{total})'))
+            )
+            table.save()
+            timings_path = save_timings(timings)
+            self.zaber_stage.motion_profiles = table
+            summary = '\n'.join(f"{e['step_um']:g} µm: {e['speed_mm_s']:.2f} mm/s, {e['accel_mm_s2']:.0f} mm/s², "
+                                f"{1e3 * e['total_s']:.1f} ms" for e in table.entries)
+            messagebox.showinfo("Tuning Done", f"{summary}\n\nTimings saved to {timings_path}")
         except Exception as e:
-            messagebox.showerror("Connection Error", f'Could not connect to Zaber stage. Make sure that the protocol is set to ASCII in Zaber console: {e}')
-
+            messagebox.showerror("Tuning Error", f"Could not tune the Zaber stage: {e}")
+        finally:
+            self.tune_button.configure(state='normal')
+
+    def get_engine(self):
+        # one engine for the gui and the localhost api, so both queue on the same hardware
+        if self.engine is None:
+            self.engine = AcquisitionEngine(stage=self.zaber_stage)
+        return self.engine
+
+    def get_scheduler(self):
+        # queued experiments move the prior stage for tiles and planes, when there is one to talk to
+        if self.scheduler is None:
+            try:
+                stage = self.get_prior_stage()
+            except Exception as e:
+                print(f'[WARN] No Prior stage for the experiment queue, tiles and z planes will not move: {e}')
+                stage = None
+            self.scheduler = Scheduler(self.get_engine(), xy_stage=stage, z_stage=stage)
+            self.poll_queue() # runs submitted over the api show up in the list too
+        return self.scheduler
+
+    def queue_run(self):
+        # the run starts once everything queued before it (or with a higher priority) is done
+        self.update_config()
         try:
-            self.zaber_stage.move_absolute_um(move_position)
-            print(f"[INFO] Stage moved to {move_position} µm successfully.")
+            priority = int(self.queue_priority_entry.get().strip() or 0)
+            experiment = acquisition.queued_experiment(self)
+            run = self.get_scheduler().submit(experiment, priority, acquisition.queue_listener(self))
         except Exception as e:
-            messagebox.showerror("Stage Move Error", f"Error moving stage: {e}")
+            messagebox.showerror('Queue Error', f'Could not queue the run: {e}')
+            return
+        print(f'[INFO] Queued run {run.id} ({experiment.label}) at priority {priority}.')
+        self.refresh_queue()
 
-    def move_prior_stage(self):
+    def selected_run(self):
+        selection = self.queue_list.curselection()
+        return self.queue_runs[selection[0]] if selection else None
+
+    def toggle_queue_pause(self):
+        scheduler = self.get_scheduler()
+        if scheduler.paused:
+            scheduler.resume()
+        else:
+            scheduler.pause()
+        self.refresh_queue()
+
+    def cancel_queued_run(self):
+        run_id = self.selected_run()
+        if run_id is None:
+            messagebox.showwarning('Warning', 'Select a run in the queue first.')
+            return
+        self.get_scheduler().cancel(run_id)
+        self.refresh_queue()
+
+    def reprioritize_run(self):
+        run_id = self.selected_run()
+        if run_id is None:
+            messagebox.showwarning('Warning', 'Select a run in the queue first.')
+            return
         try:
-            port = int(self.prior_port_entry.get().strip())
-            z_height = int(self.prior_z_entry.get().strip())
+            priority = int(self.queue_priority_entry.get().strip())
+        except ValueError:
+            messagebox.showerror('Value Error', 'Priority must be an integer.')
+            return
+        self.get_scheduler().reprioritize(run_id, priority)
+        self.refresh_queue()
 
-            if not (0 <= z_height <= 50000):  
-                messagebox.showerror("Value Error", "Z height must be between 0 and 50,000 µm.")
-                return
+    def refresh_queue(self):
+        # polled on the tk thread while there is a scheduler, the scheduler itself never touches tk
+        if self.scheduler is None:
+            return
+        status = self.scheduler.status()
+        selected = self.selected_run()
+        self.queue_list.delete(0, tk.END)
+        self.queue_runs = []
+        for run in status['runs']:
+            total = '?' if run['total'] is None else run['total']
+            self.queue_list.insert(tk.END, f"#{run['run']} {run['label']}  p{run['priority']}  {run['state']} "
+                                           f"({run['done']}/{total})")
+            self.queue_runs.append(run['run'])
+        if selected in self.queue_runs:
+            self.queue_list.selection_set(self.queue_runs.index(selected))
+        self.queue_pause_button.config(text='Resume Queue' if status['paused'] else 'Pause Queue')
+
+    def poll_queue(self):
+        self.refresh_queue()
+        self.root.after(500, self.poll_queue)
+
+    def start_api(self, port: int = api.DEFAULT_PORT):
+        '''serve the acquisition engine on localhost, for scripts and notebooks next to the gui
+
+        args:
+            port: tcp port
+
+        returns: none
+        '''
+
+        if self.api_server is None:
+            self.api_server = api.serve(self.get_engine(), port=port, scheduler=self.get_scheduler())
+
+    def get_prior_stage(self):
+        # simulated transport in simulation mode so the prior controls work off the rig
+        kind = 'sim' if self.simulation_mode.get() else 'dll'
+        if kind not in self.prior_stages:
+            self.prior_stages[kind] = PriorStage(SimulatedPriorTransport() if kind == 'sim' else None)
+        stage = self.prior_stages[kind]
+        stage.connect(int(self.prior_port_entry.get().strip()))
+        return stage
 
-            ret, response = send_command(f"controller.connect {port}")
-            if ret != 0:
-                messagebox.showerror("Connection Error", f"Could not connect to Prior stage on port COM{port}")
-            
-            ret, response = send_command(f"controller.z.goto-position {z_height}")
-            if ret != 0:
-                messagebox.showerror("Movement Error", f"Could not move Prior stage to {z_height}")
+    def move_prior_stage(self):
+        try:
+            z_height = int(self.prior_z_entry.get().strip())
+            int(self.prior_port_entry.get().strip())
+        except ValueError:
+            messagebox.showerror("Input Error", "Please enter a valid numeric Z height and port.")
+            return
 
-            wait_for_z_motion()
+        if not (0 <= z_height <= 50000):
+            messagebox.showerror("Value Error", "Z height must be between 0 and 50,000 µm.")
+            return
 
-            _, current_pos = send_command("controller.z.position.get")
+        try:
+            stage = self.get_prior_stage()
+        except Exception as e:
+            messagebox.showerror("Connection Error", f"Could not connect to Prior stage on port COM{self.prior_port_entry.get().strip()}: {e}")
+            return
 
-            messagebox.showinfo("Success", f"Moved Prior Stage to {current_pos}.")
+        try:
+            stage.goto_z(z_height)
+            messagebox.showinfo("Success", f"Moved Prior Stage to {stage.get_z()}.")
+        except Exception as e:
+            messagebox.showerror("Movement Error", f"Could not move Prior stage to {z_height}: {e}")
+
+    def autofocus_settings(self):
+        return {'range_um': float(self.entry_af_range.get().strip()), 'metric': self.af_metric_var.get()}
+
+    def rpoc_settings(self):
+        # closed loop mask settings, the channel the mask is made from is the one picked for mask creation
+        names = self.config['channel_names']
+        channel = self.rpoc_channel_var.get()
+        budget = self.entry_rpoc_budget.get().strip()
+        return {
+            'settings': {'method': self.rpoc_method_var.get(), 'channel': names.index(channel) if channel in names else 0},
+            'budget_s': float(budget) / 1e3 if budget else None,
+        }
 
+    def run_autofocus(self):
+        self.autofocus_button.configure(state='disabled')
+        try:
+            result = autofocus.autofocus(self, **self.autofocus_settings())
+            self.prior_z_entry.delete(0, tk.END)
+            self.prior_z_entry.insert(0, str(result['z_um']))
+            print(f"[INFO] Focus at {result['z_um']} um after {result['frames']} frames.")
         except ValueError:
-            messagebox.showerror("Input Error", "Please enter a valid numeric Z height and port.")
+            messagebox.showerror("Input Error", "Please enter a valid numeric focus range.")
+        except Exception as e:
+            messagebox.showerror("Autofocus Error", f"Could not autofocus: {e}")
+        finally:
+            self.autofocus_button.configure(state='normal')
 
     def create_mask(self):
         if self.data is None or len(np.shape(self.data)) != 3:
@@ -547,9 +955,35 @@ class GUI:
 
         selected_image = self.data[channel_index] 
 
+        from pysrs.mains.rpoc2 import RPOC # the editor and its PIL modules load with the first mask
         mask_window = tk.Toplevel(self.root)
         mask_window.title(f'RPOC Mask Editor - {selected_channel}')
-        RPOC(mask_window, image=selected_image) 
+        RPOC(mask_window, image=selected_image, geometry=self.config)
+
+    def auto_mask(self):
+        # otsu on the selected channel of the last frame, with the default cleanup, straight into the loaded mask
+        if self.data is None or len(np.shape(self.data)) != 3:
+            messagebox.showerror("Data Error", "No valid data available. Try acquiring an image first.")
+            return
+
+        selected_channel = self.rpoc_channel_var.get()
+        if selected_channel not in self.config["channel_names"]:
+            messagebox.showerror("Selection Error", "Please select a valid input channel.")
+            return
+
+        channel_index = self.config["channel_names"].index(selected_channel)
+        if channel_index >= np.shape(self.data)[0]:
+            messagebox.showerror("Data Mismatch", f"No data occupies channel {selected_channel}. Try acquiring an image.")
+            return
+
+        try:
+            mask = automask.make_mask(self.data, method='otsu', channel=channel_index)
+        except Exception as e:
+            messagebox.showerror("Mask Error", f"Could not generate mask: {e}")
+            return
+        from PIL import Image
+        self.rpoc_mask = Image.fromarray(mask, 'L')
+        self.mask_file_path.set(f"Auto (Otsu, {selected_channel})")
 
     def update_rpoc_options(self):
         if self.config["channel_names"]:
@@ -571,14 +1005,18 @@ class GUI:
         # load mask button function
         file_path = filedialog.askopenfilename(
             title="Select Mask File",
-            filetypes=[("Mask Files", "*.mask *.json *.txt *.png"), ("All Files", "*.*")]
+            filetypes=[("Mask Files", "*.rmask *.mask *.json *.txt *.png"), ("All Files", "*.*")]
         )
         if file_path:
             filename = os.path.basename(file_path)
             self.mask_file_path.set(filename)
-            # Load and store the mask as a PIL Image:
+            # .rmask stays as runs and compiles straight to TTL, anything else is loaded as a PIL Image:
             try:
-                self.rpoc_mask = Image.open(file_path).convert('L')
+                if file_path.endswith(mask_io.EXTENSION):
+                    self.rpoc_mask = mask_io.load_mask(file_path)
+                else:
+                    from PIL import Image
+                    self.rpoc_mask = Image.open(file_path).convert('L')
             except Exception as e:
                 messagebox.showerror("Mask Error", f"Error loading mask: {e}")
         else:
@@ -586,65 +1024,65 @@ class GUI:
             self.rpoc_mask = None
 
     def update_config(self):
-        for key, entry in self.param_entries.items():
-            value = entry.get().strip()
-            try:
-                if key in ['ao_chans', 'ai_chans', 'channel_names']:
-                    channels = [v.strip() for v in value.split(',') if v.strip()]
-                    if channels != self.config[key]:
-                        self.config[key] = channels
-                        self.show_feedback(entry)
-                        self.update_rpoc_options()
-                        self.create_colorbar_settings()  # Refresh UI for colorbars dynamically
-                elif key == 'zaber_chan':
-                    if value != self.config['zaber_chan']:  
-                        if self.zaber_stage.is_connected():
-                            self.zaber_stage.disconnect()
-                            print(f"[INFO] Disconnected from previous Zaber stage at {self.config['zaber_chan']}.")
-
-                        self.config[key] = value 
-
-                        try:
-                            self.zaber_stage.port = value
-                            self.zaber_stage.connect()
-                            print(f"[INFO] Successfully connected to Zaber stage at {value}.")
-                        except Exception as e:
-                            messagebox.showerror('Connection Error', 
-                                                f'Could not connect to Zaber stage on port {value}.\n'
-                                                f'Make sure the connection is on ASCII protocol in Zaber console.\n\nError: {e}')
-                            return 
-
-                        self.show_feedback(entry)  
-                elif key == 'device':
-                    if value != self.config[key]:
-                        self.config[key] = value
-                        self.show_feedback(entry)
-                elif key in ['amp_x', 'amp_y', 'rate', 'dwell']:
-                    if float(value) != self.config[key]:
-                        self.config[key] = float(value)
-                        self.show_feedback(entry)
-                else:
-                    if int(value) != self.config[key]:
-                        self.config[key] = int(value)
-                        self.show_feedback(entry)
-                        
-            except ValueError:
-                messagebox.showerror('Error', f'Invalid value for {key}. Please check your input.')
-                return  
+        # parse every entry into the config model, tk thread only. workers read gui.config.snapshot() instead
+        if threading.current_thread() is not threading.main_thread():
+            return
+        try:
+            changes = self.config.update({key: entry.get() for key, entry in self.param_entries.items()})
+        except ConfigError as e:
+            messagebox.showerror('Error', f'{e} Please check your input.')
+            return
+
+        for key in changes:
+            if key in self.param_entries:
+                self.show_feedback(self.param_entries[key])
 
         self.update_rpoc_options()
         self.toggle_hyperspectral_fields()
         self.toggle_save_options()
+        self.toggle_zstack_fields()
         self.toggle_rpoc_fields()
 
-            
+    def on_config_change(self, changes):
+        # runs on whichever thread changed the config, widgets are only touched from the tk thread
+        if threading.current_thread() is not threading.main_thread():
+            self.root.after(0, self.on_config_change, changes)
+            return
+        if {'ai_chans', 'channel_names'} & set(changes):
+            self.update_rpoc_options()
+            self.create_colorbar_settings()
+        if 'zaber_chan' in changes:
+            threading.Thread(target=self.reconnect_zaber, args=changes['zaber_chan'], daemon=True).start()
+
+    def reconnect_zaber(self, old, new):
+        # off the tk thread, connecting includes homing and a dead port only gives up after the connect timeout
+        try:
+            if self.zaber_stage.is_connected():
+                self.zaber_stage.disconnect()
+                print(f"[INFO] Disconnected from previous Zaber stage at {old}.")
+            self.zaber_stage.port = new
+            self.zaber_stage.connect()
+            print(f"[INFO] Successfully connected to Zaber stage at {new}.")
+        except Exception as e:
+            messagebox.showerror('Connection Error',
+                                f'Could not connect to Zaber stage on port {new}.\n'
+                                f'Make sure the connection is on ASCII protocol in Zaber console.\n\nError: {e}')
+
+    def start_acquisition(self):
+        # commit the entries on the tk thread first, the acquisition thread only reads the config
+        self.update_config()
+        try:
+            focus = acquisition.focus_settings(self) # refocus runs on the engine thread, so no tk reads there
+        except Exception as e:
+            messagebox.showerror('Autofocus Error', f'Could not set up refocusing: {e}')
+            return
+        threading.Thread(target=acquisition.acquire, args=(self,), kwargs={'focus': focus}, daemon=True).start()
+
     def show_feedback(self, widget):
-        local_style = ttk.Style()
-        local_style.configure("Feedback.TEntry", fieldbackground="lightgreen")
+        # the Feedback.TEntry style is configured once in create_widgets
+        widget.configure(style="Feedback.TEntry")
+        self.root.after(500, lambda: widget.configure(style="TEntry"))
 
-        widget.configure(style="Feedback.TEntry")  
-        self.root.after(500, lambda: widget.configure(style="TEntry"))  #
-            
     def browse_save_path(self):
         # open file selector when the file folder emoji is pressed
         filepath = filedialog.asksaveasfilename(
@@ -656,6 +1094,23 @@ class GUI:
             self.save_file_entry.delete(0, tk.END)
             self.save_file_entry.insert(0, filepath)
 
+    def replay_capture(self):
+        if self.acquiring:
+            messagebox.showwarning('Warning', 'Wait for the current acquisition to finish first.')
+            return
+        path = filedialog.askdirectory(title='Select a raw capture folder')
+        if not path:
+            return
+        if not os.path.exists(os.path.join(path, 'capture.json')):
+            messagebox.showerror('Replay Error', 'That folder does not contain a capture.json.')
+            return
+        def run():
+            try:
+                acquisition.replay_capture(self, path)
+            except Exception as e:
+                messagebox.showerror('Replay Error', f'Could not replay capture: {e}')
+        threading.Thread(target=run, daemon=True).start()
+
     def toggle_save_options(self):
         if self.save_acquisitions.get():
             if self.hyperspectral_enabled.get():
@@ -690,6 +1145,17 @@ class GUI:
             self.entry_numshifts.config(state='disabled')
             self.continuous_button.configure(state='normal')
 
+    def toggle_zstack_fields(self):
+        state = 'normal' if self.zstack_enabled.get() else 'disabled'
+        for entry in (self.entry_z_start, self.entry_z_stop, self.entry_z_planes):
+            entry.config(state=state)
+        for entry in self.mosaic_entries:
+            entry.config(state='normal' if self.mosaic_enabled.get() else 'disabled')
+        if self.zstack_enabled.get() or self.mosaic_enabled.get():
+            self.continuous_button.configure(state='disabled')
+        elif not self.hyperspectral_enabled.get() and not self.save_acquisitions.get():
+            self.continuous_button.configure(state='normal')
+
     def toggle_rpoc_fields(self):
         self.update_rpoc_options()  
 
@@ -709,9 +1175,10 @@ class GUI:
         self.fixed_colorbar_vars.clear()
         self.fixed_colorbar_widgets.clear()
 
-        temp = self.config['channel_names']
+        # unnamed inputs are labelled by their channel, the config itself is left alone
+        temp = list(self.config['channel_names'])
         for i, val in enumerate(self.config['ai_chans']):
-            if len(self.config['channel_names']) <= i:
+            if len(temp) <= i:
                 temp.append(val)
 
         for i, ch in enumerate(self.config['ai_chans']):
@@ -745,7 +1212,16 @@ class GUI:
     def close(self):
         # make sure closing the window also stops the code, basically just a cleanup function
         self.running = False
-        self.zaber_stage.disconnect()
+        if self.scheduler is not None:
+            self.scheduler.cancel()
+        elif self.engine is not None:
+            self.engine.cancel()
+        if self.api_server is not None:
+            self.api_server.shutdown()
+        try:
+            self.zaber_stage.disconnect(timeout=2) # a stuck connect or move must not keep the window open
+        except Exception as e:
+            print(f'[WARN] Zaber stage did not disconnect cleanly: {e}')
         self.root.quit()
         self.root.destroy()
         os._exit(0)
\ No newline at end of file
@@ -0,0 +1,123 @@
+import numpy as np
+
+'''
+fixed cost live plotting for long signal monitoring
+
+samples are reduced to a min/max pair per screen column as they arrive and only those pairs are kept, in a
+ring buffer covering the visible window. every redraw then pushes the same handful of points to matplotlib
+no matter how long the monitor has been running, and short spikes still show up in the envelope.
+'''
+
+
+class RingBuffer:
+    def __init__(self, capacity: int, channels: int = 1, dtype=np.float64, fill=np.nan) -> None:
+        '''fixed size per channel buffer that overwrites its oldest entries
+
+        args:
+            capacity: entries kept per channel
+            channels: number of channels
+            dtype: storage type
+            fill: value of slots that have not been written yet
+
+        returns: none
+        '''
+
+        self.capacity = capacity
+        self.data = np.full((channels, capacity), fill, dtype=dtype)
+        self.head = 0 # next slot to write
+        self.count = 0 # total entries ever written
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def extend(self, block) -> None:
+        block = np.atleast_2d(block)
+        n = block.shape[1]
+        if n >= self.capacity: # only the newest capacity entries can survive anyway
+            self.data[:] = block[:, -self.capacity:]
+            self.head = 0
+        else:
+            first = min(n, self.capacity - self.head)
+            self.data[:, self.head:self.head + first] = block[:, :first]
+            self.data[:, :n - first] = block[:, first:]
+            self.head = (self.head + n) % self.capacity
+        self.count += n
+
+    def ordered(self) -> np.ndarray:
+        # oldest to newest, always capacity long so the plot arrays never change size
+        return np.roll(self.data, -self.head, axis=1)
+
+
+class LiveTrace:
+    def __init__(self, ax, labels: list, rate: float, window_s: float = 10, width_px: int = None) -> None:
+        '''scrolling min/max envelope plot of one or more channels
+
+        args:
+            ax: matplotlib axes to draw on
+            labels: one legend label per channel
+            rate: sample rate in Hz
+            window_s: seconds of history on screen
+            width_px: number of envelope columns, defaults to the axes width in pixels
+
+        returns: none
+        '''
+
+        self.ax = ax
+        self.rate = rate
+        self.window_s = window_s
+        self.channels = len(labels)
+        width_px = width_px or max(100, int(ax.bbox.width))
+        self.samples_per_bin = max(1, int(np.ceil(window_s * rate / width_px)))
+        self.nbins = int(np.ceil(window_s * rate / self.samples_per_bin))
+        self.mins = RingBuffer(self.nbins, self.channels)
+        self.maxs = RingBuffer(self.nbins, self.channels)
+        self.carry = np.empty((self.channels, 0)) # samples that do not fill a whole column yet
+        self.samples = 0
+        self.lines = [ax.plot([], [], label=label, linewidth=0.8)[0] for label in labels]
+        self.ylim = None
+
+    def extend(self, data) -> None:
+        '''add new samples, cost only depends on how many came in
+
+        args:
+            data: (channels, n) array, or (n,) for a single channel
+
+        returns: none
+        '''
+
+        data = np.asarray(data, dtype=float).reshape(self.channels, -1)
+        self.samples += data.shape[1]
+        if self.carry.shape[1]:
+            data = np.concatenate([self.carry, data], axis=1)
+        full = data.shape[1] // self.samples_per_bin * self.samples_per_bin
+        if full:
+            bins = data[:, :full].reshape(self.channels, -1, self.samples_per_bin)
+            self.mins.extend(bins.min(axis=2))
+            self.maxs.extend(bins.max(axis=2))
+        self.carry = data[:, full:]
+
+    def draw(self) -> None:
+        '''push the envelope to the lines and scroll the axes, no relim over the history
+
+        args: none
+
+        returns: none
+        '''
+
+        t_end = (self.samples - self.carry.shape[1]) / self.rate
+        bin_s = self.samples_per_bin / self.rate
+        t = t_end - bin_s * np.arange(self.nbins, 0, -1)
+        x = np.repeat(t, 2)
+        lo, hi = self.mins.ordered(), self.maxs.ordered()
+        for ch, line in enumerate(self.lines):
+            line.set_data(x, np.column_stack([lo[ch], hi[ch]]).ravel()) # vertical stroke per column spans min to max
+
+        self.ax.set_xlim(max(0, t_end - self.window_s), max(t_end, self.window_s))
+        if len(self.mins):
+            ymin, ymax = np.nanmin(lo), np.nanmax(hi)
+            pad = 0.05 * (ymax - ymin) or 1e-3
+            # only rescale when the envelope leaves the current limits or shrinks a lot, so the axes do not jitter
+            if (self.ylim is None or ymin < self.ylim[0] or ymax > self.ylim[1]
+                    or (ymax - ymin) < 0.25 * (self.ylim[1] - self.ylim[0])):
+                self.ylim = (ymin - pad, ymax + pad)
+                self.ax.set_ylim(*self.ylim)
@@ -1,8 +1,12 @@
 import nidaqmx
 from nidaqmx.constants import AcquisitionType
+from nidaqmx.stream_readers import AnalogSingleChannelReader
 import numpy as np
 import matplotlib.pyplot as plt
 import time
+from pysrs.aaaa.gui.live_trace import LiveTrace
+from pysrs.aaaa.acquisition.recorder import record_stream
+from pysrs.aaaa.acquisition.noise import analyze_channels
 
 class LockIn:
     def __init__(self, device: str, ai_chan: str, sampling_rate: float = 1e6, config: dict = {}, **kwargs):
@@ -24,25 +28,83 @@ class LockIn:
         self.__dict__.update(kwargs)
 
         self.name = self.device + '/' + self.ai_chan
+        self.task = None
 
-    def show_live(self, duration: float = 10):
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self) -> None:
+        '''keep a task open so repeated short reads skip the task setup cost
+
+        args: none
+
+        returns: none
+        '''
+
+        if self.task is not None:
+            return
+        self.task = nidaqmx.Task()
+        self.task.ai_channels.add_ai_voltage_chan(self.name)
+
+    def close(self) -> None:
+        '''release the task held open by open()
+
+        args: none
+
+        returns: none
+        '''
+
+        if self.task is not None:
+            self.task.close()
+            self.task = None
+
+    def read_burst(self, num_samples: int = 1000) -> np.ndarray:
+        '''read a short finite burst of samples, meant for point measurements like calibration
+
+        args:
+            num_samples: number of samples to take at self.sampling_rate
+
+        returns: 1D array of the burst
+        '''
+
+        task = self.task if self.task is not None else nidaqmx.Task()
+        try:
+            if self.task is None:
+                task.ai_channels.add_ai_voltage_chan(self.name)
+            task.timing.cfg_samp_clk_timing(
+                rate=self.sampling_rate,
+                sample_mode=AcquisitionType.FINITE,
+                samps_per_chan=num_samples
+            )
+            task.start()
+            data = task.read(number_of_samples_per_channel=num_samples,
+                             timeout=num_samples / self.sampling_rate + 1)
+            task.stop()
+        finally:
+            if self.task is None:
+                task.close()
+        return np.asarray(data)
+
+    def show_live(self, duration: float = 10, window: float = 10):
         '''show live data collected from the arbitrary input
 
         args:
             duration: amount of time to collect live data for
+            window: seconds of history kept on screen
 
         returns: none
         '''
 
-        num_samples = int(self.duration * self.sampling_rate)
+        num_samples = int(duration * self.sampling_rate)
         counter = 0
 
-        times = []
-        data = []
-
         plt.ion()
         fig, ax = plt.subplots()
-        line, = ax.plot([], [], label=self.name)
+        trace = LiveTrace(ax, [self.name], self.sampling_rate, window_s=window)
         ax.set_xlabel('Time, s')
         ax.set_ylabel('Voltage, V')
         ax.set_title(f'Real Time Data from {self.name}')
@@ -61,42 +123,33 @@ class LockIn:
             tic = time.time()
 
             while counter < num_samples:
-                toc = time.time() - tic
-                chunk = int(min(self.sampling_rate * toc, num_samples - counter))
+                available = task.in_stream.avail_samp_per_chan
+                chunk = int(min(available, num_samples - counter))
                 if chunk > 0:
-                    dt = task.read(number_of_samples_per_channel=chunk)
+                    trace.extend(task.read(number_of_samples_per_channel=chunk))
                     counter += chunk
+                    trace.draw()
+                plt.pause(0.01)
 
-                    current = np.linspace(counter / self.sampling_rate, 
-                                          (counter + chunk) / self.sampling_rate, 
-                                          chunk, endpoint = False)
-                    times.extend(current)
-                    data.extend(dt)
-
-                    line.set_xdata(times)
-                    line.set_ydata(data)
-                    ax.relim()
-                    ax.autoscale_view()
-                    plt.pause(0.01)
-                
             task.stop()
 
         plt.ioff()
-        toc = time.time() - tic
-        print(f'acquisition done in {toc-tic} s')
+        print(f'acquisition done in {time.time() - tic} s')
         plt.show()
 
-    def collect(self) -> np.ndarray:
+    def collect(self, chunk_s: float = 0.1) -> np.ndarray:
         '''skeleton function for collecting data, modeled into acquisition
         
-        args: none
-        
+        args:
+            chunk_s: seconds per read, samples land in one preallocated array instead of a single long read
+
         returns: 2D array, arr[0] is the times and arr[1] is corresponding data
         '''
 
         num_samples = int(self.duration * self.sampling_rate)
-        times = np.linspace(0, self.duration, num_samples)
-        data = []
+        times = np.arange(num_samples) / self.sampling_rate
+        data = np.empty(num_samples)
+        chunk = max(1, int(chunk_s * self.sampling_rate))
 
         with nidaqmx.Task() as task:
             task.ai_channels.add_ai_voltage_chan(self.name)
@@ -105,28 +158,58 @@ class LockIn:
                 sample_mode=AcquisitionType.FINITE,
                 samps_per_chan=num_samples
             )
+            reader = AnalogSingleChannelReader(task.in_stream)
 
             print(f"taking {num_samples} samples from {self.name} at {self.sampling_rate} hz")
             task.start()
-            time.sleep(self.duration + 0.1) # buffer to make sure the task is actually done
-            data = task.read(number_of_samples_per_channel=num_samples, timeout=1)
+            for start in range(0, num_samples, chunk):
+                count = min(chunk, num_samples - start)
+                reader.read_many_sample(data[start:start + count], number_of_samples_per_channel=count,
+                                        timeout=10 * chunk_s + 1)
             task.stop()
 
         print("Data collection complete")
-        return times, np.array(data)
+        return times, data
+
+    def record(self, path, duration: float = None, summary_factor: int = None, **kwargs) -> str:
+        '''stream this channel to disk for recordings too long to hold in memory, see recorder.record_stream
+
+        args:
+            path: raw output file, open it again with recorder.load_recording
+            duration: seconds to record, defaults to self.duration
+            summary_factor: samples per min/mean/max summary point
+            kwargs: passed on to record_stream (chunk_s, progress, stop, ...)
+
+        returns: path
+        '''
+
+        duration = self.duration if duration is None else duration
+        return record_stream(self.device, [self.ai_chan], self.sampling_rate, duration, path,
+                             summary_factor=summary_factor, **kwargs)
 
 
 if __name__ == '__main__':
-    lockin = LockIn('Dev1', 'ai1', sampling_rate=200, duration=1)
-    times, data = lockin.collect()
-    other = LockIn('Dev1', 'ai0', sampling_rate=200, duration=1)
-    times2, data2 = other.collect()
-
-    plt.plot(times, data, label='ai1', color='black')
-    plt.plot(times2, data2, label='ai0 (nothing useful)', color='red')
-    plt.xlabel('Time, s')
-    plt.ylabel('Voltage, V')
-    plt.title('long-time comparison of lockin BG with unoccupied channel')
-    plt.grid(True)
-    plt.legend()
-    plt.show()
\ No newline at end of file
+    # lock-in background against an unconnected channel, streamed so the record can be as long as needed
+    analyzer = analyze_channels('Dev1', ['ai1', 'ai0'], rate=200, duration=60, nperseg=1024,
+                                bands=[(0.1, 1), (1, 10), (10, 100)])
+    for channel, metrics in analyzer.summary().items():
+        print(channel)
+        for key, value in metrics.items():
+            print(f'    {key}: {value:.4g}')
+
+    freqs, psd = analyzer.welch.psd()
+    taus, adev = analyzer.allan.deviation()
+    fig, (ax_psd, ax_adev) = plt.subplots(1, 2, figsize=(11, 4))
+    for i, (label, color) in enumerate([('ai1', 'black'), ('ai0 (nothing useful)', 'red')]):
+        ax_psd.loglog(freqs[1:], np.sqrt(psd[i, 1:]), label=label, color=color)
+        ax_adev.loglog(taus, adev[i], 'o-', label=label, color=color)
+    ax_psd.set_xlabel('Frequency, Hz')
+    ax_psd.set_ylabel('Noise density, V/rtHz')
+    ax_adev.set_xlabel('Averaging time, s')
+    ax_adev.set_ylabel('Allan deviation, V')
+    for ax in (ax_psd, ax_adev):
+        ax.grid(True, which='both')
+        ax.legend()
+    fig.suptitle('lockin BG vs unoccupied channel')
+    plt.tight_layout()
+    plt.show()
@@ -1,9 +1,5 @@
-import nidaqmx
-from nidaqmx.constants import AcquisitionType
 import numpy as np
 import time
-import matplotlib.pyplot as plt
-from PIL import Image
 
 class Galvo: 
     def __init__(self, config: dict = {}, amp_x: float = 0.5, amp_y: float = 0.5, numsteps_x: int = 100, numsteps_y: int = 100,
@@ -65,6 +61,48 @@ class Galvo:
         composite = np.vstack([x_waveform, y_waveform])
 
         return composite
+
+    def ttl_waveform(self, mask, threshold: int = 128, out: np.ndarray = None) -> np.ndarray:
+        '''compile an rpoc mask into a per sample TTL pattern on the raster clock
+
+        args:
+            mask: 2D array, either frame sized (numsteps_y, numsteps_x) or raster sized (total_y, total_x)
+            threshold: mask values above this turn the line on
+            out: optional preallocated bool array of total_samples to write into, for double buffering in live loops
+
+        returns: bool array of total_samples, padding columns are always off
+        '''
+
+        mask = np.asarray(mask)
+        if mask.shape == (self.numsteps_y, self.numsteps_x):
+            on = np.zeros((self.total_y, self.total_x), dtype=bool)
+            on[:, self.extrasteps_left:self.extrasteps_left + self.numsteps_x] = mask > threshold
+        elif mask.shape == (self.total_y, self.total_x):
+            on = mask > threshold
+        else:
+            raise ValueError(f'Mask is {mask.shape}, expected {(self.numsteps_y, self.numsteps_x)} or {(self.total_y, self.total_x)}.')
+
+        if out is None:
+            out = np.empty(self.total_samples, dtype=bool)
+        # every pixel held for pixel_samples samples, one broadcast write instead of a repeat per row
+        out.reshape(-1, self.pixel_samples)[:] = on.reshape(-1, 1)
+        return out
+
+    def park(self, x: float = 0.0, y: float = 0.0) -> None:
+        '''hold the galvos at a fixed point, e.g. for point measurements without scanning
+
+        args:
+            x, y: position in V relative to the galvo offsets
+
+        returns: none
+        '''
+
+        import nidaqmx # only needed on the rig, Galvo itself is used offline for replays and masks
+        with nidaqmx.Task() as task:
+            for chan in self.ao_chans:
+                task.ao_channels.add_ao_voltage_chan(f'{self.device}/{chan}')
+            task.write([self.offset_x + x, self.offset_y + y], auto_start=True) # same [x, y] order as the raster waveform
+            task.wait_until_done(timeout=1)
     
 
     @staticmethod
@@ -1,18 +1,109 @@
-from prior_stage.coordinator import send_command
+from pysrs.aaaa.instruments.prior_stage.coordinator import SimulatedPriorTransport, default_transport, parse_response
 import time
 
-def wait_for_z_motion():
-    while True:
-        _, response = send_command("controller.z.busy.get")
-
-        if response:
-            try:
-                status = int(response)
-                if status == 0:
-                    break  
-            except ValueError:
-                print(f"Invalid response from controller: '{response}'")
-        else:
-            print("No response from controller, is it connected?")
-
-        time.sleep(0.1)  
\ No newline at end of file
+class PriorStage:
+    def __init__(self, transport=None, port: int = None) -> None:
+        '''create an object for the Prior ProScan stage (focus z and xy)
+
+        args:
+            transport: DLLTransport on the rig, SimulatedPriorTransport anywhere else, defaults to the shared dll transport
+            port: COM port number to connect to right away, e.g. 4
+
+        returns: none
+        '''
+
+        self.transport = transport if transport is not None else default_transport()
+        self.port = None
+        if port is not None:
+            self.connect(port)
+
+    def query(self, command: str):
+        '''send a command and parse the reply, raising instead of printing on errors
+
+        args:
+            command: sdk command string
+
+        returns: parsed response, see coordinator.parse_response
+        '''
+
+        ret, response = self.transport.cmd(command)
+        if ret != 0:
+            raise RuntimeError(f"Prior command '{command}' failed (Return Code: {ret})")
+        return parse_response(response)
+
+    def connect(self, port: int) -> None:
+        if self.port == port:
+            return
+        if self.port is not None:
+            self.disconnect()
+        self.query(f"controller.connect {port}")
+        self.port = port
+
+    def disconnect(self) -> None:
+        if self.port is not None:
+            self.query("controller.disconnect")
+            self.port = None
+
+    def get_z(self) -> int:
+        return self.query("controller.z.position.get")
+
+    def get_xy(self) -> tuple:
+        return self.query("controller.stage.position.get")
+
+    def goto_z(self, z: int, wait: bool = True, timeout: float = 30) -> None:
+        '''move the focus, optionally returning right away so other work overlaps the move
+
+        args:
+            z: target in um
+            wait: block until the move is done
+            timeout: give up waiting after this many seconds
+
+        returns: none
+        '''
+
+        self.query(f"controller.z.goto-position {int(round(z))}")
+        if wait:
+            self.wait_for_z_motion(timeout)
+
+    def goto_xy(self, x: int, y: int, wait: bool = True, timeout: float = 60) -> None:
+        self.query(f"controller.stage.goto-position {int(round(x))} {int(round(y))}")
+        if wait:
+            self.wait_for_xy_motion(timeout)
+
+    def _wait_idle(self, axis: str, timeout: float, min_interval: float, max_interval: float) -> None:
+        # poll fast right after the command (short moves finish in a few ms), then back off so long moves
+        # do not flood the controller, and never sleep past the deadline
+        deadline = time.monotonic() + timeout
+        interval = min_interval
+        while self.query(f"controller.{axis}.busy.get") != 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Prior {axis} still moving after {timeout} s.")
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, max_interval)
+
+    def wait_for_z_motion(self, timeout: float = 30, min_interval: float = 1e-3, max_interval: float = 0.05) -> None:
+        '''block until the focus stops
+
+        args:
+            timeout: give up after this many seconds
+            min_interval, max_interval: first and longest gap between busy polls in s
+
+        returns: none
+        '''
+
+        self._wait_idle('z', timeout, min_interval, max_interval)
+
+    def wait_for_xy_motion(self, timeout: float = 60, min_interval: float = 1e-3, max_interval: float = 0.05) -> None:
+        self._wait_idle('stage', timeout, min_interval, max_interval)
+
+
+def wait_for_z_motion(timeout: float = 30):
+    # kept for older scripts that talk to the module level send_command
+    PriorStage(default_transport()).wait_for_z_motion(timeout)
+
+if __name__ == '__main__':
+    stage = PriorStage(SimulatedPriorTransport(), port=4)
+    tic = time.perf_counter()
+    stage.goto_z(100)
+    print(f'z at {stage.get_z()} um after {time.perf_counter() - tic:.3f} s')
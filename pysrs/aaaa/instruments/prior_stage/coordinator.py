@@ -1,67 +1,186 @@
-from ctypes import WinDLL, create_string_buffer
 import os
+import threading
 import time
+from pathlib import Path
 
-DLL_PATH = r"C:\Users\Lab Admin\Documents\PythonStuff\pysrs\pysrs\instruments\prior_stage\PriorScientificSDK.dll"
-SDKPrior = None
-sessionID = None 
+DLL_PATH = Path(__file__).resolve().parent / 'PriorScientificSDK.dll' # ships next to this file, no hard coded user path
+RX_BUFFER_SIZE = 1000
 
-def initialize_sdk() -> None:
-    '''only useful for send_command(), opens the .dll file to initialize the SDK via WinDLL
+# sdk return codes from errors.h
+PRIOR_OK = 0
+PRIOR_UNRECOGNISED_COMMAND = -10001
+PRIOR_NOTCONNECTED = -10004
+PRIOR_INVALID_PARAMETERS = -10007
 
-    args: none
 
-    returns: non
-    '''
-
-    global SDKPrior, sessionID
+def parse_response(response: str):
+    '''turn an sdk response string into python values, the one place that knows the reply formats
 
-    if SDKPrior is None:
-        if os.path.exists(DLL_PATH):
-            SDKPrior = WinDLL(DLL_PATH)
-        else:
-            raise RuntimeError("DLL could not be loaded.")
+    args:
+        response: raw reply text, e.g. '0', '1200', '1500,-300'
 
-        ret = SDKPrior.PriorScientificSDK_Initialise()  
-        if ret != 0:
-            raise RuntimeError(f"Failed to initialize Prior SDK. Error code: {ret}")
-
-        print("Prior SDK Initialized.")
+    returns: int, tuple of ints for comma separated replies, or the stripped string if it is not numeric
+    '''
 
-    if sessionID is None:
-        sessionID = SDKPrior.PriorScientificSDK_OpenNewSession()
-        if sessionID < 0:
-            raise RuntimeError(f"Failed to open Prior SDK session. SessionID: {sessionID}")
+    response = response.strip()
+    try:
+        if ',' in response:
+            return tuple(int(v) for v in response.split(','))
+        return int(response)
+    except ValueError:
+        return response
+
+
+class DLLTransport:
+    def __init__(self, dll_path=None) -> None:
+        '''talks to the controller through the Prior SDK dll, windows only
+
+        args:
+            dll_path: path to PriorScientificSDK.dll, defaults to the copy in this folder
+
+        returns: none
+        '''
+
+        self.dll_path = Path(os.environ.get('PRIOR_SDK_DLL', dll_path or DLL_PATH))
+        self.sdk = None
+        self.session = None
+        self.rx = None
+        self.lock = threading.Lock() # the pooled rx buffer is shared, so one command at a time
+
+    def open(self) -> None:
+        if self.sdk is None:
+            from ctypes import WinDLL, create_string_buffer # imported here so the package loads on linux
+            if not self.dll_path.exists():
+                raise RuntimeError(f"DLL could not be loaded from {self.dll_path}.")
+            self.sdk = WinDLL(str(self.dll_path))
+            ret = self.sdk.PriorScientificSDK_Initialise()
+            if ret != 0:
+                self.sdk = None
+                raise RuntimeError(f"Failed to initialize Prior SDK. Error code: {ret}")
+            self.rx = create_string_buffer(RX_BUFFER_SIZE) # allocated once and reused for every reply
+            print("Prior SDK Initialized.")
+
+        if self.session is None:
+            session = self.sdk.PriorScientificSDK_OpenNewSession()
+            if session < 0:
+                raise RuntimeError(f"Failed to open Prior SDK session. SessionID: {session}")
+            self.session = session
+            print(f"SDK Session Opened. Session ID: {session}")
+
+    def cmd(self, command: str) -> tuple[int, str]:
+        self.open()
+        with self.lock:
+            self.rx[0] = b'\0'
+            ret = self.sdk.PriorScientificSDK_cmd(self.session, command.encode(), self.rx)
+            return ret, self.rx.value.decode().strip()
+
+    def close(self) -> None:
+        if self.session is not None:
+            self.sdk.PriorScientificSDK_CloseSession(self.session)
+            self.session = None
+
+
+class SimulatedPriorTransport:
+    def __init__(self, z_speed: float = 2000, xy_speed: float = 10000) -> None:
+        '''stand-in for the sdk that runs anywhere, moves take distance / speed of real time
+
+        args:
+            z_speed: simulated focus speed in um/s
+            xy_speed: simulated stage speed in um/s
+
+        returns: none
+        '''
+
+        self.z_speed = z_speed
+        self.xy_speed = xy_speed
+        self.connected = False
+        self.axes = {'z': self._axis((0,)), 'stage': self._axis((0, 0))}
+        self.lock = threading.Lock()
+        self.log = [] # every command sent, for checking what the controller was asked to do
+
+    @staticmethod
+    def _axis(position):
+        return {'start': position, 'target': position, 't0': 0.0, 'duration': 0.0}
+
+    def _position(self, axis):
+        a = self.axes[axis]
+        frac = 1.0 if a['duration'] == 0 else min(1.0, (time.monotonic() - a['t0']) / a['duration'])
+        return tuple(round(s + (t - s) * frac) for s, t in zip(a['start'], a['target']))
+
+    def _goto(self, axis, target, speed):
+        start = self._position(axis)
+        distance = max(abs(t - s) for s, t in zip(start, target))
+        self.axes[axis] = {'start': start, 'target': target, 't0': time.monotonic(), 'duration': distance / speed}
+
+    def cmd(self, command: str) -> tuple[int, str]:
+        with self.lock:
+            self.log.append(command)
+            words = command.split()
+            if not words:
+                return PRIOR_UNRECOGNISED_COMMAND, ''
+            if words[0] == 'controller.connect':
+                self.connected = True
+                return PRIOR_OK, '0'
+            if not self.connected:
+                return PRIOR_NOTCONNECTED, ''
+            if words[0] == 'controller.disconnect':
+                self.connected = False
+                return PRIOR_OK, '0'
+
+            parts = words[0].split('.')
+            if len(parts) < 3 or parts[1] not in self.axes:
+                return PRIOR_UNRECOGNISED_COMMAND, ''
+            axis, action = parts[1], '.'.join(parts[2:])
+            speed = self.z_speed if axis == 'z' else self.xy_speed
+            try:
+                if action == 'goto-position':
+                    self._goto(axis, tuple(int(v) for v in words[1:]), speed)
+                    return PRIOR_OK, '0'
+                if action == 'move-relative':
+                    current = self._position(axis)
+                    self._goto(axis, tuple(c + int(v) for c, v in zip(current, words[1:])), speed)
+                    return PRIOR_OK, '0'
+            except (ValueError, TypeError):
+                return PRIOR_INVALID_PARAMETERS, ''
+            if action == 'position.get':
+                return PRIOR_OK, ','.join(str(v) for v in self._position(axis))
+            if action == 'busy.get':
+                return PRIOR_OK, '0' if self._position(axis) == self.axes[axis]['target'] else '1'
+            return PRIOR_UNRECOGNISED_COMMAND, ''
+
+    def close(self) -> None:
+        self.connected = False
+
+
+_default_transport = None
+
+def default_transport():
+    global _default_transport
+    if _default_transport is None:
+        _default_transport = DLLTransport()
+    return _default_transport
 
-        print(f"SDK Session Opened. Session ID: {sessionID}")
 
 def send_command(command: str) -> tuple[int, str]:
-    '''main function to send any command to the stage
-    
-    args: none
+    '''main function to send any command to the stage, kept for scripts that do not use PriorStage
 
-    returns: none
-    '''
-
-    initialize_sdk()  # error code -10200 heheheheheehruiaewrgilaeuwblaiewjghlkajgbla,knja,ekjb
+    args:
+        command: sdk command string, e.g. 'controller.z.position.get'
 
-    rx = create_string_buffer(1000)
-    ret = SDKPrior.PriorScientificSDK_cmd(
-        sessionID, create_string_buffer(command.encode()), rx
-    )
-    response = rx.value.decode().strip()
+    returns: (sdk return code, response string)
+    '''
 
+    ret, response = default_transport().cmd(command)
     if ret != 0:
         print(f"Error executing command: {command} (Return Code: {ret})")
-
     return ret, response
 
 if __name__ == "__main__":
     print("connecting")
     send_command("controller.connect 4")
 
-    send_command(f"controller.z.goto-position 10000") 
-    _, current_pos = send_command("controller.z.position.get") 
+    send_command(f"controller.z.goto-position 10000")
+    _, current_pos = send_command("controller.z.position.get")
     print(f"z pos after move: {current_pos}")
 
     print("disconnectiong")
@@ -1,91 +1,350 @@
 import numpy as np
-from zaber_motion import Units
-from zaber_motion.ascii import Connection
 import concurrent.futures
+import threading
+import time
+
+# zaber_motion loads its native library on import (a few hundred ms), so it is only imported by the first
+# connect, on the stage worker. everything that uses these names runs on the worker after that
+Units = None
+Connection = None
+RECONNECT_ERRORS = ()
+TRAVEL_UM = 1e5 # longest possible move, assumed when the start position is not known
+CONNECT_TIMEOUT_S = 60 # opening the port plus a full homing run, well over the homing time at the default speed
+MIN_POLL_S, MAX_POLL_S = 1e-3, 0.02 # settle polling, fast at first then backing off so the port is not flooded
+
+
+def load_zaber_motion() -> None:
+    global Units, Connection, RECONNECT_ERRORS
+    if Connection is not None:
+        return
+    from zaber_motion import Units, ConnectionClosedException, ConnectionFailedException, RequestTimeoutException
+    from zaber_motion.ascii import Connection
+    RECONNECT_ERRORS = (ConnectionClosedException, ConnectionFailedException, RequestTimeoutException)
 
 class ZaberStage:
-    def __init__(self, port: str) -> None:
-        '''create an object for the zaber stage
+    def __init__(self, port: str, timeout: float = 10, position_max_age: float = 0.5) -> None:
+        '''create an object for the zaber stage, this is a long lived session so create it once and reuse it
 
-        args: 
+        args:
             port: str, COM port for the stage, e.g. 'COM3'
-            
+            timeout: default time to wait on blocking calls before giving up
+            position_max_age: seconds a cached position is trusted before the stage is asked again
+
         returns: none
         '''
 
         self.port = port
+        self.timeout = timeout
+        self.position_max_age = position_max_age
         self.connection = None
         self.device = None
         self.axis = None
+        self.devices = []
+
+        # every serial command runs on this one worker so commands never interleave and callers never block on the port
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='zaber')
+        self._cache_lock = threading.Lock()
+        self._position_um = None
+        self._position_time = 0.0
+
+        self.motion_profiles = None # MotionProfileTable from zaber_tuning, applied per step size when set
+        self._applied_profile = None
+        self._speed_mm_s = None # max speed in use, read on connect, sizes the move timeouts
+
+    def is_connected(self) -> bool:
+        return self.connection is not None and self.axis is not None
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        '''run any function on the stage worker, reconnecting once if the link dropped
+
+        args:
+            fn: callable to run, it can use self.axis / self.device / self.connection freely
+            args, kwargs: passed to fn
+
+        returns: future with the result of fn
+        '''
 
-    def connect(self, timeout: int = 10) -> None:
-        '''connect to the zaber stage in a threaded process
-        
-        args: 
-            timeout: time to wait before giving up on connection
+        return self._executor.submit(self._run, fn, *args, **kwargs)
+
+    def _run(self, fn, *args, **kwargs):
+        self._connect()
+        try:
+            return fn(*args, **kwargs)
+        except RECONNECT_ERRORS:
+            self._reset() # the port went away (cable, power cycle), reopen and try once more
+            self._connect()
+            return fn(*args, **kwargs)
+
+    def connect(self, timeout: float = CONNECT_TIMEOUT_S) -> None:
+        '''connect to the zaber stage, does nothing if the session is already open
+
+        args:
+            timeout: time to wait before giving up on connection, long enough for the stage to home. none
+                waits however long it takes
 
         returns: none
         '''
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor: # failed attempt to get it to not crash if it cant connect
-            future = executor.submit(self._connect)
-            future.result(timeout=timeout)
+        self._executor.submit(self._connect).result(timeout=timeout)
+
+    def call_timeout(self):
+        # the default timeout once a session is open, none before since the worker connects (and maybe homes) first
+        return self.timeout if self.is_connected() else None
+
+    def move_timeout(self, position_um: float):
+        '''how long a move to position_um may take before the caller gives up
+
+        args:
+            position_um: target in micrometers
+
+        returns: seconds, the default timeout plus twice the travel time at the current max speed, or none
+            while no session is open since the worker connects (and maybe homes) first
+        '''
+
+        if not self.is_connected() or not self._speed_mm_s:
+            return None
+        with self._cache_lock:
+            start = self._position_um
+        distance_um = TRAVEL_UM if start is None else abs(position_um - start)
+        return self.timeout + 2 * distance_um * 1e-3 / self._speed_mm_s
 
     def _connect(self) -> None:
-        '''helper method for connection to the zaber stage
+        '''helper method for connection to the zaber stage, only ever runs on the worker
 
         args: none
 
-        returns: none        
+        returns: none
         '''
 
         if self.connection is not None:
             return  # do not attempt a reconnect if already connected
-        
+
+        load_zaber_motion()
         self.connection = Connection.open_serial_port(self.port)
         self.connection.enable_alerts()
-        devices = self.connection.detect_devices()
-        if not devices:
+        self.devices = self.connection.detect_devices()
+        if not self.devices:
+            self._reset()
             raise RuntimeError("No Zaber devices found.")
-        
-        self.device = devices[0]
+
+        self.device = self.devices[0]
         self.axis = self.device.get_axis(1)
-        if not self.axis.is_homed():
+        if not self.axis.is_homed(): # only checked when a session is opened, not on every call
             self.axis.home()
+        self._speed_mm_s = self.axis.settings.get('maxspeed', Units.VELOCITY_MILLIMETRES_PER_SECOND)
 
-    def move_absolute_um(self, position_um: int) -> None:
-        '''move the zaber stage in micrometers
-        
-        args: 
-            position_um: location to move the stage to in micrometers, max 1e5
+    def _reset(self) -> None:
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+        self.device = None
+        self.axis = None
+        self.devices = []
+        with self._cache_lock:
+            self._position_um = None
+        self._applied_profile = None
+
+    def _cache_position(self, position_um: float) -> None:
+        with self._cache_lock:
+            self._position_um = position_um
+            self._position_time = time.monotonic()
+
+    def _apply_profile(self, speed_mm_s: float, accel_mm_s2: float) -> None:
+        if self._applied_profile == (speed_mm_s, accel_mm_s2):
+            return # skip the two serial writes when nothing changes, which is every step of a uniform scan
+        self.axis.settings.set('maxspeed', speed_mm_s, Units.VELOCITY_MILLIMETRES_PER_SECOND)
+        self.axis.settings.set('accel', accel_mm_s2, Units.ACCELERATION_MILLIMETRES_PER_SECOND_SQUARED)
+        self._applied_profile = (speed_mm_s, accel_mm_s2)
+        self._speed_mm_s = speed_mm_s
+
+    def set_motion_profile(self, speed_mm_s: float, accel_mm_s2: float) -> None:
+        '''set the max speed and acceleration used for following moves
+
+        args:
+            speed_mm_s: max speed in mm/s
+            accel_mm_s2: acceleration in mm/s^2
 
         returns: none
         '''
 
-        if self.axis is None:
-            self.connect()
-        position_mm = position_um * 1e-3
-        self.axis.move_absolute(position_mm, Units.LENGTH_MILLIMETRES)
+        self.submit(self._apply_profile, speed_mm_s, accel_mm_s2).result(timeout=self.call_timeout())
+
+    def get_motion_profile(self) -> tuple:
+        '''read the current max speed and acceleration from the device
+
+        args: none
+
+        returns: (speed in mm/s, accel in mm/s^2)
+        '''
+
+        def read():
+            return (self.axis.settings.get('maxspeed', Units.VELOCITY_MILLIMETRES_PER_SECOND),
+                    self.axis.settings.get('accel', Units.ACCELERATION_MILLIMETRES_PER_SECOND_SQUARED))
+        return self.submit(read).result(timeout=self.call_timeout())
+
+    def get_default_motion_profile(self) -> tuple:
+        '''read the factory default max speed and acceleration, which do not change when a profile is applied
+
+        args: none
+
+        returns: (speed in mm/s, accel in mm/s^2)
+        '''
+
+        def read():
+            return (self.axis.settings.get_default('maxspeed', Units.VELOCITY_MILLIMETRES_PER_SECOND),
+                    self.axis.settings.get_default('accel', Units.ACCELERATION_MILLIMETRES_PER_SECOND_SQUARED))
+        return self.submit(read).result(timeout=self.call_timeout())
+
+    def _move(self, position_um: float) -> float:
+        if self.motion_profiles is not None and self._position_um is not None:
+            profile = self.motion_profiles.lookup(abs(position_um - self._position_um))
+            if profile is not None:
+                self._apply_profile(*profile)
+        self.axis.move_absolute(position_um * 1e-3, Units.LENGTH_MILLIMETRES)
         self.axis.wait_until_idle()
+        self._cache_position(position_um)
+        return position_um
+
+    def move_async(self, position_um: float) -> concurrent.futures.Future:
+        '''start a move without blocking the caller
+
+        args:
+            position_um: location to move the stage to in micrometers, max 1e5
+
+        returns: future that resolves to the target position once the stage is idle there
+        '''
+
+        return self.submit(self._move, position_um)
+
+    def move_absolute_um(self, position_um: float) -> None:
+        '''move the zaber stage in micrometers and wait for it to arrive
+
+        args:
+            position_um: location to move the stage to in micrometers, max 1e5
+
+        returns: none
+        '''
+
+        self.move_async(position_um).result(timeout=self.move_timeout(position_um))
+
+    def _read_position(self) -> float:
+        position_um = self.axis.get_position(Units.LENGTH_MICROMETRES)
+        self._cache_position(position_um)
+        return position_um
+
+    def get_position_um(self, max_age: float = None) -> float:
+        '''current stage position, answered from the cache when it is fresh enough
+
+        args:
+            max_age: seconds a cached value is acceptable for, defaults to self.position_max_age, 0 forces a query
+
+        returns: position in micrometers
+        '''
+
+        max_age = self.position_max_age if max_age is None else max_age
+        with self._cache_lock:
+            if self._position_um is not None and time.monotonic() - self._position_time <= max_age:
+                return self._position_um
+        return self.submit(self._read_position).result(timeout=self.call_timeout())
+
+    def _read_all_positions(self) -> dict:
+        # one 'get pos' broadcast answers for every device on the chain instead of one round trip per axis
+        positions = {}
+        for reply in self.connection.generic_command_multi_response('get pos'):
+            device = next((d for d in self.devices if d.device_address == reply.device_address), None)
+            if device is None:
+                continue
+            for axis_number, value in enumerate(reply.data.split(), start=1):
+                axis = device.get_axis(axis_number)
+                positions[(reply.device_address, axis_number)] = axis.settings.convert_from_native_units(
+                    'pos', float(value), Units.LENGTH_MICROMETRES)
+        key = (self.device.device_address, 1)
+        if key in positions:
+            self._cache_position(positions[key])
+        return positions
+
+    def get_all_positions_um(self) -> dict:
+        '''batched position query across every axis of every connected device
 
-    def disconnect(self) -> None:
+        args: none
+
+        returns: dict of (device address, axis number) -> position in micrometers
+        '''
+
+        return self.submit(self._read_all_positions).result(timeout=self.call_timeout())
+
+    def _measure_settle(self, position_um: float, tolerance_um: float, timeout: float) -> dict:
+        tic = time.perf_counter()
+        self.axis.move_absolute(position_um * 1e-3, Units.LENGTH_MILLIMETRES, wait_until_idle=False)
+        interval = MIN_POLL_S
+        while self.axis.is_busy():
+            if time.perf_counter() - tic > timeout:
+                raise TimeoutError(f'Stage did not stop within {timeout} s.')
+            time.sleep(interval)
+            interval = min(interval * 1.5, MAX_POLL_S)
+        move_s = time.perf_counter() - tic
+
+        # idle is reported at the end of the trajectory, the encoder can still be ringing in after that.
+        # the settle is short, so poll it at the fast rate, still with a sleep between serial round trips
+        position = self.axis.get_position(Units.LENGTH_MICROMETRES)
+        while abs(position - position_um) > tolerance_um:
+            if time.perf_counter() - tic > timeout:
+                raise TimeoutError(f'Stage did not settle within {tolerance_um} um of {position_um} um.')
+            time.sleep(MIN_POLL_S)
+            position = self.axis.get_position(Units.LENGTH_MICROMETRES)
+        total_s = time.perf_counter() - tic
+
+        self._cache_position(position)
+        return {'target_um': position_um, 'final_um': position, 'move_s': move_s,
+                'settle_s': total_s - move_s, 'total_s': total_s}
+
+    def measure_settle_time(self, position_um: float, tolerance_um: float = 0.1, timeout: float = None) -> dict:
+        '''move to a position and time how long the move and the settling take
+
+        args:
+            position_um: target in micrometers
+            tolerance_um: how close the reported position has to be to count as settled
+            timeout: give up after this many seconds, defaults to move_timeout of the target
+
+        returns: dict with target_um, final_um, move_s, settle_s and total_s
+        '''
+
+        timeout = timeout or self.move_timeout(position_um) or self.timeout
+        # the caller waits longer than the worker, which may still have to connect and home
+        wait = None if not self.is_connected() else timeout + 1
+        return self.submit(self._measure_settle, position_um, tolerance_um, timeout).result(timeout=wait)
+
+    def disconnect(self, timeout: float = None) -> None:
         '''cleanly reset and disconnect from the zaber stage
-        
+
+        args:
+            timeout: time to wait for the worker, defaults to self.timeout. a stuck move or connect holds the
+                worker, so this raises TimeoutError instead of returning then
+
+        returns: none
+        '''
+
+        self._executor.submit(self._reset).result(timeout=self.timeout if timeout is None else timeout)
+
+    def close(self) -> None:
+        '''disconnect and stop the worker thread, the object can not be used after this
+
         args: none
-        
+
         returns: none
         '''
 
-        if self.connection:
-            self.connection.close()
-            self.connection = None
+        self.disconnect()
+        self._executor.shutdown(wait=True)
 
 if __name__ == '__main__':
-    config = {
-        'serial': 'COM3', 
-        'num_shifts': 3,  
-        'shift_size': 5,  # mm
-        'shift_offset': 20,  # mm
-    }
-    stage = ZaberStage(config)
-    stage.scan_range()
\ No newline at end of file
+    stage = ZaberStage('COM3')
+    stage.connect()
+    moves = [stage.move_async(pos) for pos in np.linspace(20000, 30000, 3)] # queued back to back on the worker
+    for move in moves:
+        print(f'arrived at {move.result()} um')
+    print(stage.measure_settle_time(25000))
+    stage.close()
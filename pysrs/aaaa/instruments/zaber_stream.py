@@ -0,0 +1,323 @@
+from collections import deque, namedtuple
+import threading
+import time
+
+'''
+zaber ascii protocol layer for controller-side step sequencing
+
+the whole list of delay positions is uploaded once as a stored stream buffer, the controller then
+steps through it on its own (dwell timer or digital handshake with the DAQ) so no host serial round
+trip sits between frames. SimulatedZaberSerial speaks the same ascii lines so this runs off the rig.
+'''
+
+Reply = namedtuple('Reply', ['device', 'axis', 'flag', 'status', 'warning', 'data'])
+
+
+def format_command(device: int, axis: int, command: str) -> bytes:
+    return f'/{device} {axis} {command}\r\n'.encode('ascii')
+
+
+def parse_reply(line) -> Reply:
+    '''parse a zaber ascii reply line, e.g. "@01 0 OK IDLE -- 0"
+
+    args:
+        line: reply as str or bytes
+
+    returns: Reply tuple
+    '''
+
+    if isinstance(line, bytes):
+        line = line.decode('ascii')
+    line = line.strip()
+    if not line.startswith('@'):
+        raise ValueError(f'Not a Zaber reply: {line!r}')
+    parts = line[1:].split(' ', 5)
+    if len(parts) < 5:
+        raise ValueError(f'Truncated Zaber reply: {line!r}')
+    data = parts[5] if len(parts) > 5 else ''
+    return Reply(int(parts[0]), int(parts[1]), parts[2], parts[3], parts[4], data)
+
+
+class SerialTransport:
+    def __init__(self, port, baudrate: int = 115200, timeout: float = 2) -> None:
+        '''raw line transport over a serial port
+
+        args:
+            port: COM port name, or an already open serial-like object with write() and readline() (e.g. the simulator)
+            baudrate: zaber ascii default is 115200
+            timeout: read timeout in s when opening a real port
+
+        returns: none
+        '''
+
+        if isinstance(port, str):
+            import serial # only needed on the rig
+            port = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+        self.port = port
+        self.lock = threading.Lock()
+
+    def query(self, device: int, axis: int, command: str) -> Reply:
+        with self.lock:
+            self.port.write(format_command(device, axis, command))
+            line = self.port.readline()
+        if not line:
+            raise TimeoutError(f'No reply from Zaber device {device} to {command!r}.')
+        return parse_reply(line)
+
+    def close(self) -> None:
+        self.port.close()
+
+
+class ConnectionTransport:
+    def __init__(self, connection) -> None:
+        '''transport that shares an open zaber_motion Connection, e.g. ZaberStage.connection
+
+        args:
+            connection: zaber_motion.ascii.Connection
+
+        returns: none
+        '''
+
+        self.connection = connection
+
+    def query(self, device: int, axis: int, command: str) -> Reply:
+        r = self.connection.generic_command(command, device=device, axis=axis, check_errors=False)
+        return Reply(r.device_address, r.axis_number, r.reply_flag, r.status, r.warning_flag, r.data)
+
+    def close(self) -> None:
+        pass # the connection belongs to whoever opened it
+
+
+class ZaberProtocol:
+    def __init__(self, transport, device: int = 1) -> None:
+        '''command layer on top of a transport, raises on rejected commands
+
+        args:
+            transport: SerialTransport or ConnectionTransport
+            device: device address on the daisy chain
+
+        returns: none
+        '''
+
+        self.transport = transport
+        self.device = device
+
+    def command(self, command: str, axis: int = 0) -> Reply:
+        reply = self.transport.query(self.device, axis, command)
+        if reply.flag != 'OK':
+            raise RuntimeError(f'Zaber rejected {command!r}: {reply.data}')
+        return reply
+
+
+class StreamProgram:
+    def __init__(self, positions_native, stream: int = 1, buffer: int = 1, axis: int = 1,
+                 mode: str = 'trigger', dwell_ms: float = 0, do_channel: int = 1, di_channel: int = 1) -> None:
+        '''a list of stage positions compiled into one stored zaber stream
+
+        args:
+            positions_native: target positions in native units (microsteps), in scan order
+            stream, buffer: stream number used to play and the stored buffer to keep the program in
+            axis: stage axis the stream drives
+            mode: 'dwell' holds each position for dwell_ms, 'trigger' raises do_channel when in position
+                  and waits for a pulse on di_channel (the DAQ's frame done line) before the next step
+            dwell_ms: hold time per step in dwell mode, also used as an extra settle pause in trigger mode
+            do_channel: zaber digital output wired to the DAQ start trigger
+            di_channel: zaber digital input driven by the DAQ when a frame is done
+
+        returns: none
+        '''
+
+        if mode not in ('dwell', 'trigger'):
+            raise ValueError("mode must be 'dwell' or 'trigger'")
+        self.positions = [int(round(p)) for p in positions_native]
+        self.stream = stream
+        self.buffer = buffer
+        self.axis = axis
+        self.mode = mode
+        self.dwell_ms = dwell_ms
+        self.do_channel = do_channel
+        self.di_channel = di_channel
+
+    def compile(self) -> list:
+        '''build the ascii commands that store the program, nothing here talks to the device
+
+        args: none
+
+        returns: list of command strings
+        '''
+
+        s = f'stream {self.stream}'
+        commands = [f'stream buffer {self.buffer} erase', f'{s} setup store {self.buffer} {self.axis}']
+        for pos in self.positions:
+            commands.append(f'{s} line abs {pos}')
+            if self.mode == 'dwell':
+                commands.append(f'{s} wait {self.dwell_ms:g}')
+                continue
+            if self.dwell_ms:
+                commands.append(f'{s} wait {self.dwell_ms:g}')
+            commands += [
+                f'{s} io set do {self.do_channel} 1', # in position, the DAQ starts the frame off this edge
+                f'{s} wait io di {self.di_channel} == 1', # DAQ pulses this once the frame has been read
+                f'{s} io set do {self.do_channel} 0',
+                f'{s} wait io di {self.di_channel} == 0',
+            ]
+        commands.append(f'{s} setup disable')
+        return commands
+
+    def upload(self, protocol: ZaberProtocol) -> None:
+        for command in self.compile():
+            protocol.command(command)
+
+    def start(self, protocol: ZaberProtocol) -> None:
+        protocol.command(f'stream {self.stream} setup live {self.axis}')
+        protocol.command(f'stream {self.stream} call {self.buffer}')
+
+    def stop(self, protocol: ZaberProtocol) -> None:
+        protocol.command(f'stream {self.stream} setup disable')
+        protocol.command(f'io set do {self.do_channel} 0')
+
+
+class SimulatedZaberSerial:
+    def __init__(self, device: int = 1, max_position: int = 2_000_000, step_time: float = 0.0) -> None:
+        '''stand-in for a serial port with a single axis zaber controller on the other end
+
+        args:
+            device: address the simulated controller answers to
+            max_position: travel limit in native units
+            step_time: seconds each stream move takes, 0 for instant
+
+        returns: none
+        '''
+
+        self.device = device
+        self.max_position = max_position
+        self.step_time = step_time
+        self.position = 0
+        self.do = {}
+        self.di = {}
+        self.buffers = {}
+        self.streams = {}
+        self.history = [] # (time, position) for every completed move, handy for checking sequencing
+        self.replies = deque()
+        self.cond = threading.Condition()
+        self.player = None
+        self.busy = False
+
+    def set_digital_input(self, channel: int, value: int) -> None:
+        # the DAQ side of the handshake
+        with self.cond:
+            self.di[channel] = int(value)
+            self.cond.notify_all()
+
+    def write(self, data: bytes) -> int:
+        for line in data.decode('ascii').splitlines():
+            if line.strip():
+                self.replies.append(self.handle(line.strip()))
+        return len(data)
+
+    def readline(self) -> bytes:
+        return self.replies.popleft() if self.replies else b''
+
+    def close(self) -> None:
+        with self.cond:
+            for stream in self.streams.values():
+                stream['mode'] = 'disabled'
+            self.cond.notify_all()
+
+    def reply(self, axis, flag='OK', data='0') -> bytes:
+        status = 'BUSY' if self.busy else 'IDLE'
+        return f'@{self.device:02d} {axis} {flag} {status} -- {data}\r\n'.encode('ascii')
+
+    def handle(self, line: str) -> bytes:
+        if not line.startswith('/'):
+            return self.reply(0, 'RJ', 'BADDATA')
+        parts = line[1:].split()
+        if not parts or int(parts[0]) != self.device:
+            return b''
+        axis = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        words = parts[2:] if len(parts) > 1 and parts[1].isdigit() else parts[1:]
+        try:
+            data = self.execute(words)
+        except (ValueError, IndexError, KeyError):
+            return self.reply(axis, 'RJ', 'BADDATA')
+        if data is None:
+            return self.reply(axis, 'RJ', 'BADCOMMAND')
+        return self.reply(axis, data=data)
+
+    def execute(self, words):
+        with self.cond:
+            if not words:
+                return '0'
+            if words[:2] == ['get', 'pos']:
+                return str(self.position)
+            if words[:2] == ['move', 'abs']:
+                self.move(int(words[2]))
+                return '0'
+            if words[0] == 'home':
+                self.move(0)
+                return '0'
+            if words[:3] == ['io', 'set', 'do']:
+                self.do[int(words[3])] = int(words[4])
+                return '0'
+            if words[:3] == ['io', 'get', 'do']:
+                return str(self.do.get(int(words[3]), 0))
+            if words[:3] == ['io', 'get', 'di']:
+                return str(self.di.get(int(words[3]), 0))
+            if words[:2] == ['stream', 'buffer'] and words[3] == 'erase':
+                self.buffers.pop(int(words[2]), None)
+                return '0'
+            if words[0] != 'stream':
+                return None
+
+            s = int(words[1])
+            stream = self.streams.setdefault(s, {'mode': 'disabled', 'buffer': None})
+            rest = words[2:]
+            if rest[:2] == ['setup', 'store']:
+                self.buffers[int(rest[2])] = []
+                stream.update(mode='store', buffer=int(rest[2]))
+            elif rest[:2] == ['setup', 'live']:
+                stream.update(mode='live', buffer=None)
+            elif rest[:2] == ['setup', 'disable']:
+                stream.update(mode='disabled', buffer=None)
+                self.cond.notify_all()
+            elif rest[0] == 'call':
+                if stream['mode'] != 'live' or int(rest[1]) not in self.buffers:
+                    raise ValueError
+                self.start_player(s, list(self.buffers[int(rest[1])]))
+            elif stream['mode'] == 'store' and rest[0] in ('line', 'wait', 'io'):
+                self.buffers[stream['buffer']].append(rest)
+            else:
+                return None
+            return '0'
+
+    def move(self, position):
+        if not 0 <= position <= self.max_position:
+            raise ValueError
+        self.position = position
+        self.history.append((time.monotonic(), position))
+
+    def start_player(self, s, program):
+        # plays the stored buffer on its own thread, like the controller does, blocking only on waits
+        def play():
+            for action in program:
+                with self.cond:
+                    if self.streams[s]['mode'] != 'live':
+                        return
+                if action[0] == 'line':
+                    self.busy = True
+                    time.sleep(self.step_time)
+                    with self.cond:
+                        self.move(int(action[2]))
+                        self.busy = False
+                elif action[0] == 'wait' and action[1] == 'io':
+                    channel, target = int(action[3]), int(action[5])
+                    with self.cond:
+                        self.cond.wait_for(lambda: self.di.get(channel, 0) == target
+                                           or self.streams[s]['mode'] != 'live')
+                elif action[0] == 'wait':
+                    time.sleep(float(action[1]) / 1000)
+                elif action[:2] == ['io', 'set']:
+                    with self.cond:
+                        self.do[int(action[3])] = int(action[4])
+        self.player = threading.Thread(target=play, daemon=True)
+        self.player.start()
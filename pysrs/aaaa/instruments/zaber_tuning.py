@@ -0,0 +1,145 @@
+import csv
+import json
+import os
+import time
+from pathlib import Path
+import numpy as np
+
+'''
+per step size motion profiles for the zaber delay stage
+
+small spectral steps are dominated by settling, not travel, so the best speed/accel for a 5 um step is
+not the best for a 5 mm step. tune_motion_profiles measures move+settle time over a grid of safe settings,
+keeps the fastest per step size, and ZaberStage applies the matching profile on every move.
+'''
+
+CACHE_DIR = Path.home() / '.pysrs' / 'zaber'
+SPEED_FRACTIONS = (0.25, 0.5, 1.0) # candidates relative to the factory defaults, never above the safe limits
+ACCEL_FRACTIONS = (0.25, 0.5, 1.0)
+
+
+class MotionProfileTable:
+    def __init__(self, entries: list = None, limits: dict = None) -> None:
+        '''lookup of step size -> (speed, accel)
+
+        args:
+            entries: list of dicts with step_um, speed_mm_s, accel_mm_s2 and total_s
+            limits: the speed_mm_s / accel_mm_s2 caps the table was tuned under
+
+        returns: none
+        '''
+
+        self.entries = sorted(entries or [], key=lambda e: e['step_um'])
+        self.limits = limits or {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, step_um: float):
+        '''profile tuned for the closest step size (compared on a log scale)
+
+        args:
+            step_um: size of the upcoming move
+
+        returns: (speed_mm_s, accel_mm_s2), or None if the table is empty
+        '''
+
+        if not self.entries or step_um <= 0:
+            return None
+        steps = np.array([e['step_um'] for e in self.entries])
+        entry = self.entries[int(np.abs(np.log(steps) - np.log(step_um)).argmin())]
+        return entry['speed_mm_s'], entry['accel_mm_s2']
+
+    def save(self, cache_dir=CACHE_DIR) -> Path:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        path = cache_dir / 'motion_profiles.json'
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'saved': time.strftime('%Y-%m-%d %H:%M:%S'), 'limits': self.limits,
+                       'entries': self.entries}, f, indent=2)
+        os.replace(tmp, path)
+        return path
+
+    @classmethod
+    def load_latest(cls, cache_dir=CACHE_DIR):
+        path = Path(cache_dir) / 'motion_profiles.json'
+        if not path.exists():
+            return None
+        try:
+            with open(path) as f:
+                d = json.load(f)
+            return cls(d['entries'], d.get('limits'))
+        except (OSError, KeyError, json.JSONDecodeError) as e:
+            print(f'[WARN] Could not read motion profiles {path}: {e}')
+            return None
+
+
+def save_timings(timings: list, cache_dir=CACHE_DIR) -> Path:
+    # every individual measurement, so the tuning can be looked at again later
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_dir / f"settle_timings_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(timings[0].keys()))
+        writer.writeheader()
+        writer.writerows(timings)
+    return path
+
+
+def tune_motion_profiles(stage, step_sizes_um, center_um: float, max_speed_mm_s: float = None,
+                         max_accel_mm_s2: float = None, repeats: int = 3, tolerance_um: float = 0.1,
+                         progress=None):
+    '''measure move+settle time over a grid of speed/accel settings and keep the fastest per step size
+
+    args:
+        stage: connected ZaberStage
+        step_sizes_um: step sizes to tune for, e.g. the spectral step of a typical scan
+        center_um: position the test moves are made around, pick somewhere inside the usual scan range
+        max_speed_mm_s, max_accel_mm_s2: safe limits, default to the device's factory settings
+        repeats: moves per setting, the median is used
+        tolerance_um: settle tolerance passed to measure_settle_time
+        progress: optional callable(done, total)
+
+    returns: (MotionProfileTable, list of every timing dict)
+    '''
+
+    attached, stage.motion_profiles = stage.motion_profiles, None # the old table must not override the candidates
+    found_profile = stage.get_motion_profile()
+    # the live settings may be a profile from an earlier tuning, capping at those would only ever ratchet down
+    default_speed, default_accel = stage.get_default_motion_profile()
+    max_speed = min(max_speed_mm_s or default_speed, default_speed * max(SPEED_FRACTIONS))
+    max_accel = min(max_accel_mm_s2 or default_accel, default_accel * max(ACCEL_FRACTIONS))
+    speeds = sorted({min(default_speed * f, max_speed) for f in SPEED_FRACTIONS})
+    accels = sorted({min(default_accel * f, max_accel) for f in ACCEL_FRACTIONS})
+
+    timings, entries = [], []
+    total = len(step_sizes_um) * len(speeds) * len(accels) * repeats
+    done = 0
+    try:
+        for step in step_sizes_um:
+            best = None
+            for speed in speeds:
+                for accel in accels:
+                    stage.set_motion_profile(speed, accel)
+                    stage.move_absolute_um(center_um) # every repeat starts from the same place
+                    totals = []
+                    for r in range(repeats):
+                        target = center_um + step if r % 2 == 0 else center_um
+                        t = stage.measure_settle_time(target, tolerance_um=tolerance_um)
+                        totals.append(t['total_s'])
+                        timings.append({'step_um': step, 'speed_mm_s': speed, 'accel_mm_s2': accel, 'repeat': r,
+                                        'move_s': t['move_s'], 'settle_s': t['settle_s'], 'total_s': t['total_s']})
+                        done += 1
+                        if progress is not None:
+                            progress(done, total)
+                    median = float(np.median(totals))
+                    if best is None or median < best['total_s']:
+                        best = {'step_um': step, 'speed_mm_s': speed, 'accel_mm_s2': accel, 'total_s': median}
+            entries.append(best)
+    finally:
+        stage.set_motion_profile(*found_profile) # leave the stage how it was found
+        stage.motion_profiles = attached
+
+    table = MotionProfileTable(entries, {'speed_mm_s': max_speed, 'accel_mm_s2': max_accel})
+    return table, timings
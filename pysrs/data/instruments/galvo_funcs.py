@@ -102,10 +102,8 @@ class Galvo:
             mask_resized = mask_pil.resize((total_x, total_y), Image.NEAREST)
             binary_mask = (np.array(mask_resized) > 128).astype(np.uint8)
         
-        # For each row, repeat each pixel value 'pixel_samples' times.
-        ttl_rows = [np.repeat(binary_mask[row, :], pixel_samples) for row in range(total_y)]
-        ttl_wave = np.concatenate(ttl_rows)
-        ttl_wave = ttl_wave * high_voltage
+        # Repeat each pixel value 'pixel_samples' times, all rows in one call.
+        ttl_wave = np.repeat(binary_mask.ravel(), pixel_samples) * high_voltage
         return ttl_wave
 
 # --- For testing ---
@@ -1,13 +1,27 @@
-import threading, time, os
+import threading, time, os, json
+import concurrent.futures
 from tkinter import messagebox
 import numpy as np
-from PIL import Image
 from utils import *
 from display import *
 from pysrs.aaaa.instruments.galvos import Galvo
-from pysrs.aaaa.acquisition.acquire import lockin_scan
+from pysrs.aaaa.acquisition.acquire import read_raster, reduce_frame, pulse_digital_line, RasterSession
+from pysrs.aaaa.acquisition.capture import CaptureWriter
+from pysrs.aaaa.instruments.zaber_stream import (StreamProgram, ZaberProtocol, SerialTransport,
+                                                 ConnectionTransport, SimulatedZaberSerial)
+from volume import VolumeWriter
+from pysrs.aaaa.acquisition.engine import AcquisitionRequest
+from pysrs.aaaa.acquisition.scheduler import Experiment
+from pysrs.aaaa.acquisition.multidev import full_channel_names
+import autofocus
+import mosaic
+from rpoc_loop import ClosedLoopRPOC, ttl_line_name
+from config_model import CHANNEL_KEYS, WAVEFORM_KEYS
+import mask_io
 
-def acquire(gui, startup=False):
+SIM_MICROSTEP_UM = 0.047625 # microstep size of the X-LSM stages, only used to fake native units in simulation
+
+def acquire(gui, startup=False, focus=None):
     if gui.running and not startup:
         messagebox.showwarning('Warning',
             'Stop continuous acquisition first before saving or single acquisitions.')
@@ -17,7 +31,6 @@ def acquire(gui, startup=False):
     gui.stop_button['state'] = 'normal'
 
     try:
-        gui.update_config()
         if gui.hyperspectral_enabled.get() and gui.save_acquisitions.get():
             numshifts_str = gui.entry_numshifts.get().strip()
             filename = gui.save_file_entry.get().strip()
@@ -45,75 +58,575 @@ def acquire(gui, startup=False):
             messagebox.showerror('Error', 'Invalid number of steps.')
             return
 
-        if not gui.hyperspectral_enabled.get():
-            images = acquire_multiple(gui, numshifts)
+        if gui.mosaic_enabled.get():
+            acquire_mosaic(gui, filename, focus)
+        elif gui.zstack_enabled.get():
+            acquire_zstack(gui, numshifts if gui.hyperspectral_enabled.get() else 1, filename)
+        elif not gui.hyperspectral_enabled.get():
+            images = acquire_multiple(gui, numshifts, focus)
             if gui.save_acquisitions.get() and images:
                 save_images(gui, images, filename)
         else:
-            images = acquire_hyperspectral(gui, numshifts)
+            images, axis = acquire_hyperspectral(gui, numshifts)
             if gui.save_acquisitions.get() and images:
-                save_images(gui, images, filename)
+                save_images(gui, images, filename, axis=axis)
     except Exception as e:
         messagebox.showerror('Error', f'Cannot collect/save data: {e}')
     finally:
         gui.acquiring = False
         gui.stop_button['state'] = 'disabled'
 
-def acquire_multiple(gui, numshifts):
-    numframes = numshifts
+def acquire_continuously(gui):
+    if gui.running or gui.acquiring:
+        messagebox.showwarning('Warning', 'An acquisition is already running.')
+        return
+    gui.update_config() # called from the button, so still on the tk thread
+    live = live_settings(gui)
+    gui.running = True
+    gui.continuous_button['state'] = 'disabled'
+    gui.stop_button['state'] = 'normal'
+    threading.Thread(target=run_continuous, args=(gui, live), daemon=True).start()
+
+def live_settings(gui):
+    # every tk variable live view needs, read on the tk thread before the loop starts and never from the loop
+    return {
+        'simulation': gui.simulation_mode.get(),
+        'capture_base': capture_path(gui),
+        'ttl_channel': gui.mask_ttl_channel_var.get() if gui.apply_mask_var.get() else None,
+        'closed_loop': gui.rpoc_closed_loop.get(),
+        'rpoc': gui.rpoc_settings(),
+    }
+
+def stop_scan(gui):
+    gui.running = False
+    gui.acquiring = False
+
+def run_continuous(gui, live):
+    '''live frames until stopped, with the rpoc mask applied open loop (loaded mask) or closed loop (remade every frame)
+
+    args:
+        gui: main GUI
+        live: live_settings(gui), taken on the tk thread
+
+    returns: none
+    '''
+
+    from PIL import Image # kept out of the gui's startup imports
+    loop, session = None, None
+    capture, captures = None, 0
+    capture_base = live['capture_base']
+    t_armed = [None]
+    def mark_armed():
+        t_armed[0] = time.perf_counter()
+    try:
+        version, config = gui.config.versioned_snapshot()
+        channels = full_channel_names(config)
+        galvo = Galvo(config)
+        capture = open_capture(capture_base, galvo, channels, config)
+        ttl, ttl_line = None, None
+        if live['ttl_channel'] is not None:
+            ttl_line = ttl_line_name(galvo.device, live['ttl_channel'])
+            if live['closed_loop']:
+                loop = ClosedLoopRPOC(galvo, **live['rpoc'])
+            elif gui.rpoc_mask is not None:
+                ttl = static_ttl(gui.rpoc_mask, galvo)
+
+        while gui.running:
+            if gui.config.version != version:
+                # only rebuild what the edit actually touched
+                changed = gui.config.changed_since(version)
+                version, config = gui.config.versioned_snapshot()
+                if changed & CHANNEL_KEYS:
+                    channels = full_channel_names(config)
+                if changed & (WAVEFORM_KEYS | CHANNEL_KEYS):
+                    if session is not None:
+                        session.close()
+                        session = None
+                    if capture is not None:
+                        # a capture holds one raster and channel list, the new settings go to a new folder
+                        capture.close()
+                        captures += 1
+                        capture = open_capture(f'{capture_base}_{captures}', Galvo(config), channels, config)
+                if changed & WAVEFORM_KEYS:
+                    galvo = Galvo(config)
+                    if loop is not None:
+                        loop = ClosedLoopRPOC(galvo, **live['rpoc'])
+                        ttl = None
+                    elif ttl is not None:
+                        ttl = static_ttl(gui.rpoc_mask, galvo)
+
+            if live['simulation']:
+                mark_armed() # nothing to arm, the frame starts now
+                data_list = generate_data(len(channels), config=config, delay_um=gui.hyper_config['single_um'])
+                t_ready = time.perf_counter()
+            else:
+                if session is None and all(ch.startswith(galvo.device + '/') for ch in channels):
+                    # tasks stay committed, a frame is start/read/stop plus the DO write of a new TTL
+                    session = RasterSession(channels, galvo, ttl_line)
+                if session is not None:
+                    raw = session.read(ttl, on_armed=mark_armed)
+                else:
+                    raw = read_raster(channels, galvo, ttl=ttl, ttl_line=ttl_line, on_armed=mark_armed)
+                t_ready = time.perf_counter()
+                if capture is not None:
+                    capture.add_frame(raw)
+                data_list = reduce_frame(raw, galvo, len(channels), config.get('demod'))
+            gui.root.after(0, display_data, gui, data_list)
+
+            if loop is not None:
+                # the TTL made from the previous frame went out when this frame was armed, that ends its latency
+                r = loop.armed(t_armed[0])
+                if r:
+                    flag = ' OVER' if r['missed'] else ''
+                    text = f"RPOC {r['latency_ms']:.1f}/{r['budget_ms']:.0f} ms{flag}"
+                    gui.root.after(0, lambda text=text: gui.progress_label.config(text=text))
+                # the next frame plays the mask made from this one
+                ttl = loop.update(np.stack(data_list), t_ready)
+                gui.rpoc_mask = Image.fromarray(loop.mask, 'L')
+    except Exception as e:
+        messagebox.showerror('Data Acquisition Error', f'Cannot display data: {e}')
+    finally:
+        if session is not None:
+            session.close()
+        if capture is not None:
+            capture.close()
+        gui.running = False
+        gui.continuous_button['state'] = 'normal'
+        gui.stop_button['state'] = 'disabled'
+        if loop is not None:
+            summary = loop.summary()
+            if summary['frames']:
+                print(f"[INFO] Closed loop RPOC: {summary['frames']} frames, latency mean {summary['mean_ms']:.1f} ms, "
+                      f"p95 {summary['p95_ms']:.1f} ms, max {summary['max_ms']:.1f} ms, "
+                      f"{summary['missed']} over the {summary['budget_ms']:.0f} ms budget.")
+
+def static_ttl(mask_image, galvo):
+    # a loaded mask is compiled once, masks made for another scan size are resized to the frame first
+    if isinstance(mask_image, mask_io.RMask):
+        return mask_image.ttl(galvo) # no decode, raises if it was made for another scan
+    mask = np.array(mask_image.convert('L'))
+    if mask.shape not in ((galvo.numsteps_y, galvo.numsteps_x), (galvo.total_y, galvo.total_x)):
+        print(f'[WARN] Mask is {mask.shape}, resizing it to the {galvo.numsteps_y}x{galvo.numsteps_x} frame.')
+        mask = np.array(mask_image.convert('L').resize((galvo.numsteps_x, galvo.numsteps_y), 0)) # 0 is Image.NEAREST
+    return galvo.ttl_waveform(mask)
+
+def engine_request(gui, config, **kwargs):
+    # what the gui wants as a headless request, every tk variable is read here and nowhere after
+    return AcquisitionRequest(dict(config), backend='sim' if gui.simulation_mode.get() else 'daq',
+                              keep_frames=False, **kwargs)
+
+def queued_experiment(gui):
+    # the acquire settings as an Experiment for the scheduler, plain frames or one hyperspectral delay scan
+    if gui.hyperspectral_enabled.get():
+        positions, _ = hyperspectral_axis(gui, int(gui.entry_numshifts.get().strip()))
+        delays, frames = np.asarray(positions).tolist(), 1
+    else:
+        delays, frames = None, int(gui.save_num_entry.get().strip())
+    return Experiment(gui.config.snapshot(), delays_um=delays, frames=frames,
+                      backend='sim' if gui.simulation_mode.get() else 'daq',
+                      label=f"gui {time.strftime('%H:%M:%S')}")
+
+def queue_listener(gui):
+    # queued runs show their frames like any other acquisition, called on the engine thread
+    def listener(event, frame):
+        if event['type'] == 'frame':
+            gui.root.after(0, display_data, gui, list(frame))
+    return listener
+
+def run_job(gui, request, before_frame=None):
+    '''submit a request to the gui's engine and follow it like any other client
+
+    args:
+        gui: main GUI
+        request: AcquisitionRequest
+        before_frame: optional callable(index, delay_um) run on the engine thread before each frame
+
+    returns: list of frames, each a list of PIL images (one per channel)
+    '''
+
     images = []
-    gui.progress_label.config(text=f'(0/{numframes})')
-    gui.root.update_idletasks()
-    channels = [f"{gui.config['device']}/{ch}" for ch in gui.config['ai_chans']]
-    galvo = Galvo(gui.config)
-    for i in range(numframes):
-        if not gui.acquiring:
-            break
-        if gui.simulation_mode.get():
-            data_list = generate_data(len(channels), config=gui.config)
-        else:
-            data_list = lockin_scan(channels, galvo)
-        gui.root.after(0, display_data, gui, data_list)
-        pil_images = [convert(d) for d in data_list]
-        images.append(pil_images)
-        gui.progress_label.config(text=f'({i + 1}/{numframes})')
-        gui.root.update_idletasks()
+    def listener(event, frame):
+        if event['type'] == 'frame':
+            data_list = list(frame)
+            gui.root.after(0, display_data, gui, data_list)
+            images.append([convert(d) for d in data_list])
+        elif event['type'] == 'progress':
+            text = f"({event['done']}/{event['total']})"
+            gui.root.after(0, lambda: gui.progress_label.config(text=text))
+    gui.progress_label.config(text=f'(0/{len(request.positions())})')
+    job = gui.get_engine().submit(request, listener, before_frame)
+    while not job.wait(0.1):
+        if not gui.acquiring: # stop button
+            job.cancel()
+    if job.state == 'error':
+        raise RuntimeError(job.error)
     return images
 
-def acquire_hyperspectral(gui, numshifts):
+def acquire_multiple(gui, numshifts, focus=None):
+    config = gui.config.snapshot() # read only for the whole acquisition, edits in the gui wait for the next one
+    request = engine_request(gui, config, frames=numshifts, delay_um=gui.hyper_config['single_um'],
+                             capture_path=capture_path(gui))
+    before = (lambda i, delay: refocus(focus)) if focus else None
+    return run_job(gui, request, before)
+
+def capture_path(gui):
+    # raw samples go next to the save file (or the home folder) in a timestamped capture folder
+    if not gui.raw_capture.get():
+        return None
+    if gui.simulation_mode.get():
+        print('[INFO] Raw capture is skipped in simulation mode, there are no raw samples.')
+        return None
+    base = os.path.splitext(gui.save_file_entry.get().strip())[0] or os.path.join(os.path.expanduser('~'), 'pysrs')
+    path = f"{base}_raw_{time.strftime('%Y%m%d_%H%M%S')}"
+    print(f'[INFO] Capturing raw samples to {path}')
+    return path
+
+def open_capture(path, galvo, channels, config):
+    # writer for the acquisitions that read the DAQ themselves, engine jobs open theirs in the backend
+    if not path:
+        return None
+    return CaptureWriter(path, galvo, channels, metadata={'config': dict(config)})
+
+def replay_capture(gui, path, realtime=True):
+    '''run a raw capture back through reduction, display and (if enabled) saving, like a live acquisition
+
+    args:
+        gui: main GUI
+        path: capture folder
+        realtime: pace at the captured frame rate, False runs as fast as the pipeline allows
+
+    returns: list of frames as PIL images
+    '''
+
+    request = AcquisitionRequest(backend='replay', replay_path=path, realtime=realtime, frames=0, keep_frames=False)
+    gui.acquiring = True
+    gui.stop_button['state'] = 'normal'
+    tic = time.perf_counter()
+    try:
+        images = run_job(gui, request)
+        elapsed = time.perf_counter() - tic
+        print(f'[INFO] Replayed {len(images)} frames in {elapsed:.2f} s ({len(images) / max(elapsed, 1e-9):.1f} fps).')
+        if gui.save_acquisitions.get() and images:
+            save_images(gui, images, gui.save_file_entry.get().strip())
+    finally:
+        gui.acquiring = False
+        gui.stop_button['state'] = 'disabled'
+    return images
+
+def focus_settings(gui):
+    # everything refocus needs, read on the tk thread before the acquisition starts, None when refocus is off
+    if not gui.autofocus_each.get():
+        return None
+    return {'stage': gui.get_prior_stage(), 'config': gui.config.snapshot(), 'simulate': gui.simulation_mode.get(),
+            **gui.autofocus_settings()}
+
+def refocus(focus):
+    # quick autofocus around the current z before a time point or tile, the frames it takes are not kept
+    result = autofocus.focus(**focus)
+    print(f"[INFO] Refocused to {result['z_um']} um ({result['frames']} frames).")
+    return result
+
+def hyperspectral_axis(gui, numshifts):
+    # grid is linear in whatever units the entries are in, the calibration table maps cm^-1 to stage um
     start_val = float(gui.entry_start_um.get().strip())
     stop_val = float(gui.entry_stop_um.get().strip())
-    positions = [start_val] if numshifts == 1 else [start_val + i * (stop_val - start_val) / (numshifts - 1) for i in range(numshifts)]
+    grid = np.linspace(start_val, stop_val, numshifts)
+    table = gui.calibration_table
+    if gui.hyper_config['units'] == 'cm-1':
+        return table.shift_to_um(grid), grid
+    shifts = table.um_to_shift(grid) if table is not None and table.is_valid() else None
+    return grid, shifts
+
+def acquire_hyperspectral(gui, numshifts):
+    config = gui.config.snapshot()
+    positions, shifts = hyperspectral_axis(gui, numshifts)
+    axis = {'positions_um': positions.tolist()}
+    if shifts is not None:
+        axis['wavenumbers_cm'] = np.asarray(shifts).tolist()
+        axis['calibration_revision'] = gui.calibration_table.revision
+    if gui.hyper_config.get('stream_mode'):
+        try:
+            images = acquire_stream_steps(gui, positions)
+        except Exception as e:
+            messagebox.showerror("Zaber Stream Error", str(e))
+            return None, None
+        return images, trim_axis(axis, len(images))
     try:
         gui.zaber_stage.connect()
     except Exception as e:
         messagebox.showerror("Zaber Error", str(e))
-        return None
+        return None, None
+    # the engine moves the stage to step i+1 while frame i is handed out
+    images = run_job(gui, engine_request(gui, config, delays_um=positions))
+    return images, trim_axis(axis, len(images))
+
+def trim_axis(axis, n):
+    for key in ('positions_um', 'wavenumbers_cm'): # trim the axis if the scan was stopped early
+        if key in axis:
+            axis[key] = axis[key][:n]
+    return axis
+
+def wait_until(condition, timeout, interval=1e-3):
+    tic = time.monotonic()
+    while not condition():
+        if time.monotonic() - tic > timeout:
+            raise TimeoutError('Timed out waiting for the stage stream.')
+        time.sleep(interval)
+
+def acquire_stream_steps(gui, positions):
+    config = gui.config.snapshot()
+    # the whole position list lives on the zaber controller as a stored stream. per step the controller moves,
+    # raises its DO (the galvo start trigger), and waits for the DAQ done pulse on its DI, so no serial traffic
+    # happens between frames. the done pulse for step i is only sent once frame i+1 is armed, so the trigger
+    # edge can never arrive before the DAQ is listening for it
+    cfg = gui.hyper_config
+    channels = full_channel_names(config)
+    galvo = Galvo(config)
+    program_args = dict(mode='trigger', dwell_ms=cfg.get('stream_settle_ms', 0),
+                        do_channel=cfg.get('stream_do', 1), di_channel=cfg.get('stream_di', 1))
+
+    if gui.simulation_mode.get():
+        capture = None # no raw samples in simulation
+        sim = SimulatedZaberSerial()
+        protocol = ZaberProtocol(SerialTransport(sim))
+        program = StreamProgram([p / SIM_MICROSTEP_UM for p in positions], **program_args)
+        program.upload(protocol)
+        start = lambda: program.start(protocol)
+        stop = lambda: program.stop(protocol)
+        def release(): # what the DAQ done pulse does on the rig
+            sim.set_digital_input(program.di_channel, 1)
+            wait_until(lambda: sim.do.get(program.do_channel, 0) == 0, timeout=5)
+            sim.set_digital_input(program.di_channel, 0)
+        def frame(on_armed):
+            on_armed()
+            wait_until(lambda: sim.do.get(program.do_channel, 0) == 1, timeout=5)
+            return generate_data(len(channels), config=config, delay_um=sim.position * SIM_MICROSTEP_UM)
+    else:
+        stage = gui.zaber_stage
+        def upload():
+            protocol = ZaberProtocol(ConnectionTransport(stage.connection), device=stage.device.device_address)
+            from zaber_motion import Units # only needed on the rig, already loaded by the stage connection
+            native = [stage.axis.settings.convert_to_native_units('pos', p, Units.LENGTH_MICROMETRES) for p in positions]
+            program = StreamProgram(native, **program_args)
+            program.upload(protocol)
+            return protocol, program
+        protocol, program = stage.submit(upload).result(timeout=stage.timeout)
+        start = lambda: stage.submit(program.start, protocol).result(timeout=stage.timeout)
+        stop = lambda: stage.submit(program.stop, protocol).result(timeout=stage.timeout)
+        done_line = f"{config['device']}/{cfg.get('stream_done_line', 'port0/line5')}"
+        trigger = f"/{config['device']}/{cfg.get('stream_trigger', 'PFI0')}"
+        release = lambda: pulse_digital_line(done_line)
+        capture = open_capture(capture_path(gui), galvo, channels, config)
+        def frame(on_armed):
+            raw = read_raster(channels, galvo, start_trigger=trigger, on_armed=on_armed)
+            if capture is not None:
+                capture.add_frame(raw, delay_um=float(positions[len(capture.header['frames'])]))
+            return reduce_frame(raw, galvo, len(channels), config.get('demod'))
+
     images = []
-    gui.progress_label.config(text=f'(0/{numshifts})')
-    gui.root.update_idletasks()
-    channels = [f"{gui.config['device']}/{ch}" for ch in gui.config['ai_chans']]
-    for i, pos in enumerate(positions):
-        if not gui.acquiring:
-            break
+    gui.progress_label.config(text=f'(0/{len(positions)})')
+    try:
+        for i in range(len(positions)):
+            if not gui.acquiring:
+                break
+            data_list = frame(start if i == 0 else release)
+            gui.root.after(0, display_data, gui, data_list)
+            images.append([convert(d) for d in data_list])
+            gui.progress_label.config(text=f'({i + 1}/{len(positions)})')
+    finally:
+        stop()
+        if capture is not None:
+            capture.close()
+    return images
+
+def zstack_positions(gui):
+    start = float(gui.entry_z_start.get().strip())
+    stop = float(gui.entry_z_stop.get().strip())
+    numplanes = int(gui.entry_z_planes.get().strip())
+    if numplanes < 1:
+        raise ValueError('Number of planes must be at least 1.')
+    return np.linspace(start, stop, numplanes)
+
+def acquire_zstack(gui, numshifts=1, filename=None):
+    config = gui.config.snapshot()
+    # z is the outer loop, the delay scan (if any) the inner one. the focus move to plane k+1 starts right after
+    # the last frame of plane k is read, so it runs while that plane is reduced and written on the writer thread.
+    # the delays are walked back and forth on alternate planes so the zaber never has to fly back to the start
+    try:
+        z_positions = zstack_positions(gui)
+    except ValueError as e:
+        messagebox.showerror('Error', f'Invalid Z-stack range: {e}')
+        return None
+    hyper = gui.hyperspectral_enabled.get()
+    channels = full_channel_names(config)
+    galvo = Galvo(config)
+    names = list(config.get('channel_names') or config['ai_chans'])[:len(channels)]
+    metadata = {'axes': ['z', 'delay', 'channel', 'y', 'x'] if hyper else ['z', 'channel', 'y', 'x'],
+                'z_um': z_positions.tolist(), 'channels': names}
+    if hyper:
+        positions, shifts = hyperspectral_axis(gui, numshifts)
+        metadata['positions_um'] = positions.tolist()
+        if shifts is not None:
+            metadata['wavenumbers_cm'] = np.asarray(shifts).tolist()
+            metadata['calibration_revision'] = gui.calibration_table.revision
         try:
-            gui.zaber_stage.move_absolute_um(pos)
+            gui.zaber_stage.connect()
         except Exception as e:
-            messagebox.showerror("Stage Move Error", str(e))
+            messagebox.showerror("Zaber Error", str(e))
             return None
-        galvo = Galvo(gui.config)
-        if gui.simulation_mode.get():
-            data_list = generate_data(len(channels), config=gui.config)
-        else:
-            data_list = lockin_scan(channels, galvo)
-        gui.root.after(0, display_data, gui, data_list)
-        pil_images = [convert(d) for d in data_list]
-        images.append(pil_images)
-        gui.progress_label.config(text=f'({i + 1}/{numshifts})')
-        gui.root.update_idletasks()
-    return images
+    try:
+        stage = gui.get_prior_stage()
+    except Exception as e:
+        messagebox.showerror("Prior Error", str(e))
+        return None
+
+    if gui.simulation_mode.get():
+        read = lambda delay, z_um: generate_data(len(channels), config=config, delay_um=delay)
+        reduce = None
+        capture = None
+    else:
+        capture = open_capture(capture_path(gui), galvo, channels, config)
+        def read(delay, z_um):
+            raw = read_raster(channels, galvo)
+            if capture is not None:
+                capture.add_frame(raw, delay_um=float(delay), z_um=float(z_um))
+            return raw
+        reduce = lambda raw: reduce_frame(raw, galvo, len(channels), config.get('demod'))
+
+    plane_shape = (len(channels), galvo.numsteps_y, galvo.numsteps_x)
+    shape = (len(z_positions), numshifts) + plane_shape if hyper else (len(z_positions),) + plane_shape
+    path = os.path.splitext(filename)[0] + '_volume.npy' if filename else None
+    writer = VolumeWriter(shape, path, metadata)
+    show = lambda f: f.exception() is None and gui.root.after(0, display_data, gui, f.result())
+
+    total = len(z_positions) * numshifts
+    done = 0
+    gui.progress_label.config(text=f'(0/{total})')
+    try:
+        stage.goto_z(z_positions[0])
+        for iz in range(len(z_positions)):
+            if not gui.acquiring:
+                break
+            stage.wait_for_z_motion()
+            order = list(range(numshifts)) if iz % 2 == 0 else list(range(numshifts - 1, -1, -1))
+            if hyper:
+                move = gui.zaber_stage.move_async(positions[order[0]])
+            for k, idelay in enumerate(order):
+                if not gui.acquiring:
+                    break
+                if hyper:
+                    move.result(timeout=gui.zaber_stage.move_timeout(positions[idelay]))
+                frame = read(positions[idelay] if hyper else gui.hyper_config['single_um'], z_positions[iz])
+                if hyper and k + 1 < len(order):
+                    move = gui.zaber_stage.move_async(positions[order[k + 1]])
+                elif k + 1 == len(order) and iz + 1 < len(z_positions):
+                    stage.goto_z(z_positions[iz + 1], wait=False)
+                writer.put((iz, idelay) if hyper else (iz,), frame, reduce).add_done_callback(show)
+                done += 1
+                gui.progress_label.config(text=f'({done}/{total})')
+    finally:
+        volume = writer.close()
+        if capture is not None:
+            capture.close()
+    if path:
+        messagebox.showinfo('Done', f'Saved volume {shape}:\n{path}')
+    gui.progress_label.config(text=f'(0/{total})')
+    return volume
+
+def mosaic_settings(gui):
+    tiles_x = int(gui.entry_tiles_x.get().strip())
+    tiles_y = int(gui.entry_tiles_y.get().strip())
+    overlap = float(gui.entry_overlap.get().strip()) / 100
+    fov_um = float(gui.entry_fov_um.get().strip())
+    if tiles_x < 1 or tiles_y < 1 or not 0.05 <= overlap < 0.5 or fov_um <= 0:
+        raise ValueError('Need at least 1x1 tiles, 5-50% overlap and a positive field of view.')
+    return tiles_x, tiles_y, overlap, fov_um
+
+def acquire_mosaic(gui, filename=None, focus=None):
+    config = gui.config.snapshot()
+    # tiles are registered against their left/right and upper neighbours in a process pool as soon as both
+    # are in, so the fft work runs while the stage moves and the next tiles are read
+    try:
+        tiles_x, tiles_y, overlap, fov_um = mosaic_settings(gui)
+    except ValueError as e:
+        messagebox.showerror('Error', f'Invalid mosaic settings: {e}')
+        return None
+    try:
+        stage = gui.get_prior_stage()
+    except Exception as e:
+        messagebox.showerror("Prior Error", str(e))
+        return None
+
+    channels = full_channel_names(config)
+    galvo = Galvo(config)
+    shape = (galvo.numsteps_y, galvo.numsteps_x)
+    pixel_um = fov_um / galvo.numsteps_x
+    step_px = (int(round(shape[0] * (1 - overlap))), int(round(shape[1] * (1 - overlap))))
+    origin = stage.get_xy()
+    grid = mosaic.tile_grid(tiles_x, tiles_y, step_px[1] * pixel_um, step_px[0] * pixel_um, origin)
+    index = {(ix, iy): k for k, (ix, iy, _, _) in enumerate(grid)}
+    rng = np.random.default_rng()
+
+    capture = None if gui.simulation_mode.get() else open_capture(capture_path(gui), galvo, channels, config)
+    tiles = [None] * len(grid)
+    jobs = []
+    gui.progress_label.config(text=f'(0/{len(grid)})')
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        try:
+            for k, (ix, iy, x, y) in enumerate(grid):
+                if not gui.acquiring:
+                    break
+                stage.goto_xy(x, y)
+                if focus:
+                    refocus(focus)
+                if gui.simulation_mode.get():
+                    data_list = mosaic.simulated_tile(x - origin[0], y - origin[1], shape, pixel_um, len(channels), rng)
+                else:
+                    raw = read_raster(channels, galvo)
+                    if capture is not None:
+                        capture.add_frame(raw, tile=[int(ix), int(iy)], x_um=float(x), y_um=float(y))
+                    data_list = reduce_frame(raw, galvo, len(channels), config.get('demod'))
+                tiles[k] = np.stack(data_list).astype(np.float32)
+                for (nx_, ny_), direction in (((ix - 1, iy), 'x'), ((ix + 1, iy), 'x'), ((ix, iy - 1), 'y')):
+                    j = index.get((nx_, ny_))
+                    if j is None or tiles[j] is None:
+                        continue
+                    a, b = (j, k) if nx_ <= ix and ny_ <= iy else (k, j) # a is always left of / above b
+                    step = step_px[1] if direction == 'x' else step_px[0]
+                    jobs.append((a, b, direction, pool.submit(mosaic.register_pair, tiles[a], tiles[b], direction, step)))
+                gui.root.after(0, display_data, gui, data_list)
+                gui.progress_label.config(text=f'({k + 1}/{len(grid)})')
+        finally:
+            if capture is not None:
+                capture.close()
+
+        done = [k for k, t in enumerate(tiles) if t is not None]
+        if not done:
+            return None
+        pairs = []
+        for a, b, direction, job in jobs:
+            dy, dx, confidence = job.result()
+            nominal = (0, step_px[1]) if direction == 'x' else (step_px[0], 0)
+            if confidence < mosaic.MIN_CONFIDENCE:
+                dy, dx, confidence = 0.0, 0.0, mosaic.MIN_CONFIDENCE # featureless overlap, fall back to the stage
+            pairs.append((done.index(a), done.index(b), nominal[0] + dy, nominal[1] + dx, confidence))
+
+    positions = mosaic.solve_positions(len(done), pairs)
+    image = mosaic.blend_tiles([tiles[k] for k in done], positions)
+    gui.root.after(0, display_data, gui, list(image))
+
+    if filename:
+        out_dir = os.path.splitext(filename)[0] + '_mosaic'
+        metadata = {'pixel_um': pixel_um, 'tiles': [tiles_x, tiles_y], 'overlap': overlap, 'origin_um': list(origin),
+                    'channels': list(config.get('channel_names') or config['ai_chans'])[:len(channels)],
+                    'tile_positions_px': positions.tolist()}
+        mosaic.write_pyramid(image, out_dir, metadata)
+        messagebox.showinfo('Done', f'Saved mosaic {image.shape}:\n{out_dir}')
+    gui.progress_label.config(text=f'(0/{len(grid)})')
+    return image
 
-def save_images(gui, images, filename):
+def save_images(gui, images, filename, axis=None):
+    config = gui.config.snapshot()
     if not images:
         return
     dirpath = os.path.dirname(filename)
@@ -122,14 +635,16 @@ def save_images(gui, images, filename):
     base, ext = os.path.splitext(filename)
     num_channels = len(images[0])
     saved_fnames = []
+    # the spectral axis goes into the tiff ImageDescription so each cube carries its own wavenumbers
+    extra = {'description': json.dumps(axis)} if axis else {}
     for ch_idx in range(num_channels):
         channel_frames = [frame[ch_idx] for frame in images]
         counter = 1
         # fallback to "chan{ch_idx}"
-        if 'channel_names' in gui.config and len(gui.config['channel_names']) > ch_idx:
-            channel_suffix = gui.config['channel_names'][ch_idx]
-        elif ch_idx < len(gui.config['ai_chans']):
-            channel_suffix = gui.config['ai_chans'][ch_idx]
+        if 'channel_names' in config and len(config['channel_names']) > ch_idx:
+            channel_suffix = config['channel_names'][ch_idx]
+        elif ch_idx < len(config['ai_chans']):
+            channel_suffix = config['ai_chans'][ch_idx]
         else:
             channel_suffix = f"chan{ch_idx}"
         new_filename = f"{base}_{channel_suffix}{ext}"
@@ -141,10 +656,11 @@ def save_images(gui, images, filename):
                 new_filename,
                 save_all=True,
                 append_images=channel_frames[1:],
-                format='TIFF'
+                format='TIFF',
+                **extra
             )
         else:
-            channel_frames[0].save(new_filename, format='TIFF')
+            channel_frames[0].save(new_filename, format='TIFF', **extra)
         saved_fnames.append(new_filename)
     msg = "Saved frames:\n" + "\n".join(saved_fnames)
     messagebox.showinfo('Done', msg)
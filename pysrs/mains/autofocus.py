@@ -0,0 +1,143 @@
+# autofocus.py
+import numpy as np
+from pysrs.aaaa.instruments.galvos import Galvo
+from pysrs.aaaa.acquisition.acquire import lockin_scan
+from pysrs.aaaa.acquisition.multidev import full_channel_names
+from utils import generate_data
+
+GOLDEN = (np.sqrt(5) - 1) / 2
+SIM_FOCUS_UM = 20 # where the simulated sample is in focus, the simulated prior starts at z = 0
+
+
+def variance_of_laplacian(image):
+    # 4 neighbour laplacian from shifted slices, no convolution needed
+    img = np.asarray(image, dtype=float)
+    lap = img[1:-1, :-2] + img[1:-1, 2:] + img[:-2, 1:-1] + img[2:, 1:-1] - 4 * img[1:-1, 1:-1]
+    return lap.var() / (img.mean()**2 + 1e-12)
+
+
+def brenner(image):
+    img = np.asarray(image, dtype=float)
+    dx = img[:, 2:] - img[:, :-2]
+    dy = img[2:, :] - img[:-2, :]
+    return ((dx**2).sum() + (dy**2).sum()) / (img.sum()**2 + 1e-12) * img.size
+
+
+def fft_high_frequency(image, cutoff=0.25):
+    # fraction of the (dc removed) spectral energy above cutoff * nyquist
+    img = np.asarray(image, dtype=float)
+    power = np.abs(np.fft.rfft2(img - img.mean()))**2
+    fy = np.fft.fftfreq(img.shape[0])[:, None]
+    fx = np.fft.rfftfreq(img.shape[1])[None, :]
+    high = np.hypot(fx, fy) > cutoff * 0.5
+    return power[high].sum() / (power.sum() + 1e-12)
+
+
+FOCUS_METRICS = {
+    'Brenner': brenner,
+    'Laplacian Variance': variance_of_laplacian,
+    'FFT High Frequency': fft_high_frequency,
+}
+
+
+def golden_section_search(score, lo, hi, tol=1.0, coarse_steps=5, max_evals=30):
+    '''find the z with the highest score using as few evaluations as possible
+
+    a short coarse scan brackets the peak first (focus curves have side lobes that trap a plain
+    golden section), then golden section narrows the bracket around the best coarse point
+
+    args:
+        score: callable z -> focus metric, each call costs one frame
+        lo, hi: search range
+        tol: stop once the bracket is smaller than this
+        coarse_steps: points in the bracketing scan, at least 3
+        max_evals: hard cap on calls to score
+
+    returns: (best z, best score, list of (z, score) in the order they were measured)
+    '''
+
+    evaluations = []
+    cache = {}
+    def f(z):
+        key = round(z / tol * 4) # positions closer than tol/4 count as the same frame
+        if key not in cache:
+            cache[key] = score(z)
+            evaluations.append((z, cache[key]))
+        return cache[key]
+
+    grid = np.linspace(lo, hi, max(3, coarse_steps))
+    values = [f(z) for z in grid]
+    i = int(np.argmax(values))
+    a, b = grid[max(i - 1, 0)], grid[min(i + 1, len(grid) - 1)]
+
+    c = b - GOLDEN * (b - a)
+    d = a + GOLDEN * (b - a)
+    fc, fd = f(c), f(d)
+    while b - a > tol and len(evaluations) < max_evals:
+        if fc > fd:
+            b, d, fd = d, c, fc
+            c = b - GOLDEN * (b - a)
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + GOLDEN * (b - a)
+            fd = f(d)
+
+    best_z, best_score = max(evaluations, key=lambda e: e[1])
+    return best_z, best_score, evaluations
+
+
+def simulated_frame(config, z, num_channels=1):
+    # the usual test image blurred in proportion to the distance from SIM_FOCUS_UM
+    frame = generate_data(num_channels, config=config)
+    sigma = 0.15 * abs(z - SIM_FOCUS_UM)
+    if sigma < 1e-3:
+        return frame
+    ny, nx = frame[0].shape
+    fy = np.fft.fftfreq(ny)[:, None]
+    fx = np.fft.rfftfreq(nx)[None, :]
+    kernel = np.exp(-2 * (np.pi * sigma)**2 * (fx**2 + fy**2))
+    return [np.fft.irfft2(np.fft.rfft2(img) * kernel, s=img.shape) for img in frame]
+
+
+def autofocus(gui, **settings):
+    # the autofocus button, tk thread only. acquisitions read these values up front and call focus() themselves
+    return focus(gui.get_prior_stage(), gui.config.snapshot(), gui.simulation_mode.get(), **settings)
+
+
+def focus(stage, config, simulate, range_um=50.0, tol_um=1.0, metric='Brenner', channel=0, resolution=64,
+          center_um=None):
+    '''move the prior focus to the sharpest plane, meant to be called before each tile or time point
+
+    args:
+        stage: connected PriorStage (or anything with get_z / goto_z)
+        config: acquisition config, for the scan and the channels
+        simulate: blur the simulated test image instead of scanning
+        range_um: full width of the search, centered on center_um
+        tol_um: stop when the focus is known to within this
+        metric: key of FOCUS_METRICS
+        channel: index of the AI channel the metric is computed on
+        resolution: pixels per side of the quick frames, the field of view stays the same
+        center_um: middle of the search, defaults to the current z
+
+    returns: dict with z_um, score, frames (number acquired) and evaluations
+    '''
+
+    center = stage.get_z() if center_um is None else center_um
+    metric_fn = FOCUS_METRICS[metric]
+    config = {**config, 'numsteps_x': resolution, 'numsteps_y': resolution} # same amplitudes, fewer pixels
+    channels = full_channel_names(config)
+    galvo = Galvo(config)
+
+    def score(z):
+        stage.goto_z(z)
+        if simulate:
+            frame = simulated_frame(config, stage.get_z(), len(channels))
+        else:
+            frame = lockin_scan(channels, galvo)
+        return metric_fn(frame[channel])
+
+    best_z, best_score, evaluations = golden_section_search(
+        score, center - range_um / 2, center + range_um / 2, tol=tol_um)
+    stage.goto_z(best_z)
+    return {'z_um': stage.get_z(), 'score': best_score, 'frames': len(evaluations), 'evaluations': evaluations}
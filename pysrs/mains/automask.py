@@ -0,0 +1,342 @@
+# automask.py
+import concurrent.futures
+import functools
+import itertools
+import os
+import numpy as np
+
+'''
+automatic rpoc masks from multi-channel frames
+
+a mask is made in a fixed pipeline: pick the image to threshold (one channel, or the ratio of two), threshold
+it (otsu, multi-otsu or a fixed ratio cut), open/close to remove speckle and bridge small gaps, drop connected
+components outside a size range, and optionally fill holes. everything is numpy on whole arrays, no scipy, and
+whole stacks or mosaics go through a process pool one frame per task. masks come out as uint8 0/255 at the frame
+size, the same thing RPOC.save_mask writes, and scan_mask pads them to the full raster for the ttl compiler.
+'''
+
+METHODS = ['otsu', 'multi-otsu', 'ratio']
+
+
+def histogram(image, bins: int):
+    # histogram over the 0.1-99.9 percentile range, so a few hot or divide by ~0 pixels (ratios) cannot squash it
+    values = np.asarray(image, dtype=float).ravel()
+    values = values[np.isfinite(values)]
+    lo, hi = np.percentile(values, [0.1, 99.9])
+    return np.histogram(values, bins=bins, range=(lo, hi if hi > lo else lo + 1))
+
+
+def otsu_threshold(image, bins: int = 256) -> float:
+    '''threshold maximizing the between class variance of the histogram
+
+    args:
+        image: 2D array, any dtype
+        bins: histogram bins
+
+    returns: threshold in image units, pixels above it are foreground
+    '''
+
+    hist, edges = histogram(image, bins)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    w0 = np.cumsum(hist)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(hist * centers)
+    mean0 = m0 / np.maximum(w0, 1)
+    mean1 = (m0[-1] - m0) / np.maximum(w1, 1)
+    between = w0 * w1 * (mean0 - mean1)**2
+    return float(edges[int(np.argmax(between)) + 1])
+
+
+def multi_otsu_thresholds(image, classes: int = 3, bins: int = 64) -> np.ndarray:
+    '''thresholds splitting the histogram into several classes, every combination of cuts is scored at once
+
+    args:
+        image: 2D array
+        classes: number of classes, 2 is plain otsu
+        bins: histogram bins, keep small for 4+ classes since the search grows as bins^(classes-1)
+
+    returns: classes - 1 increasing thresholds
+    '''
+
+    hist, edges = histogram(image, bins)
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    # prefix sums with a leading zero, class k holds bins [cut_k, cut_k+1)
+    w = np.concatenate([[0], np.cumsum(hist)]).astype(float)
+    m = np.concatenate([[0], np.cumsum(hist * centers)])
+    cuts = np.array(list(itertools.combinations(range(1, bins), classes - 1)))
+    bounds = np.hstack([np.zeros((len(cuts), 1), int), cuts, np.full((len(cuts), 1), bins)])
+    weight = w[bounds[:, 1:]] - w[bounds[:, :-1]]
+    mass = m[bounds[:, 1:]] - m[bounds[:, :-1]]
+    # between class variance up to a constant: sum of mass^2 / weight over the classes
+    score = np.where(weight > 0, mass**2 / np.maximum(weight, 1e-12), 0).sum(axis=1)
+    return edges[cuts[int(np.argmax(score))]]
+
+
+def ratio_image(channels, numerator: int = 0, denominator: int = 1, eps: float = 1e-6) -> np.ndarray:
+    # e.g. lipid / protein channel, normalizes out illumination and depth falloff that both channels share
+    channels = np.asarray(channels, dtype=float)
+    den = channels[denominator]
+    return channels[numerator] / np.where(np.abs(den) < eps, eps, den)
+
+
+def disk_offsets(radius: int) -> list:
+    r = int(radius)
+    return [(dy, dx) for dy in range(-r, r + 1) for dx in range(-r, r + 1) if dy * dy + dx * dx <= r * r + r]
+
+
+def shift_reduce(mask: np.ndarray, radius: int, op, pad_value: bool) -> np.ndarray:
+    # combine the mask with every shift inside the disk, one whole array operation per offset
+    r = int(radius)
+    padded = np.pad(mask, r, constant_values=pad_value)
+    ny, nx = mask.shape
+    out = mask.copy()
+    for dy, dx in disk_offsets(r):
+        op(out, padded[r + dy:r + dy + ny, r + dx:r + dx + nx], out=out)
+    return out
+
+
+def binary_dilate(mask, radius: int = 1) -> np.ndarray:
+    mask = np.asarray(mask, dtype=bool)
+    return shift_reduce(mask, radius, np.logical_or, False) if radius > 0 else mask
+
+
+def binary_erode(mask, radius: int = 1) -> np.ndarray:
+    mask = np.asarray(mask, dtype=bool)
+    return shift_reduce(mask, radius, np.logical_and, True) if radius > 0 else mask
+
+
+def binary_open(mask, radius: int = 1) -> np.ndarray:
+    return binary_dilate(binary_erode(mask, radius), radius)
+
+
+def binary_close(mask, radius: int = 1) -> np.ndarray:
+    return binary_erode(binary_dilate(mask, radius), radius)
+
+
+def row_runs(mask: np.ndarray):
+    '''horizontal runs of True pixels
+
+    args:
+        mask: 2D bool array
+
+    returns: (rows, starts, stops) arrays, one entry per run, ordered by row then start
+    '''
+
+    ny, nx = mask.shape
+    padded = np.zeros((ny, nx + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, stops = np.nonzero(edges == -1)
+    return rows, starts, stops
+
+
+def label_components(mask):
+    '''4-connected components by union-find over row runs, far fewer nodes than pixels
+
+    args:
+        mask: 2D bool array
+
+    returns: (int32 label image with 0 as background, number of components)
+    '''
+
+    mask = np.asarray(mask, dtype=bool)
+    rows, starts, stops = row_runs(mask)
+    n = len(rows)
+    labels = np.zeros(mask.shape, dtype=np.int32)
+    if n == 0:
+        return labels, 0
+
+    parent = np.arange(n)
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first = np.searchsorted(rows, np.arange(mask.shape[0] + 1))
+    for y in range(mask.shape[0] - 1):
+        a0, a1, b0, b1 = first[y], first[y + 1], first[y + 1], first[y + 2]
+        if a0 == a1 or b0 == b1:
+            continue
+        # runs a (row y) and b (row y + 1) touch when a.start < b.stop and b.start < a.stop
+        lo = np.searchsorted(stops[a0:a1], starts[b0:b1], side='right') + a0
+        hi = np.searchsorted(starts[a0:a1], stops[b0:b1], side='left') + a0
+        for b, (i0, i1) in enumerate(zip(lo, hi)):
+            rb = find(b0 + b)
+            for a in range(i0, i1):
+                ra = find(a)
+                if ra != rb:
+                    parent[max(ra, rb)] = min(ra, rb)
+                    rb = min(ra, rb)
+
+    roots = np.array([find(i) for i in range(n)])
+    _, run_labels = np.unique(roots, return_inverse=True)
+    lengths = stops - starts
+    flat = rows * mask.shape[1] + starts
+    # paint each run with its label through one repeat
+    pixel_index = np.repeat(flat - np.cumsum(np.concatenate([[0], lengths[:-1]])), lengths) + np.arange(lengths.sum())
+    labels.ravel()[pixel_index] = np.repeat(run_labels + 1, lengths)
+    return labels, int(run_labels.max()) + 1
+
+
+def filter_components(mask, min_size: int = 0, max_size: int = None) -> np.ndarray:
+    '''keep only connected components with a pixel count in [min_size, max_size]
+
+    args:
+        mask: 2D bool array
+        min_size: smallest component kept, removes speckle
+        max_size: largest component kept, None for no limit
+
+    returns: filtered 2D bool array
+    '''
+
+    mask = np.asarray(mask, dtype=bool)
+    if not min_size and max_size is None:
+        return mask
+    labels, count = label_components(mask)
+    sizes = np.bincount(labels.ravel(), minlength=count + 1)
+    keep = sizes >= min_size
+    if max_size is not None:
+        keep &= sizes <= max_size
+    keep[0] = False
+    return keep[labels]
+
+
+def fill_holes(mask) -> np.ndarray:
+    # background components that never reach the border are holes
+    mask = np.asarray(mask, dtype=bool)
+    labels, count = label_components(~mask)
+    border = np.unique(np.concatenate([labels[0], labels[-1], labels[:, 0], labels[:, -1]]))
+    outside = np.zeros(count + 1, dtype=bool)
+    outside[border] = True
+    outside[0] = True
+    return mask | ~outside[labels]
+
+
+def make_mask(frame, method: str = 'otsu', channel: int = 0, ratio: tuple = (0, 1), ratio_cut: float = None,
+              classes: int = 3, keep_classes: tuple = None, open_radius: int = 1, close_radius: int = 1,
+              min_size: int = 20, max_size: int = None, fill: bool = True, invert: bool = False) -> np.ndarray:
+    '''one mask from one multi-channel frame
+
+    args:
+        frame: (channels, ny, nx) or a single 2D image
+        method: 'otsu', 'multi-otsu' or 'ratio'
+        channel: channel thresholded by otsu / multi-otsu
+        ratio: (numerator, denominator) channels for method 'ratio'
+        ratio_cut: fixed cut on the ratio, None runs otsu on the ratio image
+        classes: number of multi-otsu classes
+        keep_classes: multi-otsu classes that become the mask, default only the brightest
+        open_radius, close_radius: disk radii of the morphological open and close, 0 to skip
+        min_size, max_size: component size limits in pixels
+        fill: fill holes inside components
+        invert: mask the dark part instead of the bright part
+
+    returns: uint8 mask, 255 where the rpoc laser should be on
+    '''
+
+    frame = np.asarray(frame, dtype=float)
+    if frame.ndim == 2:
+        frame = frame[None]
+
+    if method == 'otsu':
+        image = frame[channel]
+        mask = image > otsu_threshold(image)
+    elif method == 'multi-otsu':
+        image = frame[channel]
+        classes_img = np.digitize(image, multi_otsu_thresholds(image, classes))
+        keep = (classes - 1,) if keep_classes is None else keep_classes
+        mask = np.isin(classes_img, keep)
+    elif method == 'ratio':
+        image = ratio_image(frame, *ratio)
+        mask = image > (otsu_threshold(image) if ratio_cut is None else ratio_cut)
+    else:
+        raise ValueError(f"method must be one of {METHODS}")
+
+    if invert:
+        mask = ~mask
+    mask = binary_open(mask, open_radius)
+    mask = binary_close(mask, close_radius)
+    mask = filter_components(mask, min_size, max_size)
+    if fill:
+        mask = fill_holes(mask)
+    return mask.astype(np.uint8) * 255
+
+
+def frames_of(stack) -> np.ndarray:
+    # any stack (volume, hyperspectral volume, mosaic tiles) as (frames, channels, ny, nx). 3D input is always
+    # (frames, ny, nx) of one channel, a single multi-channel frame has to come in as frame[None]
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        return stack[None, None]
+    if stack.ndim == 3:
+        return stack[:, None]
+    return stack.reshape((-1,) + stack.shape[-3:])
+
+
+def batch_masks(stack, workers: int = None, **settings) -> np.ndarray:
+    '''masks for every frame of a stack or mosaic, one process pool task per frame
+
+    args:
+        stack: array whose last three axes are (channels, ny, nx), e.g. a load_volume result or mosaic tiles,
+            or a 3D (frames, ny, nx) stack of single channel frames
+        workers: pool size, None for one per core, 0 to run in this process
+        settings: make_mask keyword arguments
+
+    returns: uint8 masks shaped like the stack without the channel axis
+    '''
+
+    stack = np.asarray(stack)
+    frames = frames_of(stack)
+    work = functools.partial(make_mask, **settings)
+    if workers == 0 or len(frames) == 1:
+        masks = [work(f) for f in frames]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            masks = list(pool.map(work, frames, chunksize=max(1, len(frames) // (4 * (workers or os.cpu_count() or 1)))))
+    out_shape = stack.shape[:-3] + stack.shape[-2:] if stack.ndim >= 4 else (len(frames),) + stack.shape[-2:]
+    return np.stack(masks).reshape(out_shape)
+
+
+def scan_mask(mask, galvo) -> 'Image.Image':
+    '''pad a frame sized mask to the full raster, so the ttl compiler never has to resize it
+
+    args:
+        mask: uint8 mask of (numsteps_y, numsteps_x)
+        galvo: Galvo the mask is played on, the padding columns (and rows, for galvos that pad y) stay off
+
+    returns: PIL 'L' image of (total_y, total_x)
+    '''
+
+    mask = np.asarray(mask, dtype=np.uint8)
+    if mask.shape != (galvo.numsteps_y, galvo.numsteps_x):
+        raise ValueError(f"Mask is {mask.shape}, the scan is {(galvo.numsteps_y, galvo.numsteps_x)}.")
+    left = getattr(galvo, 'extrasteps_left', getattr(galvo, 'numsteps_extra', 0))
+    top = (galvo.total_y - galvo.numsteps_y) // 2
+    full = np.zeros((galvo.total_y, galvo.total_x), dtype=np.uint8)
+    full[top:top + mask.shape[0], left:left + mask.shape[1]] = mask
+    from PIL import Image
+    return Image.fromarray(full, 'L')
+
+
+def save_masks(masks, out_dir, prefix: str = 'mask') -> list:
+    '''write masks as png, the format the gui's Load Mask reads
+
+    args:
+        masks: uint8 masks, any leading shape
+        out_dir: folder, created if needed
+        prefix: file name prefix, the flat frame index is appended
+
+    returns: list of written paths
+    '''
+
+    masks = np.asarray(masks, dtype=np.uint8)
+    masks = masks.reshape((-1,) + masks.shape[-2:])
+    from PIL import Image
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for i, mask in enumerate(masks):
+        path = os.path.join(out_dir, f'{prefix}_{i:04d}.png')
+        Image.fromarray(mask, 'L').save(path)
+        paths.append(path)
+    return paths
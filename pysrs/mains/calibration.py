@@ -1,11 +1,123 @@
 # calibration.py
 import tkinter as tk
 from tkinter import ttk, messagebox
-import time, threading
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from pysrs.instruments.galvo_funcs import Galvo
+import threading
+import numpy as np
+from pysrs.aaaa.instruments.galvos import Galvo
 from pysrs.aaaa.acquisition.acquire import lockin_scan
+from pysrs.aaaa.acquisition.multidev import full_channel_names
+from utils import generate_data
+from calibration_table import CalibrationTable
+
+CAL_MODES = ['Point', 'Line', 'Full Frame'] # point parks the galvos, line scans one row, full frame is the old behaviour
+FIT_MODELS = ['Gaussian', 'Lorentzian', 'None']
+
+
+def peak_model(x, params, model='Gaussian'):
+    # params are (offset, amplitude, center, fwhm) for both models so the fits are directly comparable
+    offset, amp, center, fwhm = params
+    x = np.asarray(x, dtype=float)
+    if model == 'Lorentzian':
+        half = fwhm / 2
+        return offset + amp * half**2 / ((x - center)**2 + half**2)
+    sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+    return offset + amp * np.exp(-0.5 * ((x - center) / sigma)**2)
+
+
+def fit_peak(positions, intensities, model='Gaussian', max_iter=100):
+    '''least squares peak fit (levenberg-marquardt) so the calibration does not need scipy
+
+    args:
+        positions: stage positions in um
+        intensities: measured signal at each position
+        model: 'Gaussian' or 'Lorentzian'
+        max_iter: iteration cap for the solver
+
+    returns: dict with offset, amplitude, center, fwhm and the model name
+    '''
+
+    x = np.asarray(positions, dtype=float)
+    y = np.asarray(intensities, dtype=float)
+    if x.size < 4:
+        raise ValueError('Need at least 4 calibration points to fit a peak.')
+
+    offset = y.min()
+    amp = y.max() - offset
+    center = x[np.argmax(y)]
+    above = x[y >= offset + amp / 2]
+    fwhm = max(above.max() - above.min(), np.ptp(x) / x.size)
+    params = np.array([offset, amp, center, fwhm])
+
+    damping = 1e-3
+    residual = y - peak_model(x, params, model)
+    cost = residual @ residual
+    for _ in range(max_iter):
+        steps = 1e-6 * np.maximum(np.abs(params), 1.0) # relative step, but not vanishing for params near 0
+        jac = np.empty((x.size, params.size))
+        for i in range(params.size): # 4 params, cheap to do numerically
+            shifted = params.copy()
+            shifted[i] += steps[i]
+            jac[:, i] = (peak_model(x, shifted, model) - peak_model(x, params, model)) / steps[i]
+        jtj = jac.T @ jac
+        grad = jac.T @ residual
+        try:
+            delta = np.linalg.solve(jtj + damping * np.diag(np.diag(jtj) + 1e-12), grad)
+        except np.linalg.LinAlgError:
+            break
+        trial = params + delta
+        trial[3] = abs(trial[3])
+        trial_residual = y - peak_model(x, trial, model)
+        trial_cost = trial_residual @ trial_residual
+        if trial_cost < cost:
+            converged = cost - trial_cost < 1e-12 * max(cost, 1e-12)
+            params, residual, cost = trial, trial_residual, trial_cost
+            damping /= 10
+            if converged:
+                break
+        else:
+            damping *= 10
+            if damping > 1e10:
+                break
+
+    return {'model': model, 'offset': params[0], 'amplitude': params[1],
+            'center': params[2], 'fwhm': params[3]}
+
+
+def make_probe(gui, mode, n_samples):
+    # returns a read() callable giving one intensity value per stage position and a cleanup callable
+    config = gui.config.snapshot() # the whole sweep probes with one config
+    channels = full_channel_names(config)
+
+    if gui.simulation_mode.get():
+        rng = np.random.default_rng()
+        def read(pos):
+            if mode == 'Full Frame':
+                return generate_data(len(channels), config=config)[0].mean()
+            peak = np.exp(-0.5 * ((pos - gui.hyper_config['single_um']) / 500)**2)
+            return peak + rng.normal(0, 0.02, n_samples).mean()
+        return read, lambda: None
+
+    if mode == 'Full Frame':
+        def read(pos):
+            galvo = Galvo(config)
+            return lockin_scan(channels, galvo)[0].mean()
+        return read, lambda: None
+
+    if mode == 'Line':
+        galvo = Galvo({**config, 'numsteps_y': 1, 'amp_y': 0.0}) # a single row through the center of the frame
+        def read(pos):
+            return lockin_scan(channels, galvo)[0].mean()
+        return read, lambda: None
+
+    from pysrs.aaaa.instruments.arb_input import LockIn # pulls in nidaqmx, only when a point calibration runs
+    Galvo(config).park()
+    device, chan = channels[0].split('/', 1) # the first channel may be on another card
+    lockin = LockIn(device, chan, sampling_rate=config['rate'])
+    lockin.open()
+    def read(pos):
+        return lockin.read_burst(n_samples).mean()
+    return read, lockin.close
+
 
 def calibrate_stage(gui):
     cal_win = tk.Toplevel(gui.root)
@@ -30,20 +142,86 @@ def calibrate_stage(gui):
     cal_steps_entry.insert(0, '10')
     cal_steps_entry.grid(row=2, column=1, padx=5, pady=3)
 
+    ttk.Label(config_frame, text='Mode').grid(row=0, column=2, sticky='w', padx=5, pady=3)
+    mode_var = tk.StringVar(value=CAL_MODES[0])
+    ttk.Combobox(config_frame, textvariable=mode_var, values=CAL_MODES, state='readonly',
+                 width=12).grid(row=0, column=3, padx=5, pady=3)
+
+    ttk.Label(config_frame, text='Samples / Position').grid(row=1, column=2, sticky='w', padx=5, pady=3)
+    samples_entry = ttk.Entry(config_frame, width=10, font=('Calibri', 14))
+    samples_entry.insert(0, '1000')
+    samples_entry.grid(row=1, column=3, padx=5, pady=3)
+
+    ttk.Label(config_frame, text='Peak Fit').grid(row=2, column=2, sticky='w', padx=5, pady=3)
+    fit_var = tk.StringVar(value=FIT_MODELS[0])
+    ttk.Combobox(config_frame, textvariable=fit_var, values=FIT_MODELS, state='readonly',
+                 width=12).grid(row=2, column=3, padx=5, pady=3)
+
+    fit_label = ttk.Label(config_frame, text='')
+    fit_label.grid(row=3, column=2, columnspan=2, sticky='w', padx=5, pady=3)
+
     start_button = ttk.Button(config_frame, text='Start Calibration', style='TButton')
     start_button.grid(row=3, column=0, columnspan=2, padx=5, pady=10)
 
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
     fig = Figure(figsize=(5, 3), dpi=100)
     ax = fig.add_subplot(111)
     ax.set_title('Calibration Data')
     ax.set_xlabel('Stage Position (µm)')
     ax.set_ylabel('Average Intensity')
+    data_line, = ax.plot([], [], '-o', color='blue')
+    fit_line, = ax.plot([], [], '--', color='red')
 
     canvas = FigureCanvasTkAgg(fig, master=cal_win)
     canvas_widget = canvas.get_tk_widget()
     canvas_widget.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
+    ttk.Label(config_frame, text='Known Shift (cm⁻¹)').grid(row=4, column=2, sticky='w', padx=5, pady=3)
+    shift_entry = ttk.Entry(config_frame, width=10, font=('Calibri', 14))
+    shift_entry.grid(row=4, column=3, padx=5, pady=3)
+
     cal_running = [False]
+    last_fit = [None]
+
+    def save_to_table():
+        # store the fitted peak center against the known band so later sessions can scan in cm^-1
+        if last_fit[0] is None:
+            messagebox.showerror("Error", "Run a calibration with a peak fit first.")
+            return
+        try:
+            shift = float(shift_entry.get().strip())
+        except ValueError:
+            messagebox.showerror("Error", "Enter the known Raman shift of the calibration peak.")
+            return
+        # work on a copy so a rejected point never reaches the table the scans are using
+        live = gui.calibration_table or CalibrationTable()
+        table = CalibrationTable(live.positions_um, live.shifts_cm, live.revision, dict(live.metadata))
+        table.add_point(last_fit[0]['center'], shift)
+        table.metadata['last_fit'] = {k: (float(v) if k != 'model' else v) for k, v in last_fit[0].items()}
+        try:
+            path = table.save()
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Could not save calibration: {e}")
+            return
+        gui.calibration_table = table
+        gui.update_calibration_status()
+        messagebox.showinfo("Saved", f"Calibration saved to {path} ({len(table)} points).")
+
+    def update_plot(positions, intensities):
+        # only the line data changes, the axes are never rebuilt
+        data_line.set_data(positions, intensities)
+        ax.relim()
+        ax.autoscale_view()
+        canvas.draw_idle()
+
+    def show_fit(positions, result):
+        last_fit[0] = result
+        xs = np.linspace(min(positions), max(positions), 500)
+        fit_line.set_data(xs, peak_model(xs, (result['offset'], result['amplitude'],
+                                              result['center'], result['fwhm']), result['model']))
+        fit_label.config(text=f"{result['model']}: center {result['center']:.1f} µm, FWHM {result['fwhm']:.1f} µm")
+        canvas.draw_idle()
 
     def run_calibration():
         cal_running[0] = True
@@ -51,7 +229,8 @@ def calibrate_stage(gui):
             start_val = float(start_entry.get().strip())
             stop_val = float(stop_entry.get().strip())
             n_steps = int(cal_steps_entry.get().strip())
-            if n_steps < 1 or start_val >= stop_val:
+            n_samples = int(samples_entry.get().strip())
+            if n_steps < 1 or n_samples < 1 or start_val >= stop_val:
                 raise ValueError
         except ValueError:
             messagebox.showerror("Error", "Invalid calibration settings.")
@@ -65,42 +244,43 @@ def calibrate_stage(gui):
             cal_running[0] = False
             return
 
-        positions_to_scan = [start_val] if n_steps == 1 else [start_val + i * (stop_val - start_val) / (n_steps - 1) for i in range(n_steps)]
-        positions, intensities = [], []
-
-        for pos in positions_to_scan:
-            if not cal_running[0]:
-                break
-            try:
-                gui.zaber_stage.move_absolute_um(pos)
-            except Exception as e:
-                messagebox.showerror("Zaber Error", str(e))
-                cal_running[0] = False
-                break
-
-            if gui.simulation_mode.get():
-                data_list = gui.generate_data(len(gui.config['ai_chans']))
-                data = data_list[0]
-            else:
-                galvo = Galvo(gui.config)
-                data_list = lockin_scan([f"{gui.config['device']}/{ch}" for ch in gui.config['ai_chans']], galvo)
-                data = data_list[0]
+        mode, model = mode_var.get(), fit_var.get()
+        try:
+            read, cleanup = make_probe(gui, mode, n_samples)
+        except Exception as e:
+            messagebox.showerror("DAQ Error", str(e))
+            cal_running[0] = False
+            return
 
-            avg_val = data.mean()
-            positions.append(pos)
-            intensities.append(avg_val)
+        positions_to_scan = np.linspace(start_val, stop_val, n_steps)
+        positions, intensities = [], []
+        last_fit[0] = None # a fit of an older sweep must not be saved against this one
+        cal_win.after(0, fit_line.set_data, [], [])
 
-            ax.clear()
-            ax.set_title('Calibration Data')
-            ax.set_xlabel('Stage Position (µm)')
-            ax.set_ylabel('Average Intensity')
-            ax.plot(positions, intensities, '-o', color='blue')
-            canvas.draw()
-            canvas.flush_events()
+        try:
+            for pos in positions_to_scan:
+                if not cal_running[0]:
+                    break
+                try:
+                    gui.zaber_stage.move_absolute_um(pos)
+                except Exception as e:
+                    messagebox.showerror("Zaber Error", str(e))
+                    break
 
-            time.sleep(0.2)
+                positions.append(pos)
+                intensities.append(read(pos))
+                cal_win.after(0, update_plot, list(positions), list(intensities))
+        finally:
+            cleanup()
+            cal_running[0] = False
 
-        cal_running[0] = False
+        if model != 'None' and len(positions) >= 4:
+            try:
+                result = fit_peak(positions, intensities, model)
+                cal_win.after(0, show_fit, positions, result)
+            except Exception as e:
+                last_fit[0] = None
+                cal_win.after(0, lambda msg=f'Fit failed: {e}': fit_label.config(text=msg))
 
     def start_cal():
         if not cal_running[0]:
@@ -111,3 +291,6 @@ def calibrate_stage(gui):
     stop_button = ttk.Button(config_frame, text='Stop Calibration', style='TButton',
                              command=lambda: cal_running.__setitem__(0, False))
     stop_button.grid(row=4, column=0, columnspan=2, padx=5, pady=5)
+
+    save_button = ttk.Button(config_frame, text='Save to Table', style='TButton', command=save_to_table)
+    save_button.grid(row=5, column=2, columnspan=2, padx=5, pady=5)
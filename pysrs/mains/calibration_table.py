@@ -0,0 +1,157 @@
+# calibration_table.py
+import json, os, time
+from pathlib import Path
+import numpy as np
+
+CACHE_DIR = Path.home() / '.pysrs' / 'calibration' # local cache so calibrations survive between sessions
+FORMAT_VERSION = 1
+
+
+def unique_pairs(xp, fp):
+    # sorted xp with exactly repeated (xp, fp) pairs dropped, one xp with two different fp is refused
+    pairs = np.unique(np.column_stack([np.asarray(xp, dtype=float), np.asarray(fp, dtype=float)]), axis=0)
+    xp, fp = pairs[:, 0], pairs[:, 1]
+    if len(np.unique(xp)) < len(xp):
+        raise ValueError('Calibration table maps one value to several others.')
+    return xp, fp
+
+
+def interp_linear(x, xp, fp):
+    # np.interp but with linear extrapolation off both ends instead of clamping
+    x = np.atleast_1d(np.asarray(x, dtype=float))
+    xp, fp = unique_pairs(xp, fp)
+    out = np.interp(x, xp, fp)
+    if len(xp) >= 2:
+        lo, hi = x < xp[0], x > xp[-1]
+        out[lo] = fp[0] + (x[lo] - xp[0]) * (fp[1] - fp[0]) / (xp[1] - xp[0])
+        out[hi] = fp[-1] + (x[hi] - xp[-1]) * (fp[-1] - fp[-2]) / (xp[-1] - xp[-2])
+    return out
+
+
+class CalibrationTable:
+    def __init__(self, positions_um=(), shifts_cm=(), revision: int = 0, metadata: dict = None) -> None:
+        '''stage position <-> raman shift lookup built from calibration peaks
+
+        args:
+            positions_um: delay stage positions of the calibration peaks
+            shifts_cm: known raman shifts of those peaks in cm^-1
+            revision: save counter, the highest revision in the cache is loaded at startup
+            metadata: anything else worth keeping with the table (sample, fit model, ...)
+
+        returns: none
+        '''
+
+        self.positions_um = [float(p) for p in positions_um]
+        self.shifts_cm = [float(s) for s in shifts_cm]
+        self.revision = revision
+        self.metadata = metadata or {}
+
+    def __len__(self):
+        return len(self.positions_um)
+
+    def is_valid(self) -> bool:
+        # two peaks at the same position (or band) give no slope to interpolate with
+        return len(set(self.positions_um)) >= 2 and len(set(self.shifts_cm)) >= 2
+
+    def add_point(self, position_um: float, shift_cm: float) -> None:
+        # replace any existing entry for the same band so recalibrating one peak does not duplicate it
+        for i, shift in enumerate(self.shifts_cm):
+            if abs(shift - shift_cm) < 1e-6:
+                self.positions_um[i] = float(position_um)
+                return
+        self.positions_um.append(float(position_um))
+        self.shifts_cm.append(float(shift_cm))
+
+    def _sorted(self, by_shift=False):
+        pos = np.asarray(self.positions_um)
+        shifts = np.asarray(self.shifts_cm)
+        order = np.argsort(shifts if by_shift else pos)
+        return pos[order], shifts[order]
+
+    def shift_to_um(self, shifts_cm) -> np.ndarray:
+        '''convert raman shifts to stage positions, vectorized over the whole grid
+
+        args:
+            shifts_cm: scalar or array of raman shifts in cm^-1
+
+        returns: array of stage positions in um
+        '''
+
+        if not self.is_valid():
+            raise ValueError('Calibration table needs at least 2 distinct points.')
+        pos, shifts = self._sorted(by_shift=True)
+        return interp_linear(shifts_cm, shifts, pos)
+
+    def um_to_shift(self, positions_um) -> np.ndarray:
+        '''convert stage positions to raman shifts
+
+        args:
+            positions_um: scalar or array of stage positions in um
+
+        returns: array of raman shifts in cm^-1
+        '''
+
+        if not self.is_valid():
+            raise ValueError('Calibration table needs at least 2 distinct points.')
+        pos, shifts = self._sorted()
+        return interp_linear(positions_um, pos, shifts)
+
+    def to_dict(self) -> dict:
+        return {
+            'format_version': FORMAT_VERSION,
+            'revision': self.revision,
+            'saved': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'positions_um': self.positions_um,
+            'shifts_cm': self.shifts_cm,
+            'metadata': self.metadata,
+        }
+
+    def save(self, cache_dir=CACHE_DIR) -> Path:
+        '''write the table as a new revision in the cache, older revisions are kept
+
+        args:
+            cache_dir: directory holding the calibration revisions
+
+        returns: path of the written file
+        '''
+
+        # identical points are dropped, two bands at one position (or one band at two) is a bad table
+        pos, shifts = np.asarray(self.positions_um), np.asarray(self.shifts_cm)
+        pairs = np.unique(np.column_stack([pos, shifts]), axis=0) if len(pos) else np.empty((0, 2))
+        if len(np.unique(pairs[:, 0])) < len(pairs):
+            raise ValueError('Calibration table maps one position to several Raman shifts.')
+        if len(np.unique(pairs[:, 1])) < len(pairs):
+            raise ValueError('Calibration table maps one Raman shift to several positions.')
+        self.positions_um, self.shifts_cm = pairs[:, 0].tolist(), pairs[:, 1].tolist()
+
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        latest = CalibrationTable.load_latest(cache_dir)
+        self.revision = (latest.revision if latest else 0) + 1
+        path = cache_dir / f'calibration_r{self.revision:04d}.json'
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(tmp, path) # never leave a half written table behind
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            d = json.load(f)
+        if d.get('format_version', 0) > FORMAT_VERSION:
+            raise ValueError(f'{path} was written by a newer version of pysrs.')
+        return cls(d['positions_um'], d['shifts_cm'], d.get('revision', 0), d.get('metadata'))
+
+    @classmethod
+    def load_latest(cls, cache_dir=CACHE_DIR):
+        # returns None instead of raising so startup works on a fresh machine
+        cache_dir = Path(cache_dir)
+        if not cache_dir.is_dir():
+            return None
+        for path in sorted(cache_dir.glob('calibration_r*.json'), reverse=True):
+            try:
+                return cls.load(path)
+            except (ValueError, KeyError, OSError, json.JSONDecodeError) as e:
+                print(f'[WARN] Skipping unreadable calibration {path.name}: {e}')
+        return None
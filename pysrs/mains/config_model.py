@@ -0,0 +1,184 @@
+# config_model.py
+import threading
+from collections.abc import Mapping
+from types import MappingProxyType
+
+'''
+thread safe acquisition config
+
+the gui used to keep a plain dict that update_config rebuilt from the tk entries, and acquisition threads
+called update_config themselves, every frame in the old scan loop, touching widgets from outside the tk
+thread. now the entries are parsed once on the tk thread into a ConfigModel that validates every field,
+notifies subscribers of real changes only, and hands workers immutable snapshots. a worker takes one
+snapshot per acquisition (or re-takes it when the version moves) and never touches a widget.
+'''
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def parse_list(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return tuple(v.strip() for v in value if str(v).strip())
+
+
+def parse_optional_int(value):
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    return int(value)
+
+
+def parse_demod(value):
+    if value is None:
+        return None
+    if not isinstance(value, Mapping):
+        raise ConfigError('demod must be a dict of demodulate_raster settings or None')
+    return dict(value)
+
+
+# key -> (parser, check on the parsed value or None, message when the check fails)
+FIELDS = {
+    'device': (str, lambda v: bool(v.strip()), 'device name cannot be empty'),
+    'ao_chans': (parse_list, lambda v: len(v) == 2, 'need exactly 2 AO channels (x, y)'),
+    'ai_chans': (parse_list, lambda v: len(v) >= 1, 'need at least 1 AI channel'),
+    'channel_names': (parse_list, None, ''),
+    'zaber_chan': (str, lambda v: bool(v.strip()), 'zaber port cannot be empty'),
+    'amp_x': (float, lambda v: v >= 0, 'amplitude must be >= 0'),
+    'amp_y': (float, lambda v: v >= 0, 'amplitude must be >= 0'),
+    'rate': (float, lambda v: v > 0, 'sample rate must be > 0'),
+    'numsteps_x': (int, lambda v: v >= 1, 'need at least 1 step'),
+    'numsteps_y': (int, lambda v: v >= 1, 'need at least 1 step'),
+    'numsteps_extra': (int, lambda v: v >= 0, 'padding cannot be negative'),
+    'dwell': (float, lambda v: v > 0, 'dwell time must be > 0'),
+    'demod': (parse_demod, None, ''),
+    'sim_seed': (parse_optional_int, None, ''),
+}
+
+# changes to these need a new raster waveform (and TTL), anything else can be picked up without a rebuild
+WAVEFORM_KEYS = {'device', 'ao_chans', 'amp_x', 'amp_y', 'rate', 'numsteps_x', 'numsteps_y', 'numsteps_extra', 'dwell'}
+CHANNEL_KEYS = {'device', 'ai_chans', 'channel_names'}
+
+
+class ConfigModel(Mapping):
+    def __init__(self, values: dict) -> None:
+        '''validated config that reads like a dict
+
+        args:
+            values: initial value of every field in FIELDS that should be set
+
+        returns: none
+        '''
+
+        self._lock = threading.RLock()
+        self._values = {}
+        self._versions = {} # key -> version it last changed at
+        self._subscribers = []
+        self.version = 0
+        self.update(values, notify=False)
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._values[key]
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._values))
+
+    def __len__(self):
+        return len(self._values)
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __repr__(self):
+        return f'ConfigModel(v{self.version}, {dict(self.snapshot())})'
+
+    @staticmethod
+    def parse(key: str, value):
+        '''convert and validate one field, strings from tk entries are fine
+
+        args:
+            key: field name, must be in FIELDS
+            value: raw value
+
+        returns: parsed value, raises ConfigError
+        '''
+
+        if key not in FIELDS:
+            raise ConfigError(f'Unknown config field {key}.')
+        parser, check, message = FIELDS[key]
+        try:
+            parsed = parser(value.strip() if isinstance(value, str) else value)
+        except (TypeError, ValueError) as e:
+            raise ConfigError(f'Invalid value for {key}: {value!r}') from e
+        if check is not None and not check(parsed):
+            raise ConfigError(f'Invalid value for {key}: {message}.')
+        return parsed
+
+    def update(self, values: dict, notify: bool = True) -> dict:
+        '''set several fields at once, all or nothing
+
+        args:
+            values: key -> raw value
+            notify: call the subscribers with what changed
+
+        returns: dict of key -> (old, new) for the fields that actually changed
+        '''
+
+        parsed = {key: self.parse(key, value) for key, value in values.items()} # raises before anything is set
+        with self._lock:
+            changes = {key: (self._values.get(key), value) for key, value in parsed.items()
+                       if key not in self._values or self._values[key] != value}
+            if changes:
+                self.version += 1
+                for key, (_, value) in changes.items():
+                    self._values[key] = value
+                    self._versions[key] = self.version
+            subscribers = list(self._subscribers)
+        if changes and notify:
+            for callback, keys in subscribers:
+                relevant = changes if keys is None else {k: v for k, v in changes.items() if k in keys}
+                if relevant:
+                    callback(relevant)
+        return changes
+
+    def subscribe(self, callback, keys=None):
+        '''call callback(changes) after every real change, on the thread that made it
+
+        args:
+            callback: callable taking a dict of key -> (old, new)
+            keys: only these fields, None for all
+
+        returns: callable that unsubscribes
+        '''
+
+        entry = (callback, None if keys is None else set(keys))
+        with self._lock:
+            self._subscribers.append(entry)
+        def unsubscribe():
+            with self._lock:
+                if entry in self._subscribers:
+                    self._subscribers.remove(entry)
+        return unsubscribe
+
+    def snapshot(self) -> MappingProxyType:
+        # read only copy for one acquisition, later edits in the gui never show up in it
+        return self.versioned_snapshot()[1]
+
+    def versioned_snapshot(self):
+        '''snapshot together with the version it was taken at, to check later what changed since
+
+        args: none
+
+        returns: (version, read only mapping)
+        '''
+
+        with self._lock:
+            values = {k: dict(v) if isinstance(v, dict) else v for k, v in self._values.items()}
+            return self.version, MappingProxyType(values)
+
+    def changed_since(self, version: int) -> set:
+        with self._lock:
+            return {key for key, v in self._versions.items() if v > version}
@@ -1,8 +1,10 @@
 import numpy as np
-from mpl_toolkits.axes_grid1 import make_axes_locatable
 import math
 
 def create_axes(gui, n_channels):
+    from mpl_toolkits.axes_grid1 import make_axes_locatable # matplotlib is loaded with the display, after the window is up
+    if gui.fig is None:
+        gui.create_display() # a frame arrived before the deferred display was built
     gui.fig.clf()
     gui.fig.patch.set_facecolor('#1E1E1E') 
 
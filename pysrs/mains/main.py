@@ -1,7 +1,13 @@
+import sys
 import tkinter as tk
-from pysrs.aaaa.gui.gui import GUI
+from startup import PhaseTimer
 
 if __name__ == '__main__':
+    timer = PhaseTimer(expected=('imports', 'widgets', 'window', 'display', 'instruments'))
+    with timer.phase('imports'):
+        from pysrs.aaaa.gui.gui import GUI
     root = tk.Tk()
-    app = GUI(root)
+    app = GUI(root, timer=timer)
+    if '--api' in sys.argv: # localhost control api next to the gui, see pysrs/aaaa/acquisition/api.py
+        app.start_api()
     root.mainloop()
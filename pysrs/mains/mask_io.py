@@ -0,0 +1,235 @@
+# mask_io.py
+import json
+import os
+import struct
+import time
+from collections.abc import Mapping
+import numpy as np
+from pysrs.aaaa.instruments.galvos import Galvo
+
+'''
+compact rpoc mask files (.rmask)
+
+a record is a small json header (mask shape, the scan geometry it was made for, encoding) followed by the mask
+either as per row run lengths or as bit packed rows, whichever is smaller. runs go straight to the TTL
+pattern with a cumulative sum over run edges, so loading a mask for the daq never decodes or resizes an image.
+a file can hold any number of records back to back, a library of hundreds of masks is one read.
+
+layout per record: b'RMSK', uint8 version, uint32 header length, header json, payload
+'''
+
+MAGIC = b'RMSK'
+VERSION = 1
+EXTENSION = '.rmask'
+# grid, padding and field of view, a mask only lines up with a scan that matches on all of them
+GEOMETRY_KEYS = ['numsteps_x', 'numsteps_y', 'extrasteps_left', 'extrasteps_right', 'amp_x', 'amp_y', 'offset_x', 'offset_y']
+
+
+class RMask:
+    def __init__(self, shape: tuple, counts: np.ndarray, starts: np.ndarray, stops: np.ndarray,
+                 geometry: dict = None, metadata: dict = None) -> None:
+        '''binary mask held as row runs
+
+        args:
+            shape: (ny, nx)
+            counts: runs per row, length ny
+            starts, stops: run bounds (stop exclusive), ordered by row then start
+            geometry: scan the mask was made for, GEOMETRY_KEYS taken from the galvo or config
+            metadata: anything else, e.g. source file or channel
+
+        returns: none
+        '''
+
+        self.shape = tuple(int(n) for n in shape)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+        self.geometry = dict(geometry or {})
+        self.metadata = dict(metadata or {})
+
+    @classmethod
+    def from_array(cls, mask, geometry: dict = None, metadata: dict = None, threshold: int = 128) -> 'RMask':
+        '''runs from a 2D mask, values above threshold are on (bool masks are used as is)'''
+
+        mask = np.asarray(mask)
+        on = mask if mask.dtype == bool else mask > threshold
+        ny, nx = on.shape
+        padded = np.zeros((ny, nx + 2), dtype=np.int8)
+        padded[:, 1:-1] = on
+        edges = np.diff(padded, axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        _, stops = np.nonzero(edges == -1)
+        return cls((ny, nx), np.bincount(rows, minlength=ny), starts, stops, geometry, metadata)
+
+    def rows(self) -> np.ndarray:
+        return np.repeat(np.arange(self.shape[0]), self.counts)
+
+    def to_array(self) -> np.ndarray:
+        '''uint8 0/255 image of the mask, only needed for display'''
+
+        ny, nx = self.shape
+        edges = np.zeros(ny * nx + 1, dtype=np.int32)
+        base = self.rows() * nx
+        np.add.at(edges, base + self.starts, 1)
+        np.add.at(edges, base + self.stops, -1)
+        return (np.cumsum(edges[:-1]) > 0).reshape(ny, nx).astype(np.uint8) * 255
+
+    def coverage(self) -> float:
+        return float((self.stops - self.starts).sum() / max(self.shape[0] * self.shape[1], 1))
+
+    def ttl(self, galvo, out: np.ndarray = None) -> np.ndarray:
+        '''TTL pattern straight from the runs, same result as galvo.ttl_waveform on the decoded mask
+
+        args:
+            galvo: Galvo to play on, the mask must be frame sized (numsteps) or raster sized (total) and made for
+                the same geometry (zoom, offset, padding) when it has one stored
+            out: optional preallocated bool array of total_samples
+
+        returns: bool array of total_samples
+        '''
+
+        differs = geometry_mismatch(self.geometry, geometry_of(galvo))
+        if differs:
+            raise ValueError(f'Mask was made for another scan geometry: {differs}.')
+        ny, nx = self.shape
+        if (ny, nx) == (galvo.numsteps_y, galvo.numsteps_x):
+            left = galvo.extrasteps_left
+        elif (ny, nx) == (galvo.total_y, galvo.total_x):
+            left = 0
+        else:
+            raise ValueError(f'Mask was made for {(ny, nx)}, the scan is {(galvo.numsteps_y, galvo.numsteps_x)}.')
+        base = (self.rows() * galvo.total_x + left) * galvo.pixel_samples
+        edges = np.zeros(galvo.total_samples + 1, dtype=np.int8)
+        # starts are all distinct and so are stops, so each fancy indexed add sees every slot at most once
+        edges[base + self.starts * galvo.pixel_samples] += 1
+        edges[base + self.stops * galvo.pixel_samples] -= 1
+        if out is None:
+            out = np.empty(galvo.total_samples, dtype=bool)
+        np.cumsum(edges[:-1], out=edges[:-1])
+        np.greater(edges[:-1], 0, out=out)
+        return out
+
+    def encode(self) -> bytes:
+        ny, nx = self.shape
+        run_dtype = np.uint16 if nx < 2**16 else np.uint32
+        count_dtype = np.uint16 if nx < 2**16 else np.uint32
+        runs = np.empty((len(self.starts), 2), dtype=run_dtype)
+        runs[:, 0], runs[:, 1] = self.starts, self.stops
+        run_payload = self.counts.astype(count_dtype).tobytes() + runs.tobytes()
+        bits_size = ny * ((nx + 7) // 8)
+        if len(run_payload) <= bits_size:
+            encoding, payload = 'runs', run_payload
+        else:
+            on = np.zeros((ny, nx), dtype=bool)
+            on[self.to_array() > 0] = True
+            encoding, payload = 'bits', np.packbits(on, axis=1).tobytes()
+        header = {
+            'shape': [ny, nx],
+            'encoding': encoding,
+            'run_dtype': np.dtype(run_dtype).name,
+            'runs': int(len(self.starts)),
+            'payload_bytes': len(payload),
+            'geometry': self.geometry,
+            'metadata': self.metadata,
+        }
+        head = json.dumps(header).encode()
+        return MAGIC + struct.pack('<BI', VERSION, len(head)) + head + payload
+
+    @classmethod
+    def decode(cls, buffer, offset: int = 0):
+        '''one record from a bytes like buffer
+
+        returns: (RMask, offset of the next record)
+        '''
+
+        view = memoryview(buffer)
+        if bytes(view[offset:offset + 4]) != MAGIC:
+            raise ValueError('Not an rmask record.')
+        version, head_len = struct.unpack_from('<BI', view, offset + 4)
+        if version > VERSION:
+            raise ValueError(f'rmask version {version} is newer than this reader ({VERSION}).')
+        start = offset + 9
+        header = json.loads(bytes(view[start:start + head_len]))
+        start += head_len
+        end = start + header['payload_bytes']
+        ny, nx = header['shape']
+        if header['encoding'] == 'runs':
+            dtype = np.dtype(header['run_dtype'])
+            counts = np.frombuffer(view[start:start + ny * dtype.itemsize], dtype=dtype)
+            runs = np.frombuffer(view[start + ny * dtype.itemsize:end], dtype=dtype).reshape(-1, 2)
+            mask = cls((ny, nx), counts, runs[:, 0], runs[:, 1], header['geometry'], header['metadata'])
+        else:
+            bits = np.frombuffer(view[start:end], dtype=np.uint8).reshape(ny, -1)
+            mask = cls.from_array(np.unpackbits(bits, axis=1, count=nx).astype(bool), header['geometry'], header['metadata'])
+        return mask, end
+
+
+def geometry_of(source) -> dict:
+    # scan geometry from a Galvo or a config mapping, a config goes through Galvo so unset keys get its defaults
+    if isinstance(source, Mapping):
+        source = Galvo(dict(source))
+    return {key: getattr(source, key) for key in GEOMETRY_KEYS if getattr(source, key, None) is not None}
+
+
+def geometry_mismatch(stored: dict, scan: dict) -> str:
+    # '' if the scan matches every key the mask stored (older masks stored fewer), else what differs
+    differs = [f'{key} {stored[key]} vs {scan[key]}' for key in GEOMETRY_KEYS
+               if key in stored and key in scan and not np.isclose(float(stored[key]), float(scan[key]))]
+    return ', '.join(differs)
+
+
+def save_mask(path, mask, geometry=None, metadata: dict = None) -> str:
+    '''write one mask
+
+    args:
+        path: output file, .rmask is added if missing
+        mask: 2D array (values above 128 or True are on) or an RMask
+        geometry: Galvo or config dict the mask was made for, optional
+        metadata: extra header fields
+
+    returns: path written
+    '''
+
+    return save_masks(path, [mask], geometry, metadata)
+
+
+def save_masks(path, masks, geometry=None, metadata: dict = None) -> str:
+    '''write a mask library, all records in one file'''
+
+    path = str(path)
+    if not path.endswith(EXTENSION):
+        path += EXTENSION
+    geometry = geometry_of(geometry) if geometry is not None else None
+    meta = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), **(metadata or {})}
+    with open(path, 'wb') as f:
+        for mask in masks:
+            if not isinstance(mask, RMask):
+                mask = RMask.from_array(mask, geometry, meta)
+            f.write(mask.encode())
+    return path
+
+
+def load_masks(path) -> list:
+    '''every record of an .rmask file, or of every .rmask file in a folder (sorted by name)
+
+    args:
+        path: file or folder
+
+    returns: list of RMask
+    '''
+
+    path = str(path)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(EXTENSION))
+        return [mask for f in files for mask in load_masks(f)]
+    with open(path, 'rb') as f:
+        buffer = f.read() # one read for the whole library, the records are views into it
+    masks, offset = [], 0
+    while offset < len(buffer):
+        mask, offset = RMask.decode(buffer, offset)
+        masks.append(mask)
+    return masks
+
+
+def load_mask(path) -> RMask:
+    return load_masks(path)[0]
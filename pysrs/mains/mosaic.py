@@ -0,0 +1,248 @@
+# mosaic.py
+import json
+import os
+import numpy as np
+
+'''
+xy tiled mosaics on the prior stage
+
+tiles are visited in a serpentine order, each new tile is registered against the neighbours that are
+already in (left/right and above) by fft phase correlation on their overlap strips. the registrations run
+in a process pool while the next tiles are acquired, then a least squares solve turns the pairwise shifts
+into tile positions, the tiles are feather blended, and the result is written as a chunked pyramid that
+can be browsed at any zoom without loading the whole map.
+'''
+
+CHUNK = 512
+MIN_CONFIDENCE = 0.05 # correlation peak below this means the overlap had no structure, trust the stage instead
+
+
+def tile_grid(tiles_x: int, tiles_y: int, step_x_um: float, step_y_um: float, origin=(0, 0)) -> list:
+    '''serpentine tile order so the stage never flies back across the sample
+
+    args:
+        tiles_x, tiles_y: grid size
+        step_x_um, step_y_um: stage step between neighbouring tiles (field of view minus overlap)
+        origin: stage position of tile (0, 0)
+
+    returns: list of (ix, iy, x_um, y_um) in acquisition order
+    '''
+
+    grid = []
+    for iy in range(tiles_y):
+        columns = range(tiles_x) if iy % 2 == 0 else range(tiles_x - 1, -1, -1)
+        for ix in columns:
+            grid.append((ix, iy, origin[0] + ix * step_x_um, origin[1] + iy * step_y_um))
+    return grid
+
+
+def phase_correlation(a, b):
+    '''shift of b relative to a from the normalized cross power spectrum
+
+    args:
+        a, b: 2D arrays of the same shape
+
+    returns: (dy, dx, peak) with subpixel shifts, peak near 1 for a clean match and near 0 for noise
+    '''
+
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    window = np.hanning(a.shape[0])[:, None] * np.hanning(a.shape[1])[None, :] # stops the strip edges dominating
+    fa = np.fft.rfft2((a - a.mean()) * window)
+    fb = np.fft.rfft2((b - b.mean()) * window)
+    cross = fa * np.conj(fb)
+    corr = np.fft.irfft2(cross / (np.abs(cross) + 1e-12), s=a.shape)
+
+    iy, ix = np.unravel_index(np.argmax(corr), corr.shape)
+    peak = corr[iy, ix]
+    shift = []
+    for i, n, axis in ((iy, a.shape[0], 0), (ix, a.shape[1], 1)):
+        # parabola through the peak and its two neighbours for the subpixel part
+        lo = corr[(i - 1) % n, ix] if axis == 0 else corr[iy, (i - 1) % n]
+        hi = corr[(i + 1) % n, ix] if axis == 0 else corr[iy, (i + 1) % n]
+        denom = lo - 2 * peak + hi
+        frac = 0.5 * (lo - hi) / denom if denom != 0 else 0.0
+        s = i + frac
+        shift.append(s - n if s > n / 2 else s)
+    return shift[0], shift[1], float(peak)
+
+
+def register_pair(a, b, direction: str, step_px: int) -> tuple:
+    '''correction to the nominal offset of tile b next to tile a, runs in a worker process
+
+    args:
+        a, b: (channel, y, x) tiles, a is left of b ('x') or above b ('y')
+        direction: 'x' or 'y'
+        step_px: nominal tile step in pixels along direction
+
+    returns: (dy, dx, confidence) correction to add to the nominal offset
+    '''
+
+    ref = np.asarray(a).sum(axis=0)
+    mov = np.asarray(b).sum(axis=0)
+    if direction == 'x':
+        width = ref.shape[1] - step_px
+        dy, dx, peak = phase_correlation(ref[:, step_px:], mov[:, :width])
+    else:
+        height = ref.shape[0] - step_px
+        dy, dx, peak = phase_correlation(ref[step_px:, :], mov[:height, :])
+    return dy, dx, peak
+
+
+def solve_positions(num_tiles: int, pairs: list) -> np.ndarray:
+    '''least squares tile positions from pairwise offsets, tile 0 is pinned at the origin
+
+    args:
+        num_tiles: number of tiles
+        pairs: list of (i, j, dy, dx, weight), meaning tile j sits (dy, dx) pixels from tile i
+
+    returns: (num_tiles, 2) array of (y, x) pixel positions
+    '''
+
+    rows = len(pairs) + 1
+    A = np.zeros((rows, num_tiles))
+    rhs = np.zeros((rows, 2))
+    w = np.ones(rows)
+    for k, (i, j, dy, dx, weight) in enumerate(pairs):
+        A[k, i], A[k, j] = -1, 1
+        rhs[k] = dy, dx
+        w[k] = weight
+    A[-1, 0] = 1 # anchor
+    w[-1] = 1e3
+    positions, *_ = np.linalg.lstsq(A * w[:, None], rhs * w[:, None], rcond=None)
+    return positions
+
+
+def feather_weights(shape) -> np.ndarray:
+    # linear ramp from each edge so overlapping tiles fade into each other instead of leaving seams
+    wy = np.minimum(np.arange(1, shape[0] + 1), np.arange(shape[0], 0, -1)).astype(float)
+    wx = np.minimum(np.arange(1, shape[1] + 1), np.arange(shape[1], 0, -1)).astype(float)
+    return wy[:, None] * wx[None, :]
+
+
+def blend_tiles(tiles: list, positions: np.ndarray) -> np.ndarray:
+    '''place the tiles at their solved positions and feather blend the overlaps
+
+    args:
+        tiles: list of (channel, y, x) arrays, all the same shape
+        positions: (num_tiles, 2) (y, x) pixel positions from solve_positions
+
+    returns: (channel, Y, X) mosaic
+    '''
+
+    positions = np.round(positions - positions.min(axis=0)).astype(int)
+    nc, ny, nx = np.shape(tiles[0])
+    height, width = positions[:, 0].max() + ny, positions[:, 1].max() + nx
+    total = np.zeros((nc, height, width), dtype=np.float32)
+    weight = np.zeros((height, width), dtype=np.float32)
+    w = feather_weights((ny, nx)).astype(np.float32)
+    for tile, (y, x) in zip(tiles, positions):
+        total[:, y:y + ny, x:x + nx] += np.asarray(tile, dtype=np.float32) * w
+        weight[y:y + ny, x:x + nx] += w
+    return total / np.maximum(weight, 1e-12)
+
+
+def downsample(image: np.ndarray) -> np.ndarray:
+    # 2x2 mean over the last two axes, odd edges are padded by repeating the last row/column
+    c, h, w = image.shape
+    image = np.pad(image, ((0, 0), (0, h % 2), (0, w % 2)), mode='edge')
+    return image.reshape(c, image.shape[1] // 2, 2, image.shape[2] // 2, 2).mean(axis=(2, 4))
+
+
+def write_pyramid(image: np.ndarray, out_dir, metadata: dict = None, chunk: int = CHUNK) -> str:
+    '''write a (channel, Y, X) image as a chunked multi resolution pyramid
+
+    layout is out_dir/level_<n>/<row>_<col>.npy plus out_dir/mosaic.json, level 0 is full resolution
+    and every level halves the previous one until it fits in a single chunk
+
+    args:
+        image: (channel, Y, X) array
+        out_dir: directory to create
+        metadata: extra entries for mosaic.json (pixel size, tile grid, ...)
+        chunk: chunk edge length in pixels
+
+    returns: out_dir
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+    levels = []
+    level = np.asarray(image, dtype=np.float32)
+    n = 0
+    while True:
+        level_dir = os.path.join(out_dir, f'level_{n}')
+        os.makedirs(level_dir, exist_ok=True)
+        for r in range(0, level.shape[1], chunk):
+            for c in range(0, level.shape[2], chunk):
+                np.save(os.path.join(level_dir, f'{r // chunk}_{c // chunk}.npy'), level[:, r:r + chunk, c:c + chunk])
+        levels.append(list(level.shape))
+        if max(level.shape[1:]) <= chunk:
+            break
+        level = downsample(level)
+        n += 1
+    with open(os.path.join(out_dir, 'mosaic.json'), 'w') as f:
+        json.dump({**(metadata or {}), 'chunk': chunk, 'levels': levels}, f, indent=2)
+    return out_dir
+
+
+def read_region(out_dir, level: int, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+    '''read part of one pyramid level, only the chunks that overlap the region are loaded
+
+    args:
+        out_dir: directory written by write_pyramid
+        level: pyramid level, 0 is full resolution
+        y0, y1, x0, x1: region in that level's pixels
+
+    returns: (channel, y1 - y0, x1 - x0) array, clipped to the level size
+    '''
+
+    with open(os.path.join(out_dir, 'mosaic.json')) as f:
+        meta = json.load(f)
+    chunk = meta['chunk']
+    nc, height, width = meta['levels'][level]
+    y0, x0 = max(y0, 0), max(x0, 0)
+    y1, x1 = min(y1, height), min(x1, width)
+    out = np.zeros((nc, max(y1 - y0, 0), max(x1 - x0, 0)), dtype=np.float32)
+    for r in range(y0 // chunk, (y1 - 1) // chunk + 1):
+        for c in range(x0 // chunk, (x1 - 1) // chunk + 1):
+            block = np.load(os.path.join(out_dir, f'level_{level}', f'{r}_{c}.npy'), mmap_mode='r')
+            by, bx = r * chunk, c * chunk
+            sy0, sy1 = max(y0, by), min(y1, by + block.shape[1])
+            sx0, sx1 = max(x0, bx), min(x1, bx + block.shape[2])
+            out[:, sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = block[:, sy0 - by:sy1 - by, sx0 - bx:sx1 - bx]
+    return out
+
+
+_sim_sample = None
+
+def simulated_tile(x_um: float, y_um: float, shape: tuple, pixel_um: float, num_channels: int = 1,
+                   rng=None, jitter_px: float = 3) -> list:
+    '''crop of a fixed random sample at a stage position, with a little stage repeatability error
+
+    args:
+        x_um, y_um: stage position of the tile corner
+        shape: (y, x) pixels per tile
+        pixel_um: pixel size
+        num_channels: channels to return
+        rng: numpy Generator for the jitter and noise
+        jitter_px: max stage error in pixels, so the registration has something to correct
+
+    returns: list of 2D arrays, one per channel
+    '''
+
+    global _sim_sample
+    rng = rng or np.random.default_rng()
+    if _sim_sample is None:
+        # band limited noise, built once and wrapped so any stage position has texture
+        seed = np.random.default_rng(0)
+        size = 2048
+        f = np.fft.rfft2(seed.normal(size=(size, size)))
+        fy = np.fft.fftfreq(size)[:, None]
+        fx = np.fft.rfftfreq(size)[None, :]
+        field = np.fft.irfft2(f * np.exp(-(fx**2 + fy**2) / (2 * 0.1**2)), s=(size, size))
+        _sim_sample = (field - field.min()) / np.ptp(field)
+    oy = int(round(y_um / pixel_um + rng.uniform(-jitter_px, jitter_px)))
+    ox = int(round(x_um / pixel_um + rng.uniform(-jitter_px, jitter_px)))
+    rows = np.arange(oy, oy + shape[0]) % _sim_sample.shape[0]
+    cols = np.arange(ox, ox + shape[1]) % _sim_sample.shape[1]
+    crop = _sim_sample[np.ix_(rows, cols)]
+    return [crop * (1 + 0.3 * ch) + rng.normal(0, 0.01, shape) for ch in range(num_channels)]
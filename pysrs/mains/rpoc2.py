@@ -2,6 +2,39 @@ import tkinter as tk
 from tkinter import ttk, filedialog
 from PIL import Image, ImageTk, ImageDraw, ImageOps
 import numpy as np
+import math
+from pysrs.mains import mask_io
+
+LANCZOS_SUPPORT = 3 # lanczos reaches 3 source pixels (more when shrinking) past each output pixel
+BRUSH_WIDTH = 2
+
+def display_region(box, image_size, display_size, support=LANCZOS_SUPPORT):
+    '''display pixels whose resize footprint touches an image region, and the image pixels needed to redo them
+
+    args:
+        box: changed image region (x0, y0, x1, y1)
+        image_size: (width, height) of the full image
+        display_size: (width, height) it is resized to on the canvas
+        support: filter support in source pixels
+
+    returns: (display box, source box), both (x0, y0, x1, y1)
+    '''
+
+    dst, src = [], []
+    for lo, hi, n_img, n_disp in ((box[0], box[2], image_size[0], display_size[0]),
+                                  (box[1], box[3], image_size[1], display_size[1])):
+        scale = n_img / n_disp
+        reach = support * max(scale, 1.0)
+        d0 = max(int(math.floor((lo - reach) / scale - 0.5)), 0)
+        d1 = min(int(math.ceil((hi + reach) / scale - 0.5)) + 1, n_disp)
+        dst.append((d0, d1))
+        src.append((max(int(math.floor(d0 * scale - reach)) - 1, 0), min(int(math.ceil(d1 * scale + reach)) + 1, n_img)))
+    return (dst[0][0], dst[1][0], dst[0][1], dst[1][1]), (src[0][0], src[1][0], src[0][1], src[1][1])
+
+def patch_photo(photo, patch, x, y):
+    # tk copies the small photo into the displayed one in place, the full size image is never converted again
+    small = ImageTk.PhotoImage(patch)
+    photo.tk.call(str(photo), 'copy', str(small), '-to', x, y)
 
 class ColorSlider(tk.Canvas):
     def __init__(self, master, min_val=0, max_val=255, init_val=0, width=200, height=20,
@@ -67,8 +100,9 @@ class ColorSlider(tk.Canvas):
             self.command(value)
 
 class RPOC:
-    def __init__(self, root, image=None):
+    def __init__(self, root, image=None, geometry=None):
         self.root = root
+        self.geometry = geometry # scan the image came from (Galvo or config), stored with .rmask saves
 
         style = ttk.Style()
         style.theme_use('clam')
@@ -103,6 +137,11 @@ class RPOC:
         self.eraser_var = tk.BooleanVar(value=False)
         self.fill_loop_var = tk.BooleanVar(value=True)
 
+        self.drawing = False
+        self.points = []
+        self.mask_index = None
+        self.display_sizes = {} # canvas -> size the cached display image was rendered at
+
         self.build_ui()
         self.update_images()
 
@@ -136,14 +175,14 @@ class RPOC:
         self.lower_slider = ColorSlider(
             controls_frame, min_val=0, max_val=255, init_val=self.lower_threshold.get(),
             width=200, height=20, fill_side='left', accent_color=self.highlight_color, bg_color='#505050',
-            command=lambda val: [self.lower_threshold.set(val), self.update_images()]
+            command=lambda val: [self.lower_threshold.set(val), self.update_thresholds()]
         )
         self.lower_slider.pack(side=tk.LEFT, padx=5, pady=5)
 
         self.upper_slider = ColorSlider(
             controls_frame, min_val=0, max_val=255, init_val=self.upper_threshold.get(),
             width=200, height=20, fill_side='right', accent_color='#FF0000', bg_color='#505050',
-            command=lambda val: [self.upper_threshold.set(val), self.update_images()]
+            command=lambda val: [self.upper_threshold.set(val), self.update_thresholds()]
         )
         self.upper_slider.pack(side=tk.LEFT, padx=5, pady=5)
 
@@ -153,19 +192,20 @@ class RPOC:
         ).pack(side=tk.LEFT, padx=5, pady=5)
 
         ttk.Checkbutton(
-            controls_frame, text='Fill Loop', variable=self.fill_loop_var,
-            command=self.update_images
+            controls_frame, text='Fill Loop', variable=self.fill_loop_var
         ).pack(side=tk.LEFT, padx=5, pady=5)
 
         ttk.Checkbutton(
-            controls_frame, text='Eraser', variable=self.eraser_var,
-            command=self.update_images
+            controls_frame, text='Eraser', variable=self.eraser_var
         ).pack(side=tk.LEFT, padx=5, pady=5)
 
         ttk.Button(
             controls_frame, text='Save Mask', command=self.save_mask
         ).pack(side=tk.LEFT, padx=5, pady=5)
 
+        self.fraction_label = ttk.Label(controls_frame, text='')
+        self.fraction_label.pack(side=tk.LEFT, padx=5, pady=5)
+
         self.mask_canvas.bind('<ButtonPress-1>', self.start_drawing)
         self.mask_canvas.bind('<B1-Motion>', self.draw_mask)
         self.mask_canvas.bind('<ButtonRelease-1>', self.stop_drawing)
@@ -178,44 +218,82 @@ class RPOC:
 
 
     def on_resize(self, event=None):
-        self.update_images()
+        # <Configure> fires for every child of the window, only redraw when a canvas really changed size
+        if any(self.display_sizes.get(canvas) != self.canvas_size(canvas)
+               for canvas in (self.mask_canvas, self.preview_canvas)):
+            self.update_images()
+
+    def canvas_size(self, canvas):
+        w, h = canvas.winfo_width(), canvas.winfo_height()
+        if w < 2 or h < 2:
+            return self.img_width, self.img_height
+        return w, h
 
     def get_base_image(self):
         if self.invert_var.get():
             return ImageOps.invert(self.original_image)
         return self.original_image
 
-    def update_mask_image(self):
-        self.mask_canvas.delete("all")        
-
+    def update_layers(self):
+        # full resolution layers, only change with invert
         base = self.get_base_image()
-        gray = base.convert('L')
-        lower, upper = self.lower_threshold.get(), self.upper_threshold.get()
+        self.base_np = np.array(base)
+        self.gray_image = base.convert('L')
+        self.gray_np = np.array(self.gray_image)
+        self.histogram = np.bincount(self.gray_np.ravel(), minlength=256)
 
-        gray_np = np.array(gray)
-        rgb_np = np.stack([gray_np, gray_np, gray_np], axis=-1)
+    def update_lut(self):
+        '''threshold colours for every gray level, the only thing that changes when a slider moves
 
-        self.valid_pixels = (gray_np >= lower) & (gray_np <= upper)
+        the lut has 512 entries, gray + 256 * drawn, so one lookup colours the whole display including strokes.
+        entries are rgba packed into uint32, so the lookup is a single np.take and the result is already image bytes
 
-        rgb_np[gray_np < lower] = [0, 0, 255]
-        rgb_np[gray_np > upper] = [255, 0, 0]
+        args: none
 
-        mask_np = np.array(self.binary_mask)
-        drawn = (mask_np == 255)
-        valid_drawn = drawn & self.valid_pixels
-        rgb_np[valid_drawn] = [0, 255, 0]
+        returns: none
+        '''
 
-        thresholded_full = Image.fromarray(rgb_np.astype('uint8'), 'RGB')
-
-        mask_w = self.mask_canvas.winfo_width()
-        mask_h = self.mask_canvas.winfo_height()
-        if mask_w < 2 or mask_h < 2:
-            mask_w, mask_h = self.img_width, self.img_height
-
-        thresholded_resized = thresholded_full.resize((mask_w, mask_h), Image.Resampling.LANCZOS)
-        self.mask_image = thresholded_resized
-        self.tk_mask_image = ImageTk.PhotoImage(self.mask_image)
+        lower, upper = self.lower_threshold.get(), self.upper_threshold.get()
+        levels = np.arange(256, dtype=np.uint8)
+        self.valid_lut = (levels >= lower) & (levels <= upper)
+
+        lut = np.repeat(levels[:, None], 3, axis=1)
+        lut[levels < lower] = [0, 0, 255]
+        lut[levels > upper] = [255, 0, 0]
+        drawn = lut.copy()
+        drawn[self.valid_lut] = [0, 255, 0]
+        rgba = np.full((512, 4), 255, dtype=np.uint8)
+        rgba[:, :3] = np.concatenate([lut, drawn])
+        self.lut = rgba.view(np.uint32).ravel()
+
+        inside = self.histogram[self.valid_lut].sum() / max(self.histogram.sum(), 1)
+        self.fraction_label.config(text=f'In range: {100 * inside:.1f}%')
+
+    def colour(self, index):
+        h, w = index.shape
+        return Image.frombuffer('RGBA', (w, h), np.take(self.lut, index), 'raw', 'RGBA', 0, 1)
+
+    def valid_pixels(self, box=None):
+        # pixels inside the thresholds, looked up instead of stored so slider moves never touch the full image
+        if box is None:
+            return self.valid_lut[self.gray_np]
+        x0, y0, x1, y1 = box
+        return self.valid_lut[self.gray_np[y0:y1, x0:x1]]
+
+    def render_preview(self, box):
+        x0, y0, x1, y1 = box
+        drawn = np.asarray(self.binary_mask.crop(box)) == 255
+        return Image.fromarray(np.where(drawn[..., None], self.base_np[y0:y1, x0:x1], 0).astype(np.uint8), 'RGB')
 
+    def update_mask_image(self):
+        # resized gray and strokes are cached as one lut index per display pixel, gray + 256 * drawn
+        self.mask_canvas.delete("all")
+        size = self.canvas_size(self.mask_canvas)
+        gray = np.asarray(self.gray_image.resize(size, Image.Resampling.LANCZOS)).astype(np.uint16)
+        drawn = np.asarray(self.binary_mask.resize(size, Image.Resampling.LANCZOS)) > 127
+        self.mask_index = gray + 256 * drawn
+        self.tk_mask_image = ImageTk.PhotoImage(self.colour(self.mask_index))
+        self.display_sizes[self.mask_canvas] = size
         self.mask_image_id = self.mask_canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_mask_image)
 
     def get_mask_applied_image(self):
@@ -225,23 +303,76 @@ class RPOC:
 
     def update_preview(self):
         self.preview_canvas.delete("all")
-
-        preview_full = self.get_mask_applied_image()
-        pw = self.preview_canvas.winfo_width()
-        ph = self.preview_canvas.winfo_height()
-
-        if pw < 2 or ph < 2:
-            pw, ph = self.img_width, self.img_height
-
-        preview_resized = preview_full.resize((pw, ph), Image.Resampling.LANCZOS)
-        self.tk_preview_image = ImageTk.PhotoImage(preview_resized)
-
+        size = self.canvas_size(self.preview_canvas)
+        full = self.render_preview((0, 0, self.img_width, self.img_height))
+        self.tk_preview_image = ImageTk.PhotoImage(full.resize(size, Image.Resampling.LANCZOS))
+        self.display_sizes[self.preview_canvas] = size
         self.preview_image_id = self.preview_canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_preview_image)
 
     def update_images(self, event=None):
+        # full redraw, only needed when invert or the canvas sizes change
+        self.update_layers()
+        self.update_lut()
         self.update_mask_image()
         self.update_preview()
 
+    def update_thresholds(self):
+        # slider moves rebuild the 512 entry lut and recolour the cached display, nothing is resized
+        if self.mask_index is None:
+            return
+        self.update_lut()
+        self.tk_mask_image.paste(self.colour(self.mask_index))
+
+    def resize_region(self, render, box, size):
+        '''resize just the display pixels an image region affects
+
+        args:
+            render: callable(source box) returning that part of the full resolution image
+            box: changed image region (x0, y0, x1, y1)
+            size: display size
+
+        returns: (display box, resized patch)
+        '''
+
+        (dx0, dy0, dx1, dy1), src = display_region(box, (self.img_width, self.img_height), size)
+        sx = self.img_width / size[0]
+        sy = self.img_height / size[1]
+        # same filter taps as the full resize, so the patch lines up with the rest of the image
+        patch = render(src).resize((dx1 - dx0, dy1 - dy0), Image.Resampling.LANCZOS,
+                                   box=(dx0 * sx - src[0], dy0 * sy - src[1], dx1 * sx - src[0], dy1 * sy - src[1]))
+        return (dx0, dy0, dx1, dy1), patch
+
+    def refresh_region(self, box):
+        '''re-render the part of both canvases a stroke touched and patch it into the displayed images
+
+        args:
+            box: changed image region (x0, y0, x1, y1), clipped to the image here
+
+        returns: none
+        '''
+
+        box = (max(box[0], 0), max(box[1], 0), min(box[2], self.img_width), min(box[3], self.img_height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+
+        size = self.display_sizes.get(self.mask_canvas)
+        if size is not None:
+            (dx0, dy0, dx1, dy1), patch = self.resize_region(self.binary_mask.crop, box, size)
+            index = self.mask_index[dy0:dy1, dx0:dx1]
+            index[:] = (index & 255) + 256 * (np.asarray(patch) > 127)
+            patch_photo(self.tk_mask_image, self.colour(index), dx0, dy0)
+
+        size = self.display_sizes.get(self.preview_canvas)
+        if size is not None:
+            (dx0, dy0, dx1, dy1), patch = self.resize_region(self.render_preview, box, size)
+            patch_photo(self.tk_preview_image, patch, dx0, dy0)
+
+    @staticmethod
+    def stroke_box(points, width=BRUSH_WIDTH):
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        return (min(xs) - width, min(ys) - width, max(xs) + width + 1, max(ys) + width + 1)
+
     def start_drawing(self, event):
         self.drawing = True
         self.points = [self._canvas_to_image_coords(event.widget, event.x, event.y)]
@@ -256,38 +387,40 @@ class RPOC:
 
         if not self.fill_loop_var.get():
             fill_val = 0 if self.eraser_var.get() else 255
-            if self.eraser_var.get() or self.valid_pixels[current_point[1], current_point[0]]:
+            if self.eraser_var.get() or self.valid_lut[self.gray_np[current_point[1], current_point[0]]]:
                 draw_full = ImageDraw.Draw(self.binary_mask)
-                draw_full.line([self.points[-1], current_point], fill=fill_val, width=2)
-            self.update_images()
+                draw_full.line([self.points[-1], current_point], fill=fill_val, width=BRUSH_WIDTH)
+                self.refresh_region(self.stroke_box([self.points[-1], current_point]))
 
         self.points.append(current_point)
 
     def stop_drawing(self, event):
+        if not self.drawing:
+            return
         self.drawing = False
         if len(self.points) < 2:
             return
 
-        fill_val = 0 if self.eraser_var.get() else 255
-
         if not self.fill_loop_var.get():
-            self.update_images()
             return
 
-        temp_mask = Image.new("L", (self.img_width, self.img_height), 0)
+        # only the loop's bounding box is touched
+        x0, y0, x1, y1 = self.stroke_box(self.points, width=1)
+        box = (max(x0, 0), max(y0, 0), min(x1, self.img_width), min(y1, self.img_height))
+        temp_mask = Image.new("L", (box[2] - box[0], box[3] - box[1]), 0)
         temp_draw = ImageDraw.Draw(temp_mask)
-        temp_draw.polygon(self.points, outline=fill_val, fill=fill_val)
+        temp_draw.polygon([(x - box[0], y - box[1]) for x, y in self.points], outline=255, fill=255)
 
-        mask_np = np.array(self.binary_mask)
-        temp_mask_np = np.array(temp_mask)
+        mask_np = np.array(self.binary_mask.crop(box))
+        inside = np.array(temp_mask) == 255
 
         if self.eraser_var.get():
-            mask_np[temp_mask_np == 255] = 0
+            mask_np[inside] = 0
         else:
-            mask_np = np.where(self.valid_pixels, np.maximum(mask_np, temp_mask_np), mask_np)
+            mask_np[inside & self.valid_pixels(box)] = 255
 
-        self.binary_mask = Image.fromarray(mask_np.astype('uint8'))
-        self.update_images()
+        self.binary_mask.paste(Image.fromarray(mask_np), box[:2])
+        self.refresh_region(box)
 
     def _canvas_to_image_coords(self, canvas_widget, cx, cy):
         canvas_w = canvas_widget.winfo_width()
@@ -299,9 +432,13 @@ class RPOC:
         return (int(round(cx * scale_x)), int(round(cy * scale_y)))
 
     def save_mask(self):
-        path = filedialog.asksaveasfilename(defaultextension='.png',
-                                            filetypes=[('PNG files', '*.png')])
-        if path:
+        path = filedialog.asksaveasfilename(defaultextension=mask_io.EXTENSION,
+                                            filetypes=[('RPOC masks', '*' + mask_io.EXTENSION), ('PNG files', '*.png')])
+        if not path:
+            return
+        if path.endswith(mask_io.EXTENSION):
+            mask_io.save_mask(path, np.array(self.binary_mask), self.geometry)
+        else:
             self.binary_mask.save(path)
 
 if __name__ == '__main__':
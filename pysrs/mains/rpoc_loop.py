@@ -0,0 +1,135 @@
+# rpoc_loop.py
+import time
+import numpy as np
+import automask
+
+'''
+closed loop rpoc
+
+every reconstructed frame is turned into a new mask (automask pipeline), compiled to the TTL pattern on the
+raster clock and handed back to the acquisition loop, which plays it with the very next frame. the time from
+the frame's samples being in memory to the TTL being written into the DO buffer and the next raster armed is
+the latency (update() covers reduction, mask and compile, armed() adds the buffer write and task start), and
+it has a budget: the dead time we allow between frames, one frame period by default so a cell cannot move
+more than a frame before its mask catches up. every frame's latency is kept and reported, and frames over
+budget are counted.
+'''
+
+
+class ClosedLoopRPOC:
+    def __init__(self, galvo, settings: dict = None, budget_s: float = None, history: int = 1000) -> None:
+        '''mask regeneration and TTL compile between frames
+
+        args:
+            galvo: Galvo the TTL is played with
+            settings: automask.make_mask keyword arguments
+            budget_s: allowed latency, None for one frame period
+            history: frames of latency records kept
+
+        returns: none
+        '''
+
+        self.galvo = galvo
+        self.settings = dict(settings or {})
+        self.frame_s = galvo.total_samples / galvo.rate
+        self.budget_s = self.frame_s if budget_s is None else budget_s
+        self.history = history
+        self.records = []
+        self.frames = 0
+        self.missed = 0
+        self.mask = None
+        self._pending = None # (t_ready, t_ttl) of the last update, waiting for armed()
+        # two TTL buffers, one can be playing while the next one is written
+        self.buffers = [np.zeros(galvo.total_samples, dtype=bool) for _ in range(2)]
+
+    def update(self, frame, t_ready: float = None) -> np.ndarray:
+        '''new mask and TTL from the latest frame
+
+        args:
+            frame: (channels, ny, nx) reconstructed images
+            t_ready: perf_counter time the raw samples were read, so reduction counts toward the latency
+
+        returns: bool TTL array of total_samples for the next frame
+        '''
+
+        t0 = time.perf_counter()
+        t_ready = t0 if t_ready is None else t_ready
+        self.mask = automask.make_mask(frame, **self.settings)
+        t1 = time.perf_counter()
+        ttl = self.galvo.ttl_waveform(self.mask, out=self.buffers[self.frames % 2])
+        t2 = time.perf_counter()
+
+        # provisional until armed() says when the TTL actually went out
+        latency = t2 - t_ready
+        record = {
+            'frame': self.frames,
+            'reduce_ms': 1e3 * (t0 - t_ready),
+            'mask_ms': 1e3 * (t1 - t0),
+            'compile_ms': 1e3 * (t2 - t1),
+            'arm_ms': None,
+            'latency_ms': 1e3 * latency,
+            'budget_ms': 1e3 * self.budget_s,
+            'missed': latency > self.budget_s,
+            'coverage': float(self.mask.mean() / 255),
+        }
+        self._pending = (t_ready, t2)
+        self.frames += 1
+        self.records.append(record)
+        if len(self.records) > self.history:
+            del self.records[0]
+        return ttl
+
+    def armed(self, t_armed: float) -> dict:
+        '''close the latency of the last update once its TTL is written and the next raster is started
+
+        args:
+            t_armed: perf_counter time the tasks playing the TTL were started (read_raster's on_armed)
+
+        returns: the finished record
+        '''
+
+        if self._pending is None:
+            return self.last()
+        t_ready, t_ttl = self._pending
+        self._pending = None
+        record = self.records[-1]
+        latency = t_armed - t_ready
+        record['arm_ms'] = 1e3 * (t_armed - t_ttl)
+        record['latency_ms'] = 1e3 * latency
+        record['missed'] = latency > self.budget_s
+        self.missed += record['missed']
+        return record
+
+    def last(self) -> dict:
+        return self.records[-1] if self.records else {}
+
+    def summary(self) -> dict:
+        '''latency statistics over the kept history
+
+        args: none
+
+        returns: dict with frames, missed, budget_ms, and mean / p95 / max latency in ms
+        '''
+
+        records = self.records[:-1] if self._pending is not None else self.records # the last TTL never played
+        latencies = np.array([r['latency_ms'] for r in records])
+        if latencies.size == 0:
+            return {'frames': 0, 'missed': 0, 'budget_ms': 1e3 * self.budget_s}
+        return {
+            'frames': self.frames,
+            'missed': self.missed,
+            'budget_ms': 1e3 * self.budget_s,
+            'mean_ms': float(latencies.mean()),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'max_ms': float(latencies.max()),
+        }
+
+
+def ttl_line_name(device: str, text: str) -> str:
+    # the gui field takes 'po4' (port0 line4), 'port0/line4' or a full 'Dev1/port0/line4'
+    text = text.strip()
+    if text.startswith(device + '/'):
+        return text
+    if text.lower().startswith('po') and text[2:].isdigit():
+        return f'{device}/port0/line{int(text[2:])}'
+    return f'{device}/{text}'
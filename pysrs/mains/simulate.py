@@ -0,0 +1,170 @@
+# simulate.py
+import numpy as np
+
+'''
+vectorized srs image simulator for simulation mode
+
+a phantom made of a few chemical components (lipid droplets, cytoplasm/protein, nuclei) is built once per
+frame size, blurred by the psf once (blur is linear, so blurring the components is the same as blurring
+every frame), and cached. a frame is then just a weighted sum of the cached maps, where the weights come
+from each component's raman band evaluated at the current delay stage position, plus shot and readout noise.
+'''
+
+# raman bands of the components on the delay stage axis (um), matched to the default 20000-30000 um scan
+COMPONENTS = [
+    {'name': 'lipid', 'center_um': 24000, 'width_um': 900, 'strength': 1.0},
+    {'name': 'protein', 'center_um': 26500, 'width_um': 1400, 'strength': 0.45},
+    {'name': 'nucleic acid', 'center_um': 28500, 'width_um': 1100, 'strength': 0.6},
+]
+# how strongly each component shows up in each detector channel, rows repeat for more channels
+CHANNEL_WEIGHTS = np.array([
+    [1.0, 1.0, 1.0],
+    [0.2, 1.0, 0.4],
+    [0.1, 0.3, 1.0],
+])
+NON_RESONANT = 0.05 # flat background present at every delay
+
+
+class SRSSimulator:
+    def __init__(self, seed: int = None, psf_sigma_px: float = 1.2, photons: float = 400, read_noise: float = 0.01) -> None:
+        '''renders simulated frames from a cached phantom
+
+        args:
+            seed: seed for the noise, None for a fresh one each run. the phantom itself is always the same
+            psf_sigma_px: gaussian psf width in pixels
+            photons: detected photons at intensity 1, sets the shot noise
+            read_noise: gaussian detector noise in intensity units
+
+        returns: none
+        '''
+
+        self.rng = np.random.default_rng(seed)
+        self.psf_sigma_px = psf_sigma_px
+        self.photons = photons
+        self.read_noise = read_noise
+        self._maps = {}
+
+    def component_maps(self, ny: int, nx: int) -> np.ndarray:
+        '''psf blurred concentration map of every component, built on first use for each frame size
+
+        args:
+            ny, nx: frame size
+
+        returns: float32 array (components, ny, nx)
+        '''
+
+        key = (ny, nx)
+        if key not in self._maps:
+            self._maps[key] = self.blur(build_phantom(ny, nx))
+        return self._maps[key]
+
+    def blur(self, maps: np.ndarray) -> np.ndarray:
+        if self.psf_sigma_px <= 0:
+            return maps.astype(np.float32)
+        ny, nx = maps.shape[1:]
+        fy = np.fft.fftfreq(ny)[:, None]
+        fx = np.fft.rfftfreq(nx)[None, :]
+        otf = np.exp(-2 * (np.pi * self.psf_sigma_px)**2 * (fx**2 + fy**2)) # fourier transform of the gaussian psf
+        return np.fft.irfft2(np.fft.rfft2(maps) * otf, s=(ny, nx)).astype(np.float32)
+
+    def spectra(self, delay_um: float) -> np.ndarray:
+        # strength of every component at this delay position
+        return np.array([c['strength'] * np.exp(-0.5 * ((delay_um - c['center_um']) / c['width_um'])**2)
+                         for c in COMPONENTS])
+
+    def frame(self, num_channels: int, ny: int, nx: int, delay_um: float = None) -> list:
+        '''one simulated frame
+
+        args:
+            num_channels: number of detector channels
+            ny, nx: frame size
+            delay_um: delay stage position, None puts every component at its band peak
+
+        returns: list of 2D float32 arrays, one per channel
+        '''
+
+        maps = self.component_maps(ny, nx)
+        if delay_um is None:
+            weights = np.array([c['strength'] for c in COMPONENTS])
+        else:
+            weights = self.spectra(delay_um)
+        channel_weights = CHANNEL_WEIGHTS[np.arange(num_channels) % len(CHANNEL_WEIGHTS)] * weights[None, :]
+        clean = np.tensordot(channel_weights.astype(np.float32), maps, axes=1) + NON_RESONANT
+
+        # shot noise through the gaussian limit of poisson, much faster and indistinguishable at these counts
+        noise = self.rng.standard_normal(clean.shape, dtype=np.float32)
+        noisy = clean + noise * np.sqrt(clean / self.photons + self.read_noise**2)
+        return list(noisy)
+
+
+def build_phantom(ny: int, nx: int) -> np.ndarray:
+    '''concentration maps of the components, a fixed seed so the sample looks the same every run
+
+    args:
+        ny, nx: frame size
+
+    returns: float32 array (components, ny, nx) with values in [0, 1]
+    '''
+
+    rng = np.random.default_rng(1234)
+    y, x = np.mgrid[0:ny, 0:nx].astype(np.float32)
+    y /= max(ny, 1)
+    x /= max(nx, 1)
+    lipid = np.zeros((ny, nx), np.float32)
+    protein = np.zeros((ny, nx), np.float32)
+    nucleus = np.zeros((ny, nx), np.float32)
+
+    # a few cells, each an ellipse of protein with an elliptical nucleus and lipid droplets inside
+    for _ in range(6):
+        cy, cx = rng.uniform(0.15, 0.85, 2)
+        ry, rx = rng.uniform(0.08, 0.16, 2)
+        angle = rng.uniform(0, np.pi)
+        dy, dx = y - cy, x - cx
+        u = (dx * np.cos(angle) + dy * np.sin(angle)) / rx
+        v = (-dx * np.sin(angle) + dy * np.cos(angle)) / ry
+        r2 = u**2 + v**2
+        protein = np.maximum(protein, np.clip(1.2 - r2, 0, 1) * 0.8)
+        nucleus = np.maximum(nucleus, ((u - 0.15)**2 + v**2 < 0.12).astype(np.float32))
+        for _ in range(rng.integers(4, 10)):
+            a = rng.uniform(0, 2 * np.pi)
+            d = rng.uniform(0.45, 0.9)
+            py = cy + ry * d * np.sin(a)
+            px = cx + rx * d * np.cos(a)
+            radius = rng.uniform(0.006, 0.015)
+            # only the pixels within 4 radii, the rest of the gaussian is zero anyway
+            y0, y1 = max(int((py - 4 * radius) * ny), 0), min(int((py + 4 * radius) * ny) + 1, ny)
+            x0, x1 = max(int((px - 4 * radius) * nx), 0), min(int((px + 4 * radius) * nx) + 1, nx)
+            if y0 < y1 and x0 < x1:
+                blob = np.exp(-((y[y0:y1, x0:x1] - py)**2 + (x[y0:y1, x0:x1] - px)**2) / (2 * radius**2))
+                lipid[y0:y1, x0:x1] = np.maximum(lipid[y0:y1, x0:x1], blob)
+
+    # slowly varying texture so the background is not perfectly flat
+    texture = np.fft.irfft2(np.fft.rfft2(rng.normal(size=(ny, nx)))
+                            * np.exp(-(np.fft.fftfreq(ny)[:, None]**2 + np.fft.rfftfreq(nx)[None, :]**2) / 2e-4),
+                            s=(ny, nx))
+    texture = (texture - texture.min()) / (np.ptp(texture) + 1e-12)
+    protein = protein + 0.15 * texture
+    return np.stack([lipid, protein, nucleus]).astype(np.float32)
+
+
+_simulators = {}
+
+def generate_frame(num_channels: int = 1, config: dict = None, delay_um: float = None, seed: int = None) -> list:
+    '''drop in for utils.generate_data, one simulator (and phantom cache) is kept per seed
+
+    args:
+        num_channels: number of detector channels
+        config: acquisition config, numsteps_x / numsteps_y set the frame size
+        delay_um: delay stage position, None for every band at its peak
+        seed: noise seed for reproducible runs, config['sim_seed'] is used when not given
+
+    returns: list of 2D arrays, one per channel
+    '''
+
+    config = config or {}
+    nx = config.get('numsteps_x', 200)
+    ny = config.get('numsteps_y', 200)
+    seed = config.get('sim_seed') if seed is None else seed
+    if seed not in _simulators:
+        _simulators[seed] = SRSSimulator(seed)
+    return _simulators[seed].frame(num_channels, ny, nx, delay_um)
@@ -0,0 +1,74 @@
+# startup.py
+import threading
+import time
+
+'''
+startup phase timings
+
+main.py starts a PhaseTimer before anything heavy is imported and the gui times each phase into it: imports,
+widgets, the first drawn window, the deferred display (matplotlib) and the instrument probe, which runs in the
+background. once every phase has finished one line is printed, so a slow start shows which phase to look at.
+'''
+
+
+class PhaseTimer:
+    def __init__(self, expected: tuple = ()) -> None:
+        '''wall clock per startup phase, safe to use from the probe thread
+
+        args:
+            expected: phases to wait for before report_when_done prints
+
+        returns: none
+        '''
+
+        self.t0 = time.perf_counter()
+        self.expected = set(expected)
+        self.phases = {} # name -> (start_s, end_s) relative to t0
+        self._lock = threading.Lock()
+        self._reported = False
+
+    def phase(self, name: str) -> '_Phase':
+        # with timer.phase('widgets'): ...
+        return _Phase(self, name)
+
+    def record(self, name: str, start_s: float, end_s: float) -> None:
+        with self._lock:
+            self.phases[name] = (start_s - self.t0, end_s - self.t0)
+
+    def mark(self, name: str) -> None:
+        # a point in time rather than a span, e.g. the window being drawn
+        now = time.perf_counter()
+        self.record(name, now, now)
+        self.report_when_done()
+
+    def report(self) -> str:
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda item: item[1][0])
+        parts = []
+        for name, (start, end) in phases:
+            parts.append(f'{name} at {1e3 * end:.0f} ms' if end == start else f'{name} {1e3 * (end - start):.0f} ms')
+        total = max((end for _, end in self.phases.values()), default=0.0)
+        return f"[INFO] Startup: {', '.join(parts)} (total {1e3 * total:.0f} ms)"
+
+    def report_when_done(self) -> None:
+        # prints once, from whichever thread finishes the last expected phase
+        with self._lock:
+            if self._reported or not self.expected <= set(self.phases):
+                return
+            self._reported = True
+        print(self.report())
+
+
+class _Phase:
+    def __init__(self, timer: PhaseTimer, name: str) -> None:
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.record(self.name, self.start, time.perf_counter())
+        self.timer.report_when_done()
+        return False
@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import concurrent.futures
+import numpy as np
+
+'''
+streaming store for volumes (z-stacks, and z-stacks of hyperspectral cubes)
+
+planes are handed over as soon as they are read and get reduced and written on a background thread, so the
+acquisition loop can already be moving the focus to the next plane. the store is a plain .npy memmap with
+a json sidecar for the axes, np.load(path, mmap_mode='r') opens it without reading the whole volume.
+'''
+
+
+class VolumeWriter:
+    def __init__(self, shape: tuple, path=None, metadata: dict = None, dtype=np.float32, max_pending: int = 4) -> None:
+        '''preallocate the volume and start the writer thread
+
+        args:
+            shape: full volume shape, (z, channel, y, x) or (z, delay, channel, y, x)
+            path: .npy file to stream into, None keeps the volume in memory only
+            metadata: axes and settings written next to the volume as <path>.json
+            dtype: on disk type
+            max_pending: planes allowed to wait for the writer before put() blocks, bounds memory on slow disks
+
+        returns: none
+        '''
+
+        self.shape = tuple(shape)
+        self.path = path
+        self.metadata = dict(metadata or {}, shape=list(self.shape), dtype=np.dtype(dtype).name)
+        if path:
+            dirpath = os.path.dirname(path)
+            if dirpath:
+                os.makedirs(dirpath, exist_ok=True)
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=self.shape)
+            self.write_metadata()
+        else:
+            self.array = np.zeros(self.shape, dtype=dtype)
+        self.written = np.zeros(self.shape[:-3], dtype=bool) # which planes actually made it, the scan can be stopped early
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='volume')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+
+    def write_metadata(self) -> None:
+        if self.path:
+            with open(os.path.splitext(self.path)[0] + '.json', 'w') as f:
+                json.dump(self.metadata, f, indent=2)
+
+    def put(self, index: tuple, frame, reduce=None) -> concurrent.futures.Future:
+        '''queue one plane for writing
+
+        args:
+            index: leading index of the plane, (iz,) or (iz, idelay)
+            frame: list of 2D arrays, one per channel, or raw samples if reduce is given
+            reduce: optional callable turning frame into that list, runs on the writer thread
+
+        returns: future resolving to the list of 2D arrays that was written
+        '''
+
+        self._slots.acquire()
+        future = self._executor.submit(self._write, tuple(index), frame, reduce)
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def _write(self, index, frame, reduce):
+        planes = reduce(frame) if reduce is not None else frame
+        self.array[index] = np.stack(planes)
+        self.written[index] = True
+        return planes
+
+    def close(self) -> np.ndarray:
+        '''wait for every queued plane, flush, and record how far the scan got
+
+        args: none
+
+        returns: the volume array (a memmap when streaming to disk)
+        '''
+
+        self._executor.shutdown(wait=True)
+        errors = [f.exception() for f in self._futures if f.exception() is not None]
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
+        self.metadata['complete'] = bool(self.written.all())
+        self.metadata['planes_written'] = int(self.written.sum())
+        self.write_metadata()
+        if errors:
+            raise errors[0]
+        return self.array
+
+
+def load_volume(path):
+    '''open a volume written by VolumeWriter without reading it into memory
+
+    args:
+        path: the .npy file
+
+    returns: (memmapped array, metadata dict)
+    '''
+
+    meta_path = os.path.splitext(path)[0] + '.json'
+    metadata = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            metadata = json.load(f)
+    return np.load(path, mmap_mode='r'), metadata
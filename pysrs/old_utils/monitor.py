@@ -3,21 +3,16 @@ from nidaqmx.constants import AcquisitionType
 import numpy as np
 import time
 import matplotlib.pyplot as plt
+from pysrs.aaaa.gui.live_trace import LiveTrace
 
-def monitor(device, channels, duration, rate, interval):
-    num_samples = int(duration * rate)
+def monitor(device, channels, duration, rate, interval, window=60):
     chunk_size = int(interval * rate)
     total_chunks = int(duration / interval)
 
-    timestamps = {ch: [] for ch in channels}
-    values = {ch: [] for ch in channels}
-
     plt.ion()
     fig, ax = plt.subplots()
-    plots = {}
-    for ch in channels:
-        plots[ch], = ax.plot([], [], label=f"{device}/{ch}")
-    
+    trace = LiveTrace(ax, [f"{device}/{ch}" for ch in channels], rate, window_s=window)
+
     ax.set_xlabel("Time (s)")
     ax.set_ylabel("Voltage (V)")
     ax.set_title("Real-Time Monitoring")
@@ -39,24 +34,8 @@ def monitor(device, channels, duration, rate, interval):
                 break
 
             data = task.read(number_of_samples_per_channel=chunk_size)
-            if len(channels) == 1:
-                data = [data]
-
-            time_chunk = np.linspace(
-                chunk_idx * interval,
-                (chunk_idx + 1) * interval,
-                chunk_size,
-                endpoint=False
-            )
-
-            for idx, channel in enumerate(channels):
-                timestamps[channel].extend(time_chunk)
-                values[channel].extend(data[idx])
-                plots[channel].set_xdata(timestamps[channel])
-                plots[channel].set_ydata(values[channel])
-            
-            ax.relim()
-            ax.autoscale_view()
+            trace.extend(np.reshape(data, (len(channels), -1)))
+            trace.draw()
             plt.pause(0.01)
 
         task.stop()
@@ -1,10 +1,12 @@
 import nidaqmx
 from nidaqmx.constants import (AcquisitionType, CountDirection, Edge,
     READ_ALL_AVAILABLE, TaskMode, TriggerType)
-from nidaqmx.stream_readers import CounterReader
+from nidaqmx.stream_readers import CounterReader, AnalogSingleChannelReader
 import numpy as np 
 import time
 import matplotlib.pyplot as plt
+from pysrs.aaaa.gui.live_trace import LiveTrace
+from pysrs.aaaa.acquisition.recorder import record_stream, load_recording
 
 '''
 old functions from initial testing
@@ -92,10 +94,17 @@ def test_connection(device_name):
     else:
         print('  no connected channels detected')
     
-def time_series(device_name, channel_name, duration, sampling_rate):
+def time_series(device_name, channel_name, duration, sampling_rate, path=None, summary_factor=None):
+    # with a path the samples stream to disk and come back memory mapped, so long runs do not fill the RAM
+    if path is not None:
+        record_stream(device_name, [channel_name], sampling_rate, duration, path, summary_factor=summary_factor)
+        data, header = load_recording(path)
+        return np.arange(len(data)) / sampling_rate, data[:, 0]
+
     num_samples = int(duration * sampling_rate)
-    timestamps = np.linspace(0, duration, num_samples)
-    data = np.zeros(num_samples)
+    timestamps = np.arange(num_samples) / sampling_rate
+    data = np.empty(num_samples)
+    chunk = max(1, int(0.1 * sampling_rate))
     
     with nidaqmx.Task() as task:
         full_channel_name = f'{device_name}/{channel_name}'
@@ -106,28 +115,26 @@ def time_series(device_name, channel_name, duration, sampling_rate):
             sample_mode=AcquisitionType.FINITE,
             samps_per_chan=num_samples
         )
+        reader = AnalogSingleChannelReader(task.in_stream)
         
         print(f'taking {num_samples} samples from {full_channel_name} at {sampling_rate} Hz')
         
         task.start()
-        time.sleep(duration + 0.1)  
-        data = task.read(number_of_samples_per_channel=num_samples)
+        for start in range(0, num_samples, chunk):
+            count = min(chunk, num_samples - start)
+            reader.read_many_sample(data[start:start + count], number_of_samples_per_channel=count, timeout=2)
         task.stop()
     
     print('data acquisition complete')
-    return timestamps, np.array(data)
+    return timestamps, data
 
-def live_series(device_name, channel_name, duration, sampling_rate):
+def live_series(device_name, channel_name, duration, sampling_rate, window=10):
     num_samples = int(duration * sampling_rate)
-    interval = 1 / sampling_rate  # Interval between each sample
     total_samples = 0
-    
-    timestamps = []
-    data = []
 
     plt.ion()  # Turn on interactive mode
     fig, ax = plt.subplots()
-    line, = ax.plot([], [], label=f'{device_name}/{channel_name}')
+    trace = LiveTrace(ax, [f'{device_name}/{channel_name}'], sampling_rate, window_s=window)
     ax.set_xlabel('Time (s)')
     ax.set_ylabel('Voltage (V)')
     ax.set_title(f'Real-Time Data from {device_name}/{channel_name}')
@@ -146,26 +153,14 @@ def live_series(device_name, channel_name, duration, sampling_rate):
         print(f'Starting real-time data acquisition from {full_channel_name}...')
         
         task.start()
-        start_time = time.time()
 
         while total_samples < num_samples:
-            elapsed_time = time.time() - start_time
-            chunk_size = int(min(sampling_rate * elapsed_time, num_samples - total_samples))
+            chunk_size = int(min(task.in_stream.avail_samp_per_chan, num_samples - total_samples))
             if chunk_size > 0:
-                new_data = task.read(number_of_samples_per_channel=chunk_size)
+                trace.extend(task.read(number_of_samples_per_channel=chunk_size))
                 total_samples += chunk_size
-
-                current_time = np.linspace(total_samples / sampling_rate, 
-                                           (total_samples + chunk_size) / sampling_rate, 
-                                           chunk_size, endpoint=False)
-                timestamps.extend(current_time)
-                data.extend(new_data)
-
-                line.set_xdata(timestamps)
-                line.set_ydata(data)
-                ax.relim()
-                ax.autoscale_view()
-                plt.pause(0.01)  
+                trace.draw()
+            plt.pause(0.01)  
         
         task.stop()
     plt.ioff()